@@ -10,7 +10,7 @@
 #                                                                              #
 # Author: Ramon A. Lovato (ramonalovato.com)                                   #
 # For: Deepstorage, LLC (deepstorage.net)                                      #
-# Version: 2.2                                                                 #
+# Version: 3.6                                                                 #
 #                                                                              #
 # Usage: NetJobs.py [OPTIONS] [PATH]                                           #
 # OPTIONS                                                                      #
@@ -28,12 +28,16 @@ import sys
 import os
 import re
 import socket
-import select
-import threading
+import selectors
+import heapq
+import itertools
 import time
+import struct
 import datetime
 import csv
+import json
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 # ############################################################################ #
@@ -54,13 +58,43 @@ MIN_HOSTS_ALL = -1
 AGENT_LISTEN_PORT = 16192
 BUFFER_SIZE = 4096
 SOCKET_TIMEOUT = 60
-SELECT_TIMEOUT = 1
+PREP_WORKERS = 64
+# Synchronized start. Each agent's clock offset is estimated from the fastest
+# of CLOCK_SAMPLES time requests, and agents are told to start at a time far
+# enough ahead for the start message to reach all of them.
+CLOCK_SAMPLES = 5
+START_LEAD_MIN = 0.5
+START_LEAD_PER_AGENT = 0.001
 SOCKET_DELIMITER = '\t'
+# Wire protocol. Every message is a frame: its length in bytes as an unsigned
+# 64-bit big-endian integer, followed by that many bytes of UTF-8 text. The
+# first exchange on a connection is a HELLO carrying the highest protocol
+# version each side speaks; both then use the lower of the two. Version 2
+# adds the metrics message, version 3 the probe message, version 4 the
+# results message, and version 5 the run name in the metrics message.
+FRAME_HEADER = struct.Struct('!Q')
+PROTOCOL_VERSION = 5
+MIN_PROTOCOL_VERSION = 1
+HELLO_STRING = '// HELLO //'
+ERROR_STRING = '// ERROR //'
 READY_STRING = '// READY //'
 START_STRING = '// START //'
+START_AT_STRING = '// START AT //'
+STARTED_STRING = '// STARTED //'
+TIME_STRING = '// TIME //'
 KILL_STRING = '// KILL //'
 DONE_STRING = '// DONE //'
 PING_STATUS_STRING = '// STATUS //'
+CLOSE_STRING = '// CLOSE //'
+METRICS_STRING = '// METRICS //'
+# Figures in a metrics message, in order. Named after the matching Vdbench
+# flatfile columns.
+METRICS_FIELDS = ('Interval', 'rate', 'MB/sec', 'resp', 'queue_depth')
+PROBE_STRING = '// PROBE //'
+PROBE_VERSION = 3
+RESULTS_STRING = '// RESULTS //'
+RESULTS_VERSION = 4
+METRICS_RUN_VERSION = 5
 PING_OK_STRING = 'OK'
 SUCCESS_STATUS = 'SUCCESS'
 ERROR_STATUS = 'ERROR'
@@ -83,13 +117,43 @@ class NetJobs:
     #
     # Initializer.
     #
-    def __init__(self, argv):
+    # In session mode, connections to the agents are kept open after each test
+    # so that calling start again reruns the tests without reconnecting or
+    # resending the specifications. Call close when finished.
+    #
+    # If given, metricsCallback is called as metricsCallback(target, command,
+    # metrics) for each interval an agent reports while its jobs are running,
+    # where metrics is a dictionary keyed by METRICS_FIELDS, plus 'Run', the
+    # Vdbench run definition, from agents that send it. It runs on the
+    # thread that called start, so it should return quickly.
+    #
+    # If extractResults is set, agents that run Vdbench send back the summary
+    # row and histogram from its output directory when each command exits;
+    # see TestConfig.records.
+    #
+    def __init__(self, argv, session=False, metricsCallback=None, extractResults=False):
         "basic initializer"
 
         self.path_in = ''
         self.tests = []
         self.sockets = {}
         self.listeners = {}
+        # Protocol version agreed with each connected agent.
+        self.versions = {}
+        self.session = session
+        self.metricsCallback = metricsCallback
+        self.extractResults = extractResults
+        # Open connections for each test label, in session mode.
+        self.sessions = {}
+
+        # Scheduler state. Other threads ask the event loop to kill all
+        # listeners by setting killRequested and writing to the wakeup socket.
+        self.killRequested = False
+        self.wakeupRecv, self.wakeupSend = socket.socketpair()
+        self.wakeupRecv.setblocking(False)
+        self.wakeupSend.setblocking(False)
+        self.timers = []
+        self.timerCount = itertools.count()
 
         # Process CLI arguments.
         self.eval_options(argv)
@@ -306,103 +370,212 @@ class NetJobs:
             sys.exit('file %s: %s' % (self.path_in, e))
 
     #
-    # Prepare remote agents.
+    # Prepare remote agents. All targets are connected to concurrently, up to
+    # PREP_WORKERS at a time, so one slow or unreachable agent doesn't hold up
+    # the rest. Failures are collected and dealt with once every target has
+    # been tried: socket timeouts count against minhosts, as before, and any
+    # other failure ends the run.
     #
     def prep_agents(self, test):
         if verbose:
             print('\t\tPreparing agents...')
 
-        targets = list(test.specs.keys())
-        for target in targets:
-            # Create TCP socket. Skip if in simulation mode.
-            if not simulate:
-                if verbose:
-                    print('\t\t\tTrying "%s"...' % target, end='')
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                except socket.error as e:
-                    sys.exit('ERROR: failed to create socket for target "%s": %s.'
-                             % (target, e))
-                # Bind socket.
+        # In session mode, agents still connected from the last run are ready.
+        targets = [t for t in test.specs.keys() if t not in self.sockets]
+
+        # Skip if in simulation mode.
+        if not simulate and targets:
+            def prep(target):
                 try:
-                    port = AGENT_LISTEN_PORT
-                    sock = socket.create_connection((target, port), timeout=SOCKET_TIMEOUT)
-                    # Perform a simple echo test to make sure it works.
-                    testBytes = bytes('name' + SOCKET_DELIMITER + target + '\n', 'UTF-8')
-                    sock.sendall(testBytes)
-                    response = sock.recv(BUFFER_SIZE)
-                    if response != testBytes:
-                        sys.exit('ERROR: agent %s failed echo test. Unsure of agent '\
-                                 'identity. Terminating.' % target)
-
-                    # Send commands and timeouts.
-                    commands = test.specs[target]
-                    timeouts = test.timeouts[target]
-                    for command in commands:
-                        timeout = timeouts[command]
-                        # Command.
-                        testBytes = bytes('command' + SOCKET_DELIMITER + command + '\n', 'UTF-8')
-                        sock.sendall(testBytes)
-                        response = sock.recv(BUFFER_SIZE)
-                        if response != testBytes:
-                            sys.exit('ERROR: agent %s failed to acknowledge command %s. Terminating.' % (target, test.specs[target]))
-
-                        # Timeout.
-                        testBytes = bytes('timeout' + SOCKET_DELIMITER + str(timeout) + '\n', 'UTF-8')
-                        sock.sendall(testBytes)
-                        response = sock.recv(BUFFER_SIZE)
-                        if response != testBytes:
-                            sys.exit('ERROR: agent %s failed to acknowledge timeout. Terminating.' % target)
-
-                    # End of commands/timeouts.
-                    testBytes = bytes(READY_STRING + '\n', 'UTF-8')
-                    sock.sendall(testBytes)
-                    response = sock.recv(BUFFER_SIZE)
-                    if response != testBytes:
-                        sys.exit('ERROR: agent %s failed to acknowledge ready. Terminating.' % target)
-
-                    # Good to go.
-                    self.sockets[target] = sock
-                    if verbose:
-                        print('\tSuccess!')
-                except socket.timeout as e:
-                    self.handle_timeout(target, test, self)
-                    print('ERROR: a socket timeout occurred: %s.' % e)
-                except socket.error as e:
-                    sys.exit('ERROR: failed to open connection to socket for target '\
-                             '"%s": %s.' % (target, e))
+                    return target, self.connect_agent(target, test), None
+                except Exception as e:
+                    return target, None, e
+
+            timedOut = []
+            failed = []
+            with ThreadPoolExecutor(max_workers=min(PREP_WORKERS, len(targets))) as pool:
+                for target, sock, error in pool.map(prep, targets):
+                    if error is None:
+                        # Good to go.
+                        self.sockets[target] = sock
+                        if verbose:
+                            print('\t\t\t"%s": success!' % target)
+                    elif isinstance(error, socket.timeout):
+                        timedOut.append((target, error))
+                    else:
+                        failed.append((target, error))
+
+            for target, error in timedOut:
+                print('ERROR: a socket timeout occurred for target "%s": %s.' % (target, error))
+                self.handle_timeout(target, test, self)
+
+            if failed:
+                for target, error in failed:
+                    print('ERROR: failed to prepare target "%s": %s.' % (target, error),
+                          file=sys.stderr)
+                for sock in self.sockets.values():
+                    sock.close()
+                self.sockets.clear()
+                sys.exit('ERROR: %d of %d agent(s) could not be prepared. Terminating.'
+                         % (len(failed), len(targets)))
 
         if verbose:
             print('\t\t...finished.\n')
 
+    #
+    # Connect to a single agent and send it its specifications. Runs on a
+    # worker thread, so errors are raised rather than exiting.
+    #
+    # Params:
+    #     target Host name or address of the agent.
+    #     test TestConfig to send.
+    #
+    # Return:
+    #     Connected socket, ready for the start message.
+    #
+    def connect_agent(self, target, test):
+        if verbose:
+            print('\t\t\tTrying "%s"...' % target)
+        port = AGENT_LISTEN_PORT
+        sock = socket.create_connection((target, port), timeout=SOCKET_TIMEOUT)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            version = negotiate_version(sock, target)
+            self.versions[target] = version
+
+            # Send the specifications all at once; the agent acknowledges
+            # them as a whole when it gets the ready message.
+            messages = ['name' + SOCKET_DELIMITER + target]
+            # Ask the agent to keep the connection open between runs.
+            if self.session:
+                messages.append('session' + SOCKET_DELIMITER + '1')
+            # Ask the agent to extract Vdbench results, if it can.
+            if self.extractResults and version >= RESULTS_VERSION:
+                messages.append('extract' + SOCKET_DELIMITER + '1')
+            # Commands and timeouts.
+            for command in test.specs[target]:
+                messages.append('command' + SOCKET_DELIMITER + command)
+                messages.append('timeout' + SOCKET_DELIMITER
+                                + str(test.timeouts[target][command]))
+            # End of commands/timeouts.
+            messages.append(READY_STRING)
+            sock.sendall(b''.join(frame(m) for m in messages))
+
+            tokens = recv_message(sock).split(SOCKET_DELIMITER)
+            if tokens[0] == ERROR_STRING:
+                raise AgentError('agent %s rejected its specifications: %s'
+                                 % (target, ' '.join(tokens[1:])))
+            elif tokens[0] != READY_STRING:
+                raise AgentError('agent %s failed to acknowledge ready' % target)
+        except:
+            sock.close()
+            raise
+
+        return sock
+
     #
     # Start remote agents.
     #
+    #
+    # Rather than starting agents one after another as the start messages go
+    # out, each agent is told to start at the same moment, converted to its
+    # own clock: the scheduler first estimates every agent's clock offset,
+    # then picks a start time far enough ahead for all the messages to
+    # arrive. Agents report when they actually started, and the spread of
+    # those times is reported with the results as the start skew. Agents
+    # whose clocks couldn't be read are just sent the start message.
+    #
     def start_agents(self, test):
         if verbose:
             print('\t\tStarting agents...')
 
+        clocks = self.sync_clocks(list(self.sockets.keys()))
+        lead = START_LEAD_MIN + START_LEAD_PER_AGENT * len(self.sockets)
+        if clocks:
+            lead = max(lead, 2 * max(rtt for offset, rtt in clocks.values()))
+        test.scheduledStart = time.time() + lead
+
+        now = time.monotonic()
         for target in list(self.sockets.keys()):
-            sock = self.sockets[target]
-            
-            # Start a ListenThread to wait for results.
-            listener = ListenThread(target, sock, test.listenerTimeouts[target],
-                                    self, test)
+            # Create an AgentListener to wait for results. All of them are
+            # serviced by the event loop in wait_for_results, which reads
+            # anything the agents send in the meantime from the socket buffers.
+            listener = AgentListener(target, self.sockets[target],
+                                     test.listenerTimeouts[target], self, test)
+            if target in clocks:
+                listener.clockOffset = clocks[target][0]
             self.listeners[target] = listener
-            listener.start()
+            listener.start(now)
 
-        # This is split into two loops to make sure all listener threads are started
-        # before any individual test is allowed to begin. This prevents race conditions
-        # with processes completing and rejoining while some listeners aren't started.
         for target in list(self.sockets.keys()):
             # Send the start command.
-            self.sockets[target].sendall(bytes(START_STRING + '\n', 'UTF-8'))
+            if target in clocks:
+                message = (START_AT_STRING + SOCKET_DELIMITER
+                           + repr(test.scheduledStart + clocks[target][0]))
+            else:
+                message = START_STRING
+            send_message(self.sockets[target], message)
 
         if verbose:
             print('\t\t...finished.\n')
 
     #
-    # Start remote agents.
+    # Estimate the clock offsets of the given targets concurrently.
+    #
+    # Return:
+    #     Dictionary mapping each target whose clock could be read to a
+    #     tuple of its offset (agent clock minus ours, in seconds) and the
+    #     round trip time of the sample it was taken from.
+    #
+    def sync_clocks(self, targets):
+        def sync(target):
+            try:
+                return target, self.sync_clock(self.sockets[target]), None
+            except Exception as e:
+                return target, None, e
+
+        clocks = {}
+        if not targets:
+            return clocks
+        with ThreadPoolExecutor(max_workers=min(PREP_WORKERS, len(targets))) as pool:
+            for target, clock, error in pool.map(sync, targets):
+                if error is None:
+                    clocks[target] = clock
+                else:
+                    print('\t\t\t-- NOTICE: unable to read the clock of %s (%s). '\
+                          'Starting it without synchronization.' % (target, error))
+        return clocks
+
+    #
+    # Estimate a single agent's clock offset. The agent's reply to a time
+    # request is assumed to have been taken halfway through the round trip,
+    # so the sample with the shortest round trip has the smallest error.
+    #
+    # Return:
+    #     Tuple of the offset (agent clock minus ours, in seconds) and the
+    #     round trip time of the best sample.
+    #
+    def sync_clock(self, sock):
+        best = None
+        for i in range(CLOCK_SAMPLES):
+            sent = time.time()
+            send_message(sock, TIME_STRING)
+            tokens = recv_message(sock).split(SOCKET_DELIMITER)
+            received = time.time()
+            if len(tokens) != 2 or tokens[0] != TIME_STRING:
+                raise AgentError('unexpected reply to time request: "%s"'
+                                 % SOCKET_DELIMITER.join(tokens))
+            rtt = received - sent
+            offset = float(tokens[1]) - (sent + received) / 2
+            if best is None or rtt < best[1]:
+                best = (offset, rtt)
+        return best
+
+    #
+    # Wait for remote agent results. A single event loop multiplexes every
+    # agent socket, and timeouts, ping deadlines and post-kill drains are
+    # kept in a heap of timers, so the loop only wakes up when there is
+    # something to do.
     #
     def wait_for_results(self, test):
         if verbose:
@@ -411,23 +584,93 @@ class NetJobs:
         print()
         print('\t\t-- %s // RESULTS:' % test.label)
 
-        # Listener threads print results here before joining.
+        # Listeners print results here as they arrive.
 
-        for listener in self.listeners.values():
-            listener.join()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.wakeupRecv, selectors.EVENT_READ, None)
+            for listener in self.listeners.values():
+                if listener.running:
+                    selector.register(listener.sock, selectors.EVENT_READ, listener)
+                else:
+                    listener.finish()
+
+            active = set(l for l in self.listeners.values() if l.running)
+            while active:
+                timeout = None
+                if self.timers:
+                    timeout = max(self.timers[0][0] - time.monotonic(), 0)
+
+                for key, events in selector.select(timeout):
+                    if key.data is None:
+                        self.drain_wakeup()
+                    else:
+                        key.data.on_readable()
+
+                if self.killRequested:
+                    self.killRequested = False
+                    for listener in active:
+                        listener.kill()
+
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    deadline, count, listener = heapq.heappop(self.timers)
+                    listener.check_timers(now)
+
+                # Retire listeners that have stopped.
+                for listener in [l for l in active if not l.running]:
+                    active.discard(listener)
+                    selector.unregister(listener.sock)
+                    listener.finish()
+
+        self.timers = []
+
+        # Report how closely the agents' start times lined up.
+        if test.startTimes:
+            times = list(test.startTimes.values())
+            test.startSkew = max(times) - min(times)
+            print('\t\t-- %s // START SKEW: %.1f ms across %d agent(s); last start %.1f ms '\
+                  'after the scheduled time.' % (test.label, test.startSkew * 1000, len(times),
+                  (max(times) - test.scheduledStart) * 1000))
 
         if verbose:
             print('\t\t...finished.\n')
-    
+
+    #
+    # Add a timer for listener at the given deadline (time.monotonic()). When
+    # it expires, the event loop calls listener.check_timers.
+    #
+    def schedule(self, listener, deadline):
+        heapq.heappush(self.timers, (deadline, next(self.timerCount), listener))
+
+    #
+    # Empty the wakeup socket.
+    #
+    def drain_wakeup(self):
+        try:
+            while self.wakeupRecv.recv(BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
     #
     # Clean up after test.
     #
     def clean_up(self, test):
         if verbose:
             print('\t\tCleaning up...')
-            
-        for sock in list(self.sockets.values()):
+
+        for target, sock in list(self.sockets.items()):
+            # In session mode, keep connections to agents that finished
+            # cleanly. Anything else may still have data in flight, so start
+            # over with a new connection next time.
+            listener = self.listeners.get(target)
+            if self.session and listener is not None and listener.done:
+                continue
             sock.close()
+            del self.sockets[target]
+
+        if self.session:
+            self.sessions[test.label] = self.sockets
 
         if verbose:
             print('\t\t...finished.\n')
@@ -454,11 +697,16 @@ class NetJobs:
                     test.timeoutsRemaining -= 1
 
     #
-    # Cause all ListenThreads to rejoin.
+    # Send the kill command to every agent and stop waiting for results. Safe
+    # to call from any thread: the kill itself happens on the event loop.
     #
     def stop_and_kill_listeners(self):
-        for listener in self.listeners.values():
-            listener.kill()
+        self.killRequested = True
+        try:
+            self.wakeupSend.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The loop already has a wakeup pending.
+            pass
 
     #
     # Write results to log file.
@@ -482,6 +730,20 @@ class NetJobs:
         except IOError as e:
             print('Error writing log file %s: %s.' % (path_out, str(e)))
 
+    #
+    # End session mode: tell every connected agent to close its session and
+    # close the connections.
+    #
+    def close(self):
+        for sockets in self.sessions.values():
+            for sock in sockets.values():
+                try:
+                    send_message(sock, CLOSE_STRING)
+                except socket.error:
+                    pass
+                sock.close()
+        self.sessions = {}
+
     #
     # Ping agents with a status request.
     #
@@ -500,9 +762,12 @@ class NetJobs:
 
         for test in self.tests:
             # Reset instance variables.
-            self.sockets = {}
+            self.sockets = self.sessions.get(test.label, {}) if self.session else {}
             self.listeners = {}
             self.testAborted = False
+            self.killRequested = False
+            self.drain_wakeup()
+            test.reset()
                     
             if verbose:
                 print('\t%s...' % test.label)
@@ -523,6 +788,40 @@ class NetJobs:
         if verbose:
             print('\nFinishing...\n')
 
+# ############################################################################ #
+# FrameBuffer class for reassembling messages from a stream.                   #
+# ############################################################################ #
+class FrameBuffer:
+    "collects received bytes and splits them into complete messages"
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    #
+    # Add received bytes.
+    #
+    # Return:
+    #     List of the messages completed by them, in order.
+    #
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(self.buffer[FRAME_HEADER.size:end].decode('UTF-8'))
+            del self.buffer[:end]
+        return messages
+
+# ############################################################################ #
+# AgentError class for agents that misbehave during preparation.               #
+# ############################################################################ #
+class AgentError(Exception):
+    "raised when an agent gives an unexpected response"
+    pass
+
 # ############################################################################ #
 # TestConfig class for storing test configurations.                            #
 # ############################################################################ #
@@ -536,22 +835,12 @@ class TestConfig:
         self.minHosts = minHosts
         self.specs = specs
         self.timeouts = timeouts
-        self.results = {}
-        if minHosts == 0:
-            self.timeoutsRemaining = None
-        else:
-            self.timeoutsRemaining = minHosts
-        
-        # Setting up dictionaries.
+
+        # Timeouts for the AgentListeners.
         self.listenerTimeouts = {}
         for target in specs.keys():
-            # Results dictionary.
-            self.results[target] = {}
-            # Timeouts for the ListenThreads.
             timeout = generalTimeout
             for command in specs[target]:
-                # Initialize results contents.
-                self.results[target][command] = None
                 # Calculate longest timeout - use for thread.
                 if timeouts[target][command] == TIMEOUT_NONE:
                     timeout = TIMEOUT_NONE
@@ -562,58 +851,131 @@ class TestConfig:
                         timeout = t
             self.listenerTimeouts[target] = timeout
 
-            self.successesReceived = 0
+        self.reset()
+
+    #
+    # Clear results and counters before a run.
+    #
+    def reset(self):
+        self.results = {}
+        for target in self.specs.keys():
+            self.results[target] = {}
+            for command in self.specs[target]:
+                self.results[target][command] = None
+        if self.minHosts == 0:
+            self.timeoutsRemaining = None
+        else:
+            self.timeoutsRemaining = self.minHosts
+        self.successesReceived = 0
+
+        # Synchronized start: the time all agents were told to start, when
+        # each actually started (both on our clock), and the difference
+        # between the earliest and latest start, in seconds.
+        self.scheduledStart = None
+        self.startTimes = {}
+        self.startSkew = None
+
+        # Latest interval metrics reported by each agent, by target, then
+        # command.
+        self.metrics = {}
+
+        # Vdbench results extracted by each agent, by target, then command.
+        # Each is a dictionary with the output directory ('output'), the
+        # flatfile summary row keyed by column name ('row'), and the
+        # histogram as [min, max, count] buckets with max None for the last,
+        # open-ended bucket ('histogram', None if unavailable).
+        self.records = {}
 
         # Used for log file.
         self.timestamp = datetime.datetime.now().isoformat()
 
+    #
+    # Fleet-wide view of the latest interval metrics: total i/o rate, MB/sec
+    # and queue depth, and the response time averaged over every I/O (i.e.
+    # weighted by rate). Returns None if no metrics have arrived yet.
+    #
+    def fleet_metrics(self):
+        latest = [m for commands in list(self.metrics.values())
+                  for m in list(commands.values())]
+        if not latest:
+            return None
+        rate = sum(m['rate'] for m in latest)
+        if rate > 0:
+            resp = sum(m['rate'] * m['resp'] for m in latest) / rate
+        else:
+            resp = sum(m['resp'] for m in latest) / len(latest)
+        return {'agents': len(self.metrics), 'rate': rate,
+                'MB/sec': sum(m['MB/sec'] for m in latest), 'resp': resp,
+                'queue_depth': sum(m['queue_depth'] for m in latest)}
+
 # ############################################################################ #
-# ListenThread class for listening for test results.                           #
+# AgentListener class for listening for test results.                          #
 # ############################################################################ #
-class ListenThread(threading.Thread):
-    "listens for test results for a given agent"
+class AgentListener:
+    "listens for test results for a given agent, driven by the NetJobs event loop"
 
     def __init__(self, target, sock, timeout, netJobs, test):
-        threading.Thread.__init__(self)
         self.target = target
         self.sock = sock
         self.timeout = timeout
         self.netJobs = netJobs
         self.test = test
         self.running = False
+        self.deadline = None
         self.pingActive = False
-        self.pingStart = None
-
-    def run(self):
+        self.pingDeadline = None
+        # Set once the agent reports all jobs complete, i.e. the connection is
+        # idle and can be reused in session mode.
+        self.done = False
+        # In session mode, a killed listener keeps reading until the agent
+        # finishes (or this time passes), so the connection stays usable.
+        self.killDeadline = None
+        # Reassembles messages from the stream.
+        self.frames = FrameBuffer()
+        # Protocol version agreed with the agent.
+        self.version = netJobs.versions.get(target, MIN_PROTOCOL_VERSION)
+        # Agent clock minus ours, if known.
+        self.clockOffset = None
+
+    def start(self, now):
         self.running = True
-        startTime = time.time()
+        if not self.timeout == TIMEOUT_NONE:
+            self.deadline = now + self.timeout
+            self.netJobs.schedule(self, self.deadline)
+
+    # Called by the event loop when the socket has data.
+    def on_readable(self):
         try:
-            while self.running:
-                currentTime = time.time()
-                elapsedTime = currentTime - startTime
-                # Check for timeout.
-                if not self.timeout == TIMEOUT_NONE and elapsedTime >= self.timeout:
-                    self.handle_timeout()
-                # Check for ping timeout.
-                elif self.pingActive and currentTime - self.pingStart >= SOCKET_TIMEOUT:
-                    self.handle_timeout()
-                else:
-                    # Wait for result to be transmitted from agent.
-                    ready = select.select([self.sock], [], [], SELECT_TIMEOUT)
-                    if ready[0]:
-                        buff = self.sock.recv(BUFFER_SIZE)
-
-                        if buff:
-                            # In case multiple commands were in the buffer, split them up before
-                            # sending to process_result_string. Filter empty strings.
-                            commands = filter(None, buff.decode('UTF-8').split('\n'))
-                            for command in commands:
-                                self.process_result_string(command)
-                            
+            buff = self.sock.recv(BUFFER_SIZE)
+
+            if not buff:
+                # Connection closed by the agent.
+                self.running = False
+                return
+
+            for message in self.frames.feed(buff):
+                self.process_result_string(message)
         except Exception as e:
-            print('\t\t\t\t-- NOTICE: while waiting for %s, the following exception occurred: %s.' 
+            print('\t\t\t\t-- NOTICE: while waiting for %s, the following exception occurred: %s.'
                 % (self.target, str(e)))
+            self.running = False
 
+    # Called by the event loop when one of this listener's timers expires.
+    def check_timers(self, now):
+        if not self.running:
+            return
+        # Check for the end of a post-kill drain.
+        if self.killDeadline is not None and now >= self.killDeadline:
+            self.running = False
+        # Check for timeout.
+        elif self.deadline is not None and now >= self.deadline:
+            self.handle_timeout()
+        # Check for ping timeout.
+        elif self.pingActive and now >= self.pingDeadline:
+            self.handle_timeout()
+
+    # Called by the event loop once the listener has stopped.
+    def finish(self):
         self.update_incomplete_and_print(TIMEOUT_STATUS)
 
     def handle_timeout(self):
@@ -624,25 +986,46 @@ class ListenThread(threading.Thread):
             self.netJobs.handle_timeout(self.target, self.test, self.netJobs)
 
     def kill(self):
-        if self.running:
-            self.running = False
+        if self.running and self.killDeadline is None:
+            if self.netJobs.session:
+                self.killDeadline = time.monotonic() + SOCKET_TIMEOUT
+                self.netJobs.schedule(self, self.killDeadline)
+            else:
+                self.running = False
             if verbose:
                 print('\t\t\t\t-- %s was sent remote kill command.' % self.target)
             try:
-                self.sock.sendall(bytes(KILL_STRING + '\n', 'UTF-8'))
+                send_message(self.sock, KILL_STRING)
             except:
-                pass
+                self.running = False
 
     def process_result_string(self, message):
-        tokens = message.split(SOCKET_DELIMITER)
+        # The output, the last field of a result, may itself contain tabs.
+        tokens = message.split(SOCKET_DELIMITER, 3)
         count = len(tokens)
 
         if DONE_STRING == message:
-            self.running = False
+            self.done = True
+            # In session mode, wait for the answer to any outstanding ping, so
+            # it isn't left on the connection for the next run.
+            if not (self.netJobs.session and self.pingActive):
+                self.running = False
             if verbose:
                 print('\t\t\t\t-- %s reported all jobs complete.' % self.target)
         elif PING_OK_STRING == message:
             self.pingActive = False
+            if self.done:
+                self.running = False
+        elif tokens[0] == METRICS_STRING:
+            self.process_metrics(message)
+        elif tokens[0] == RESULTS_STRING:
+            self.process_record(message)
+        elif tokens[0] == STARTED_STRING:
+            if count > 1 and self.clockOffset is not None:
+                try:
+                    self.test.startTimes[self.target] = float(tokens[1]) - self.clockOffset
+                except ValueError:
+                    print('\t\t\t\t-- %s sent an invalid start time: %s' % (self.target, message))
         else:
             if count < 4:
                 # Messages sent here should always have 4 tokens each, even if some
@@ -667,6 +1050,57 @@ class ListenThread(threading.Thread):
                 if self.test.successesReceived >= self.test.minHosts:
                     self.netJobs.ping_agent_status()
 
+    #
+    # Store the figures from a metrics message and pass them on to the
+    # metrics callback, if any. From protocol version 5, the metrics also
+    # have the name of the Vdbench run definition ('Run').
+    #
+    def process_metrics(self, message):
+        count = len(METRICS_FIELDS)
+        if self.version >= METRICS_RUN_VERSION:
+            count += 1
+        tokens = message.split(SOCKET_DELIMITER, count + 1)
+        if len(tokens) < count + 2:
+            print('\t\t\t\t-- %s sent an invalid metrics string: %s' % (self.target, message))
+            return
+        command = tokens[-1]
+        try:
+            metrics = dict(zip(METRICS_FIELDS,
+                               (float(t) for t in tokens[1:len(METRICS_FIELDS) + 1])))
+        except ValueError:
+            print('\t\t\t\t-- %s sent an invalid metrics string: %s' % (self.target, message))
+            return
+        metrics['Interval'] = int(metrics['Interval'])
+        if self.version >= METRICS_RUN_VERSION:
+            metrics['Run'] = tokens[-2]
+
+        self.test.metrics.setdefault(self.target, {})[command] = metrics
+        if verbose:
+            print('\t\t\t\t-- %s interval %d: %.2f IO/s, %.2f MB/s, %.3f ms, queue depth %.1f.'
+                  % (self.target, metrics['Interval'], metrics['rate'], metrics['MB/sec'],
+                     metrics['resp'], metrics['queue_depth']))
+        if self.netJobs.metricsCallback is not None:
+            try:
+                self.netJobs.metricsCallback(self.target, command, metrics)
+            except Exception as e:
+                print('\t\t\t\t-- NOTICE: the metrics callback raised an exception: %s.'
+                      % str(e))
+
+    #
+    # Store the Vdbench results from a results message.
+    #
+    def process_record(self, message):
+        tokens = message.split(SOCKET_DELIMITER, 2)
+        try:
+            record = json.loads(tokens[1])
+            command = tokens[2]
+        except (IndexError, ValueError):
+            print('\t\t\t\t-- %s sent an invalid results string.' % self.target)
+            return
+        self.test.records.setdefault(self.target, {})[command] = record
+        if verbose:
+            print('\t\t\t\t-- %s sent results from %s.' % (self.target, record.get('output')))
+
     def update_incomplete_and_print(self, message):
         for command in self.test.specs[self.target]:
             if not command in self.test.results[self.target]:
@@ -678,11 +1112,13 @@ class ListenThread(threading.Thread):
     def ping_status_check(self):
         if self.running and not self.pingActive:
             try:
-                self.sock.sendall(bytes(PING_STATUS_STRING + '\n', 'UTF-8'))
+                send_message(self.sock, PING_STATUS_STRING)
             except Exception as e:
-                self.handle_timeout
-            self.pingStart = time.time()
+                self.handle_timeout()
+                return
+            self.pingDeadline = time.monotonic() + SOCKET_TIMEOUT
             self.pingActive = True
+            self.netJobs.schedule(self, self.pingDeadline)
         
 
 # ############################################################################ #
@@ -697,6 +1133,111 @@ def ask_for_path():
     
     return input('Please enter the configuration file path: ')
 
+#
+# Agree on a protocol version with a newly connected agent.
+#
+# Params:
+#     sock Socket connected to the agent.
+#     target Host name of the agent, for error messages.
+#
+# Return:
+#     Protocol version to use.
+#
+def negotiate_version(sock, target):
+    "agree on a protocol version"
+
+    send_message(sock, HELLO_STRING + SOCKET_DELIMITER + str(PROTOCOL_VERSION))
+    tokens = recv_message(sock).split(SOCKET_DELIMITER)
+    if tokens[0] == ERROR_STRING:
+        raise AgentError('agent %s refused protocol version %d: %s'
+                         % (target, PROTOCOL_VERSION, ' '.join(tokens[1:])))
+    try:
+        version = int(tokens[1]) if tokens[0] == HELLO_STRING else None
+    except (IndexError, ValueError):
+        version = None
+    if version is None or not MIN_PROTOCOL_VERSION <= version <= PROTOCOL_VERSION:
+        raise AgentError('agent %s did not negotiate a supported protocol version. '\
+                         'Check that it runs the same version of NetJobs' % target)
+    return version
+
+#
+# Check on an agent without disturbing anything it is running. Agents serve
+# each connection separately, so this works while tests are in progress,
+# including tests started by other schedulers.
+#
+# Params:
+#     target Host name or IP address of the agent.
+#     timeout Seconds to wait for the connection and the answer.
+#
+# Return:
+#     Dictionary with the number of sessions set up on the agent, the number
+#     of commands they are running, and the agent's one-minute load average
+#     (None if unavailable).
+#
+def probe_agent(target, timeout=SOCKET_TIMEOUT):
+    "ask an agent for its status"
+
+    with socket.create_connection((target, AGENT_LISTEN_PORT), timeout=timeout) as sock:
+        if negotiate_version(sock, target) < PROBE_VERSION:
+            raise AgentError('agent %s is too old to answer probes' % target)
+        send_message(sock, PROBE_STRING)
+        tokens = recv_message(sock).split(SOCKET_DELIMITER)
+    try:
+        if tokens[0] != PROBE_STRING:
+            raise ValueError(tokens[0])
+        return {'sessions': int(tokens[1]), 'processes': int(tokens[2]),
+                'load': float(tokens[3]) if tokens[3] else None}
+    except (IndexError, ValueError):
+        raise AgentError('agent %s sent an invalid probe answer: %s'
+                         % (target, SOCKET_DELIMITER.join(tokens)))
+
+#
+# Encode a message as a frame.
+#
+def frame(message):
+    "encode a message as a frame"
+
+    payload = message.encode('UTF-8')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+#
+# Send one message as a frame.
+#
+def send_message(sock, message):
+    "send one message"
+
+    sock.sendall(frame(message))
+
+#
+# Receive one message, blocking until all of it has arrived. Only for
+# exchanges where nothing else can arrive until it is answered.
+#
+# Params:
+#     sock Socket to read from.
+#
+# Return:
+#     Message string.
+#
+def recv_message(sock):
+    "receive one message"
+
+    (length,) = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    return recv_exact(sock, length).decode('UTF-8')
+
+#
+# Receive exactly count bytes from a socket.
+#
+def recv_exact(sock, count):
+    "receive an exact number of bytes"
+
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(min(count - len(data), 1 << 20))
+        if not chunk:
+            raise AgentError('connection closed')
+        data += chunk
+    return bytes(data)
+
 #
 # Evaluate timeout string.
 #
@@ -3,20 +3,22 @@
 # ############################################################################ #
 # NetJobsAgent - agent server for the NetJobs job synchronizer.                #
 #                                                                              #
-# Copyright (c) 2015 DeepStorage, LLC (deepstorage.net)                        # 
+# Copyright (c) 2015 DeepStorage, LLC (deepstorage.net)                        #
 #     and Ramon A. Lovato (ramonalovato.com).                                  #
 #                                                                              #
 # See the file LICENSE for copying permission.                                 #
 #                                                                              #
 # Author: Ramon A. Lovato (ramonalovato.com)                                   #
 # For: Deepstorage, LLC (deepstorage.net)                                      #
-# Version: 2.3                                                                 #
+# Version: 3.6                                                                 #
 #                                                                              #
 # Usage: NetJobsAgent.py                                                       #
 #                                                                              #
 # Example: $ NetJobsAgent.py                                                   #
 # ############################################################################ #
 
+import re
+import json
 import socket
 import select
 import subprocess
@@ -24,78 +26,168 @@ import signal
 import threading
 import os
 import time
+import struct
+import tempfile
 
+from collections import deque
 from subprocess import PIPE
 
 # Must match the scheduler constants of the same names, for obvious reasons.
 AGENT_LISTEN_PORT = 16192
 BUFFER_SIZE = 4096
-SELECT_TIMEOUT = 1
 SOCKET_TIMEOUT = 60
 TIMEOUT_NONE = 0
 SOCKET_DELIMITER = '\t'
 CONNECTION_CLOSE_DELAY = 3
+# Connections waiting to be accepted. Each accepted connection is served by
+# its own thread, so this only has to cover bursts, such as a scheduler
+# preparing many agents at once.
+LISTEN_BACKLOG = 128
+# Command output. Each of a command's output streams is kept in memory up to
+# OUTPUT_LIMIT bytes; beyond that, the whole stream is written to a file in
+# OUTPUT_SPILL_DIR and only its last OUTPUT_LIMIT bytes are kept and sent
+# with the result. Output is read in lines of at most OUTPUT_LINE_LIMIT.
+# Finished spill files are kept for inspection up to OUTPUT_SPILL_RETAIN
+# bytes in all; beyond that, the oldest are deleted as commands finish.
+OUTPUT_LIMIT = 65536
+OUTPUT_LINE_LIMIT = 65536
+OUTPUT_SPILL_DIR = os.path.join(tempfile.gettempdir(), 'netjobs')
+OUTPUT_SPILL_SUFFIX = '.log'
+OUTPUT_SPILL_RETAIN = 1024 ** 3
+# Wire protocol. Every message is a frame: its length in bytes as an unsigned
+# 64-bit big-endian integer, followed by that many bytes of UTF-8 text. The
+# first exchange on a connection is a HELLO carrying the highest protocol
+# version each side speaks; both then use the lower of the two. Version 2
+# adds the metrics message, version 3 the probe message, version 4 the
+# results message, and version 5 the run name in the metrics message.
+FRAME_HEADER = struct.Struct('!Q')
+PROTOCOL_VERSION = 5
+MIN_PROTOCOL_VERSION = 1
+HELLO_STRING = '// HELLO //'
+ERROR_STRING = '// ERROR //'
 READY_STRING = '// READY //'
 START_STRING = '// START //'
+START_AT_STRING = '// START AT //'
+STARTED_STRING = '// STARTED //'
+TIME_STRING = '// TIME //'
 KILL_STRING = '// KILL //'
 DONE_STRING = '// DONE //'
 PING_STATUS_STRING = '// STATUS //'
+CLOSE_STRING = '// CLOSE //'
+METRICS_STRING = '// METRICS //'
+METRICS_VERSION = 2
+PROBE_STRING = '// PROBE //'
+PROBE_VERSION = 3
+RESULTS_STRING = '// RESULTS //'
+RESULTS_VERSION = 4
+METRICS_RUN_VERSION = 5
 PING_OK_STRING = 'OK'
 SUCCESS_STATUS = 'SUCCESS'
 ERROR_STATUS = 'ERROR'
 TIMEOUT_STATUS = 'TIMEOUT'
 KILLED_STATUS = 'KILLED'
+# Vdbench interval lines, e.g.
+#   15:31:58.075     1   770.00   3.01    4096  70.26   0.529 ...
+# give the time of day, the interval number, then i/o rate, MB/sec, bytes
+# per i/o, read pct, resp time, read resp, write resp, resp max, resp
+# stddev and queue depth, followed by cpu columns.
+INTERVAL_REGEX = re.compile(r'^\s*\d{2}:\d{2}:\d{2}\.\d+\s+(\d+)\s+'
+                            + r'\s+'.join([r'(\d+(?:\.\d+)?)'] * 10) + r'(?:\s|$)')
+# Vdbench announces each run definition (and each step of its for-loops,
+# whose interval numbers start over) with a line such as
+#   15:31:57.003 Starting RD=run1; I/O rate: 1000; elapsed=60; For loops: None
+# The runs it adds to format storage are named "format_for_<sd>"; they aren't
+# measurements, so their intervals are not sent.
+RUN_REGEX = re.compile(r'Starting RD=([^;\s]+)')
+FORMAT_RUN_PREFIX = 'format'
+# Result extraction. Vdbench echoes each of its arguments as it starts, e.g.
+#   15:31:54.411 input argument scanned: '-o/mnt/share/output/vdb1'
+# which gives its output directory. After the command exits, the summary row
+# of flatfile.html there and the last "Reads and writes:" section of
+# histogram.html (rows "min < max count ...") can be sent to the scheduler.
+ARGUMENT_REGEX = re.compile(r"input argument scanned: '(.*)'")
+FLATFILE_NAME = 'flatfile.html'
+# Bytes read at a time when reading flatfile.html backwards from the end.
+FLATFILE_BLOCK_SIZE = 4096
+HISTOGRAM_NAME = 'histogram.html'
+HISTOGRAM_SECTION = 'Reads and writes:'
+HISTOGRAM_SECTIONS = ('Reads and writes:', 'Reads:', 'Writes:')
+BUCKET_REGEX = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*<\s*(\d+(?:\.\d+)?|max)\s+([\d,]+)\s')
 
-# Used to track the number of active subprocesses.
-processcount = 0
+# Sessions that have finished setup, for probes.
+activeSessions = set()
+activeSessionsLock = threading.Lock()
+
+# Spill files still being written, which are never deleted.
+openSpillFiles = set()
+openSpillFilesLock = threading.Lock()
 
 #
-# Get run specifications from remote process.
+# Get run specifications from remote process. A connection that asks for a
+# probe instead is answered and left unready.
 #
 # Params:
-#     conn Socket connection to remote process.
+#     session AgentSession for the connection.
 #
 # Return:
 #     List of command strings.
 #     List of timeouts.
 #
-def get_specs(conn):
-    global name
-    global ready
-    global sosTimeout
-
-    sosTimeout = TIMEOUT_NONE
+def get_specs(session):
+    conn = session.sock
 
     commands = []
     timeouts = []
 
-    receiveBuffer = ''
+    # Agree on a protocol version.
+    try:
+        tokens = recv_message(conn).split(SOCKET_DELIMITER)
+        if len(tokens) < 2 or tokens[0] != HELLO_STRING:
+            raise ValueError('expected protocol negotiation, but received "%s"'
+                             % SOCKET_DELIMITER.join(tokens))
+        version = min(int(tokens[1]), PROTOCOL_VERSION)
+        if version < MIN_PROTOCOL_VERSION:
+            send_message(conn, ERROR_STRING + SOCKET_DELIMITER
+                         + 'unsupported protocol version %s' % tokens[1])
+            raise ValueError('unsupported protocol version %s' % tokens[1])
+        send_message(conn, HELLO_STRING + SOCKET_DELIMITER + str(version))
+        session.protocol = version
+        print('\tUsing protocol version %d.' % version)
+    except Exception as e:
+        print("ERROR: protocol negotiation failed: %s" % str(e))
+        return commands, timeouts
 
-    while not ready:
+    while not session.ready:
         try:
-            # Since the client waits for each setup string to be echoed before
-            # sending the next one, we don't need to lexify the string on newlines
-            # the way we do later when listening to the socket asynchronously.
-            receiveBuffer = conn.recv(BUFFER_SIZE)
-            conn.sendall(receiveBuffer) # Echo test.
-            receiveString = receiveBuffer.decode('UTF-8').replace('\n', '')
+            receiveString = recv_message(conn)
         except Exception as e:
             print("ERROR: an exception occurred while trying to receive specs: %s" % str(e))
             break
 
         print('\tReceived: "%s".' % receiveString)
 
+        error = None
         if receiveString == READY_STRING:
-            ready = True
+            session.ready = True
             print('\t\t--> Ready string received. Awaiting start message.')
+            send_message(conn, READY_STRING)
+        elif receiveString == PROBE_STRING and session.protocol >= PROBE_VERSION:
+            print('\t\t--> Probe received.')
+            send_message(conn, probe_status())
+            break
         else:
-            tokens = receiveString.replace('\n', '').split(SOCKET_DELIMITER)
+            tokens = receiveString.split(SOCKET_DELIMITER, 1)
             if len(tokens) < 2:
-                print('\t\t--> WARNING: invalid message received -- insufficient number of tokens.')
-                break
+                error = 'invalid message received -- insufficient number of tokens'
             elif tokens[0] == 'name':
-                name = tokens[1]
+                session.name = tokens[1]
                 print('\t\t--> Registering name: %s.' % tokens[1])
+            elif tokens[0] == 'session':
+                session.sessionMode = tokens[1] == '1'
+                print('\t\t--> Session mode: %s.' % ('on' if session.sessionMode else 'off'))
+            elif tokens[0] == 'extract' and session.protocol >= RESULTS_VERSION:
+                session.extract = tokens[1] == '1'
+                print('\t\t--> Result extraction: %s.' % ('on' if session.extract else 'off'))
             elif tokens[0] == 'command':
                 command = tokens[1]
                 commands.append(command)
@@ -110,133 +202,243 @@ def get_specs(conn):
                         timeouts.append(timeout)
                         print('\t\t--> Registering timeout: %d second(s).' % timeout)
                         # Check if sosTimeout needs to be updated.
-                        if not sosTimeout == TIMEOUT_NONE and timeout > sosTimeout:
-                            sosTimeout = timeout
+                        if not session.sosTimeout == TIMEOUT_NONE and timeout > session.sosTimeout:
+                            session.sosTimeout = timeout
                 except ValueError as e:
-                    print('ERROR: invalid timeout.')
-                    break
+                    error = 'invalid timeout'
             else:
-                print('\t\t--> WARNING: unknown message received. Breaking.')
-                break
+                error = 'unknown message received'
+
+        if error is not None:
+            print('\t\t--> ERROR: %s.' % error)
+            try:
+                send_message(conn, ERROR_STRING + SOCKET_DELIMITER + error)
+            except Exception:
+                pass
+            break
 
     print() # Blank line.
 
     return commands, timeouts
 
+#
+# Build the answer to a probe: the number of sessions set up on this agent,
+# the number of commands they are running, and the one-minute load average
+# (empty where the platform doesn't provide it).
+#
+def probe_status():
+    with activeSessionsLock:
+        sessions = list(activeSessions)
+    running = sum(s.processcount for s in sessions)
+    try:
+        load = '%.2f' % os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = ''
+    return SOCKET_DELIMITER.join([PROBE_STRING, str(len(sessions)), str(running), load])
+
 #
 # Execute the main run.
 #
 # Params:
-#     sock Socket on which we're with communicating client.
-#     commands List of commands to execute.
-#     timeouts List of timeouts for each command.
+#     session AgentSession to run the commands of.
 #
 # Returns:
-#     List of subprocess threads.
+#     Time the run started (time.time()).
 #
-def start_run(sock, commands, timeouts):
-    global subthreads
-    global processcount
+def start_run(session):
+    commands = session.commands
+    timeouts = session.timeouts
 
-    results = []
-    output = []
     # The lists should be the same length, but do a sanity check, just in case.
-    processcount = min(len(commands), len(timeouts))
+    count = min(len(commands), len(timeouts))
+    session.processcount = count
 
+    startTime = time.time()
     print('\n---RESULTS---\n')
 
-    for i in range(0, processcount):
+    for i in range(0, count):
         command = commands[i]
         timeout = timeouts[i]
 
         try:
-            proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # Run each command in its own process group (on POSIX), so a kill
+            # reaches everything the shell started, not just the shell.
+            proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    start_new_session=hasattr(os, 'killpg'))
         except Exception as e:
             print('\nERROR: an exception occurred while trying to spawn the subprocess thread for "%s": %s\n'\
                   % (command, str(e)))
-        thread = ProcThread(sock, command, timeout, proc)
-        subthreads.append(thread)
+        thread = ProcThread(session, command, timeout, proc)
+        session.subthreads.append(thread)
         thread.start()
 
+    return startTime
+
+#
+# Serve one scheduler connection, from setup until it closes.
+#
+# Params:
+#     session AgentSession for the connection.
+#
+def serve(session):
+    sock = session.sock
+
+    # Set the socket timeout.
+    sock.settimeout(SOCKET_TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Get the run specifications.
+    session.commands, session.timeouts = get_specs(session)
+    if not session.ready:
+        print('Setup did not complete for %s. Closing connection.\n' % (session.addr,))
+        sock.close()
+        return
+
+    with activeSessionsLock:
+        activeSessions.add(session)
+    try:
+        # One run per connection, or as many as the scheduler starts in
+        # session mode.
+        while True:
+            session.subthreads = []
+            session.results = {}
+            session.processcount = 0
+
+            # Spawn the SOSThread.
+            sosThread = SOSThread(session)
+
+            # Listen for go command.
+            sosThread.start()
+
+            # Block until sosThread has finished starting, or stopped without
+            # starting (the scheduler ended the session, or it failed).
+            sosThread.startedOrStopped.wait()
+
+            # Block until all subprocesses complete.
+            for t in session.subthreads:
+                t.join()
+
+            # Stop SOSThread
+            sosThread.stop()
+            sosThread.join()
+
+            if not sosThread.started:
+                if sosThread.closed:
+                    print('Session closed by remote client.')
+                break
+
+            try:
+                # Notify client to stop listener thread for this agent.
+                print('\nActive processes: %d. Notifying client.\n' % (session.processcount))
+                session.send(DONE_STRING)
+            except Exception as e:
+                print(str(e))
+                break
+
+            if not session.sessionMode or sosThread.closed:
+                for i in range(CONNECTION_CLOSE_DELAY):
+                    print('Closing connection in %d...' % (CONNECTION_CLOSE_DELAY-i))
+                    time.sleep(1)
+                break
+
+            print('Run complete. Session remains open; awaiting next start message.\n')
+    finally:
+        with activeSessionsLock:
+            activeSessions.discard(session)
+
+        # Close the connection.
+        try:
+            sock.close()
+        except Exception as e:
+            print(str(e))
+            pass
+        print('\nConnection from %s closed.\n' % (session.addr,))
+
 #
 # Main.
 #
+# Every connection is served by its own thread, so several schedulers (or
+# several tests from the same one) can use the agent at once, and probes are
+# answered while jobs are running.
+#
 def main():
     "main function"
 
-    global name
-    global ready
-    global results
-    global subthreads
-
     try:
         listenSock = socket.socket()
         listenPort = AGENT_LISTEN_PORT
+        # Allow a restarted agent to listen again right away, even while
+        # connections from the previous one are in TIME_WAIT.
+        listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         listenSock.bind(('', listenPort))
-        listenSock.listen(1) # Only allow single connection.
+        listenSock.listen(LISTEN_BACKLOG)
     except OSError as e:
         exit('CRITICAL ERROR: NetJobsAgent failed to initialize: %s.' % str(e))
 
-    while True:
-        print('// NetJobsAgent: listening for scheduler connection on port %d.' \
-              % listenPort)
-        print('//     Process blocks indefinitely. Exit with ctrl-C/ctrl-break.\n')
-        name = ''
-        subthreads = []
-        results = {}
-        ready = False
+    print('// NetJobsAgent: listening for scheduler connections on port %d.' \
+          % listenPort)
+    print('//     Process blocks indefinitely. Exit with ctrl-C/ctrl-break.\n')
 
+    while True:
         # Establish connection with client.
         try:
             sock, addr = listenSock.accept()
         except Exception as e:
             print("ERROR: socket accept failed: %s" % str(e))
             continue
-     
+
         print('Got connection from %s. Communicating on port %s.\n' \
               % (addr, listenPort))
 
-        # Set the socket timeout.
-        sock.settimeout(SOCKET_TIMEOUT)
+        thread = threading.Thread(target=serve, args=(AgentSession(sock, addr),))
+        thread.daemon = True
+        thread.start()
 
-        # Get the run specifications.
-        commands, timeouts = get_specs(sock)
 
-        # Spawn the SOSThread.
-        sosThread = SOSThread(sock, sosTimeout, commands, timeouts)
+# ############################################################################ #
+# AgentSession class for the state of one scheduler connection.                #
+# ############################################################################ #
+class AgentSession:
+    "state of one scheduler connection"
 
-        # Listen for go command.
-        sosThread.start()
+    def __init__(self, sock, addr):
+        "basic initializer"
+        self.sock = sock
+        self.addr = addr
+        # Set by the scheduler during setup.
+        self.name = ''
+        self.ready = False
+        # In session mode, the connection stays open after each run and the
+        # same commands can be started again.
+        self.sessionMode = False
+        # Protocol version agreed with the scheduler.
+        self.protocol = MIN_PROTOCOL_VERSION
+        # Whether to send Vdbench results after each command.
+        self.extract = False
+        self.sosTimeout = TIMEOUT_NONE
+        self.commands = []
+        self.timeouts = []
 
-        # Block until sosThread has finished starting.
-        while not sosThread.started:
-            time.sleep(0) # Yield.
+        # Per-run state.
+        self.subthreads = []
+        self.results = {}
+        # Number of active subprocesses.
+        self.processcount = 0
+        self.processLock = threading.Lock()
 
-        # Block until all subprocesses complete.
-        for t in subthreads:
-            t.join()
+        # Serializes sends, since the SOSThread and ProcThreads share the
+        # socket.
+        self.sendLock = threading.Lock()
+        # Reassembles messages from the connection. Kept for the whole
+        # connection rather than per run, so nothing received by one run's
+        # SOSThread is lost when the next one takes over.
+        self.frames = FrameBuffer()
 
-        # Stop SOSThread
-        sosThread.stop()
-        sosThread.join()
-
-        # Close the connection.
-        try:
-            # Wait for any remaining processes.
-            if processcount > 0:
-                while processcount > 0:
-                    time.sleep(0) # Yield.
-            # Notify client to stop listener thread for this agent.
-            print('\nActive processes: %d. Notifying client.\n' % (processcount))
-            sock.sendall(bytes(DONE_STRING + '\n', 'UTF-8'))
-            for i in range(CONNECTION_CLOSE_DELAY):
-                print('Closing connection in %d...' % (CONNECTION_CLOSE_DELAY-i))
-                time.sleep(1)
-            sock.close()
-        except Exception as e:
-            print(str(e))
-            pass
-        print('\nConnection closed. Returning to wait mode.\n')
+    #
+    # Send one message to the scheduler. Safe to call from any thread.
+    #
+    def send(self, message):
+        send_message(self.sock, message, self.sendLock)
 
 
 # ############################################################################ #
@@ -245,48 +447,138 @@ def main():
 class SOSThread(threading.Thread):
     "listens for kill command from client"
 
-    def __init__(self, sock, timeout, commandsList, timeoutsList):
+    def __init__(self, session):
         threading.Thread.__init__(self)
         self.running = False
-        self.sock = sock
-        self.timeout = timeout
-        self.commandsList = commandsList
-        self.timeoutsList = timeoutsList
+        self.session = session
+        self.sock = session.sock
+        self.timeout = session.sosTimeout
         self.started = False
+        # Set when the scheduler closes the connection or ends the session.
+        self.closed = False
+        # Set once the run has started, or the thread has stopped.
+        self.startedOrStopped = threading.Event()
+        # stop wakes the thread up by writing to this pair, so it can block
+        # in select without a timeout.
+        self.wakeupRecv, self.wakeupSend = socket.socketpair()
+        # Time (on our clock) a scheduled start is due, if one is pending.
+        # The thread keeps handling messages until then, so the start can
+        # still be killed or the connection closed.
+        self.startAt = None
 
     def run(self):
         self.running = True
-        startTime = time.time()
+        self.startTime = time.time()
+        frames = self.session.frames
         try:
             while self.running:
-                elapsedTime = time.time() - startTime
-                if not self.timeout == TIMEOUT_NONE and elapsedTime >= self.timeout:
-                    self.timeout_handler()
-                    break
-
-                ready = select.select([self.sock], [], [], SELECT_TIMEOUT)
-                
-                if ready[0]:
+                # Handle any messages already received, including those the
+                # last run's SOSThread read but didn't get to.
+                command = frames.pop()
+                if command is not None:
+                    self.handle_message(command)
+                    continue
+
+                if self.startAt is not None and time.time() >= self.startAt:
+                    self.start_scheduled()
+                    continue
+
+                timeout = None
+                if not self.timeout == TIMEOUT_NONE:
+                    timeout = self.timeout - (time.time() - self.startTime)
+                    if timeout <= 0:
+                        self.timeout_handler()
+                        break
+                if self.startAt is not None:
+                    delay = self.startAt - time.time()
+                    timeout = delay if timeout is None else min(timeout, delay)
+
+                ready = select.select([self.sock, self.wakeupRecv], [], [], timeout)
+
+                if self.sock in ready[0]:
                     buffer = self.sock.recv(BUFFER_SIZE)
-                
+
                     if buffer:
-                        commands = buffer.decode('UTF-8').split('\n')
-                        commands = filter(None, commands)
-                        for command in commands:
-                            if command == START_STRING:
-                                print('Start command received. Beginning run...')
-                                start_run(self.sock, self.commandsList, self.timeoutsList)
-                                self.started = True
-                            elif command == KILL_STRING:
-                                print('Run killed by remote client.')
-                                self.stop_and_kill_run()
-                            elif command == PING_STATUS_STRING:
-                                print('Status ping received.')
-                                self.sock.sendall(bytes(PING_OK_STRING + '\n', 'UTF-8'))
-                            else:
-                                print('Unknown command received from client:' % command)
+                        frames.feed(buffer)
+                    else:
+                        # The scheduler went away. Nobody is left to receive
+                        # results, so stop anything still running.
+                        print('Connection closed by remote client.')
+                        self.closed = True
+                        self.stop_and_kill_run()
         except:
             self.timeout_handler()
+        finally:
+            self.startedOrStopped.set()
+            self.wakeupRecv.close()
+            self.wakeupSend.close()
+
+    #
+    # Act on one message from the scheduler.
+    #
+    def handle_message(self, command):
+        tokens = command.split(SOCKET_DELIMITER)
+        if command == START_STRING:
+            print('Start command received. Beginning run...')
+            start_run(self.session)
+            self.started = True
+            self.startedOrStopped.set()
+        elif tokens[0] == START_AT_STRING and len(tokens) > 1:
+            # Start at the given time on our own clock (see run).
+            self.startAt = float(tokens[1])
+            print('Start command received. Beginning run in %.3f second(s)...'
+                  % max(self.startAt - time.time(), 0))
+        elif command == TIME_STRING:
+            self.session.send(TIME_STRING + SOCKET_DELIMITER + repr(time.time()))
+        elif command == KILL_STRING:
+            if self.startAt is not None:
+                print('Run killed by remote client before it started.')
+                self.cancel_scheduled()
+            elif self.session.sessionMode and not self.started:
+                # Between runs, a kill is left over from the last run (the
+                # scheduler may send it after DONE), so there is nothing to
+                # kill and the session carries on.
+                print('Kill received between runs. Ignoring.')
+            else:
+                print('Run killed by remote client.')
+                self.stop_and_kill_run()
+        elif command == PING_STATUS_STRING:
+            print('Status ping received.')
+            self.session.send(PING_OK_STRING)
+        elif command == CLOSE_STRING:
+            print('Close command received.')
+            self.closed = True
+            self.stop_and_kill_run()
+        else:
+            print('Unknown command received from client: %s' % command)
+
+    #
+    # Start a scheduled run, now that it is due, and report when it actually
+    # started.
+    #
+    def start_scheduled(self):
+        self.startAt = None
+        self.startTime = start_run(self.session)
+        self.started = True
+        self.startedOrStopped.set()
+        self.session.send(STARTED_STRING + SOCKET_DELIMITER + repr(self.startTime))
+
+    #
+    # Call off a scheduled run that hasn't started. Every command is reported
+    # as killed, as if it had started and been killed straight away, so the
+    # scheduler gets the results it is waiting for and, in session mode, the
+    # session carries on.
+    #
+    def cancel_scheduled(self):
+        self.startAt = None
+        self.running = False
+        for command in self.session.commands:
+            result = (self.session.name + SOCKET_DELIMITER + command
+                      + SOCKET_DELIMITER + KILLED_STATUS + SOCKET_DELIMITER)
+            self.session.results[command] = result
+            self.session.send(result)
+        self.started = True
+        self.startedOrStopped.set()
 
     def timeout_handler(self):
         if self.running:
@@ -294,7 +586,7 @@ class SOSThread(threading.Thread):
             print('ERROR: a global timeout occurred for this agent.')
             try:
                 # Kill all subprocess threads.
-                for thread in subthreads:
+                for thread in self.session.subthreads:
                     thread.stop_and_kill_subproc(TIMEOUT_STATUS + SOCKET_DELIMITER)
             except:
                 pass
@@ -305,13 +597,18 @@ class SOSThread(threading.Thread):
             print('Agent killed by remote host.')
             try:
                 # Kill all subprocess threads.
-                for thread in subthreads:
+                for thread in self.session.subthreads:
                     thread.stop_and_kill_subproc(KILLED_STATUS + SOCKET_DELIMITER)
             except:
                 pass
 
     def stop(self):
         self.running = False
+        try:
+            self.wakeupSend.send(b'\0')
+        except OSError:
+            # Already stopped.
+            pass
 
 
 # ############################################################################ #
@@ -320,63 +617,159 @@ class SOSThread(threading.Thread):
 class ProcThread(threading.Thread):
     "listens for subprocess completion"
 
-    def __init__(self, sock, command, timeout, proc):
+    def __init__(self, session, command, timeout, proc):
         threading.Thread.__init__(self)
         self.running = False
-        self.sock = sock
+        self.session = session
         self.command = command
         self.timeout = timeout
         self.proc = proc
         self.result = 'NONE'
+        # Vdbench output directory, if the command prints one.
+        self.outputDir = None
+        self.nextIsOutputDir = False
+        # Name of the Vdbench run definition being run, if any.
+        self.runName = None
 
+    #
+    # Echo the subprocess's output until it closes its standard output, then
+    # wait for it to exit, while another thread drains its standard error, so
+    # neither pipe can fill up and stall it. Everything blocks, so the thread
+    # uses no CPU while the subprocess runs; the timeout is enforced by a
+    # timer that kills the subprocess, which ends the output.
+    #
     def run(self):
-        global processcount
-
         self.running = True
-        startTime = time.time()
+        label = '%s_%s_%d' % (re.sub(r'[^\w.-]', '_', self.session.name) or 'netjobs',
+                              time.strftime('%Y%m%d-%H%M%S'), self.proc.pid)
+        self.output = OutputBuffer(label + '_stdout')
+        self.errors = OutputBuffer(label + '_stderr')
+        errorThread = threading.Thread(target=drain, args=(self.proc.stderr, self.errors))
+        errorThread.daemon = True
+        errorThread.start()
+        timer = None
+        if not self.timeout == None:
+            timer = threading.Timer(self.timeout, self.stop_and_kill_subproc,
+                                    (TIMEOUT_STATUS + SOCKET_DELIMITER,))
+            timer.daemon = True
+            timer.start()
         try:
-            while self.running and self.proc.poll() is None: # Checks returncode attribute.
-                print(self.proc.stdout.readline().decode('UTF-8'), end='')
-                elapsedTime = time.time() - startTime
-                # If timeout exceeded and subprocess is still running. Short-circuits
-                # if self.timeout is None.
-                if not self.timeout == None and elapsedTime >= self.timeout:
-                    self.stop_and_kill_subproc(TIMEOUT_STATUS + SOCKET_DELIMITER)
-                # Yield context.
-                time.sleep(0)
+            for data in iter(lambda: self.proc.stdout.readline(OUTPUT_LINE_LIMIT), b''):
+                self.output.write(data)
+                line = data.decode('UTF-8', errors='replace')
+                print(line, end='')
+                if self.session.protocol >= METRICS_VERSION:
+                    self.send_metrics(line)
+                if self.session.extract:
+                    self.find_output_dir(line)
+            self.proc.wait()
+            errorThread.join()
+            if self.session.extract and self.outputDir is not None:
+                self.send_results_record()
         except Exception as e:
             print('ERROR: during subprocess execution: %s.' % str(e))
             self.stop_and_kill_subproc(ERROR_STATUS + SOCKET_DELIMITER + str(e))
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.output.close()
+            self.errors.close()
 
         self.send_result()
-        processcount -= 1
+        with self.session.processLock:
+            self.session.processcount -= 1
+
+    #
+    # Send the figures from a Vdbench interval line to the scheduler as a
+    # metrics message: interval, i/o rate, MB/sec, response time and queue
+    # depth, then (from protocol version 5) the run name, followed by the
+    # command. Intervals of format runs and other lines are ignored, apart
+    # from the lines that start a run, which set the run name.
+    #
+    def send_metrics(self, line):
+        match = RUN_REGEX.search(line)
+        if match is not None:
+            self.runName = match.group(1)
+            return
+        match = INTERVAL_REGEX.match(line)
+        if match is None:
+            return
+        if self.runName is not None and self.runName.startswith(FORMAT_RUN_PREFIX):
+            return
+        fields = match.groups()
+        metrics = [fields[0], fields[1], fields[2], fields[5], fields[10]]
+        if self.session.protocol >= METRICS_RUN_VERSION:
+            metrics.append(self.runName or '')
+        try:
+            self.session.send(SOCKET_DELIMITER.join(
+                [METRICS_STRING] + metrics + [self.command]))
+        except Exception as e:
+            print('NOTICE: an exception was caught during transmission of metrics: %s.'
+                % str(e))
+
+    #
+    # Look for the Vdbench output directory ("-o DIR" or "-oDIR") in an
+    # echoed argument line.
+    #
+    def find_output_dir(self, line):
+        match = ARGUMENT_REGEX.search(line)
+        if match is None:
+            return
+        argument = match.group(1)
+        if self.nextIsOutputDir:
+            self.outputDir = argument
+            self.nextIsOutputDir = False
+        elif argument == '-o':
+            self.nextIsOutputDir = True
+        elif argument.startswith('-o'):
+            self.outputDir = argument[2:]
+
+    #
+    # Read the results in the Vdbench output directory and send them to the
+    # scheduler as a results message: a JSON object with the output
+    # directory ("output"), the flatfile's summary row keyed by column name
+    # ("row") and the histogram as [min, max, count] buckets, with max null
+    # for the open-ended last bucket ("histogram", null if unavailable),
+    # followed by the command. Nothing is sent if there is no flatfile.
+    #
+    def send_results_record(self):
+        # Vdbench resolves a relative path against its working directory,
+        # which is normally ours.
+        path = os.path.abspath(self.outputDir)
+        try:
+            row = read_summary_row(os.path.join(path, FLATFILE_NAME))
+        except (OSError, ValueError) as e:
+            print('NOTICE: unable to extract results from %s: %s.' % (path, str(e)))
+            return
+        try:
+            histogram = read_histogram(os.path.join(path, HISTOGRAM_NAME))
+        except (OSError, ValueError):
+            histogram = None
+        record = json.dumps({'output': path, 'row': row, 'histogram': histogram})
+        try:
+            self.session.send(SOCKET_DELIMITER.join([RESULTS_STRING, record, self.command]))
+        except Exception as e:
+            print('NOTICE: an exception was caught during transmission of results: %s.'
+                % str(e))
 
     def send_result(self):
-        global results
-        
+        name = self.session.name
+
         if self.result == 'NONE':
-            output, errors = self.proc.communicate()
-            if self.proc.returncode > 0 or errors:
+            if self.proc.returncode > 0 or self.errors.total > 0:
                 self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                    + ERROR_STATUS + SOCKET_DELIMITER + errors.decode('UTF-8'))
+                    + ERROR_STATUS + SOCKET_DELIMITER + self.errors.summary())
             else:
                 self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                    + SUCCESS_STATUS + SOCKET_DELIMITER + output.decode('UTF-8'))
+                    + SUCCESS_STATUS + SOCKET_DELIMITER + self.output.summary())
 
         print('* ' + self.result)
 
         # Store for logging.
-        results[self.command] = self.result
-
-        # Check to make sure we're not overrunning the socket buffer.
-        if len(self.result) > BUFFER_SIZE:
-            self.result = self.result[:BUFFER_SIZE-2]
-        # Add the terminating newline.
-        if not self.result[:-1] == '\n':
-            self.result = self.result + '\n'
+        self.session.results[self.command] = self.result
 
         try:
-            self.sock.sendall(bytes(self.result, 'UTF-8'))
+            self.session.send(self.result)
         except Exception as e:
             print('NOTICE: an exception was caught during transmission of results: %s.'
                 % str(e))
@@ -386,13 +779,306 @@ class ProcThread(threading.Thread):
             self.running = False
             print('\tCommand "%s" killed.' % self.command)
             try:
-                # Kill the subprocess.
-                self.proc.terminate()
+                # Kill the subprocess and anything it spawned.
+                if hasattr(os, 'killpg'):
+                    os.killpg(self.proc.pid, signal.SIGTERM)
+                else:
+                    self.proc.terminate()
             except:
                 pass
 
-            self.result = (name + SOCKET_DELIMITER + self.command + SOCKET_DELIMITER
-                + reason)
+            self.result = (self.session.name + SOCKET_DELIMITER + self.command
+                + SOCKET_DELIMITER + reason)
+
+
+# ############################################################################ #
+# OutputBuffer class for capturing command output in bounded memory.           #
+# ############################################################################ #
+class OutputBuffer:
+    "keeps the end of an output stream, spilling all of it to a file if large"
+
+    def __init__(self, label):
+        "basic initializer"
+        self.label = label
+        self.chunks = deque()
+        self.size = 0
+        # Bytes written in all.
+        self.total = 0
+        # Spill file, once the output outgrows memory. path is '' if it
+        # couldn't be created.
+        self.file = None
+        self.path = None
+
+    #
+    # Add output. Only one thread may write to a buffer.
+    #
+    def write(self, data):
+        self.total += len(data)
+        if self.path is None and self.total > OUTPUT_LIMIT:
+            self.spill()
+        if self.file is not None:
+            self.file.write(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        # Keep only as much as needed for the last OUTPUT_LIMIT bytes.
+        while self.size - len(self.chunks[0]) >= OUTPUT_LIMIT:
+            self.size -= len(self.chunks.popleft())
+
+    #
+    # Start writing to a file, beginning with everything so far.
+    #
+    def spill(self):
+        path = os.path.join(OUTPUT_SPILL_DIR, self.label + OUTPUT_SPILL_SUFFIX)
+        try:
+            os.makedirs(OUTPUT_SPILL_DIR, exist_ok=True)
+            with openSpillFilesLock:
+                openSpillFiles.add(path)
+            self.file = open(path, 'wb')
+            self.path = path
+            for chunk in self.chunks:
+                self.file.write(chunk)
+        except OSError as e:
+            print('NOTICE: unable to save output to a file, so only its end will be kept: %s.'
+                  % str(e))
+            with openSpillFilesLock:
+                openSpillFiles.discard(path)
+            self.file = None
+            self.path = ''
+
+    #
+    # Finish writing. If the output was spilled, make room for its file by
+    # deleting the oldest finished ones (see prune_spill_files).
+    #
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            with openSpillFilesLock:
+                openSpillFiles.discard(self.path)
+            prune_spill_files()
+
+    #
+    # Text to send with the result: the whole output if it fit in memory,
+    # otherwise a note of its size and where it was saved, followed by its
+    # last OUTPUT_LIMIT bytes.
+    #
+    def summary(self):
+        data = b''.join(self.chunks)[-OUTPUT_LIMIT:]
+        text = data.decode('UTF-8', errors='replace')
+        if self.total <= OUTPUT_LIMIT:
+            return text
+        if self.path:
+            where = 'saved on %s at %s' % (socket.gethostname(), self.path)
+        else:
+            where = 'not saved'
+        return ('[output truncated: %d bytes in all, full output %s; last %d bytes follow]\n'
+                % (self.total, where, len(data)) + text)
+
+
+# ############################################################################ #
+# FrameBuffer class for reassembling messages from a stream.                   #
+# ############################################################################ #
+class FrameBuffer:
+    "collects received bytes and splits them into complete messages"
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    #
+    # Add received bytes.
+    #
+    def feed(self, data):
+        self.buffer += data
+
+    #
+    # Take the next complete message, so any after it stay buffered until
+    # asked for.
+    #
+    # Return:
+    #     The message, or None if no complete message has been received.
+    #
+    def pop(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self.buffer)
+        end = FRAME_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        message = self.buffer[FRAME_HEADER.size:end].decode('UTF-8')
+        del self.buffer[:end]
+        return message
+
+#
+# Delete the oldest finished spill files in OUTPUT_SPILL_DIR until those left
+# add up to no more than OUTPUT_SPILL_RETAIN bytes. Files still being written
+# are left alone.
+#
+def prune_spill_files():
+    with openSpillFilesLock:
+        busy = set(openSpillFiles)
+    try:
+        names = os.listdir(OUTPUT_SPILL_DIR)
+    except OSError:
+        return
+    files = []
+    for name in names:
+        path = os.path.join(OUTPUT_SPILL_DIR, name)
+        if not name.endswith(OUTPUT_SPILL_SUFFIX) or path in busy:
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= OUTPUT_SPILL_RETAIN:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+#
+# Read the last data row of a Vdbench flatfile.html as a dictionary keyed by
+# column name. Comment lines start with "*" or an HTML tag; the first other
+# line holds the column names. For a completed run, the last row is the
+# summary ("avg_") row. Only the header and the end of the file are read:
+# the last row is found by reading backwards from the end, one block at a
+# time, the same way as vdbflatfile.readLastRow in VDBTest. Raises
+# ValueError if there is no such row.
+#
+def read_summary_row(path):
+    with open(path, 'rb') as f:
+        keys = None
+        for line in iter(f.readline, b''):
+            text = line.decode('UTF-8', 'replace').strip()
+            if not text or is_comment_line(text):
+                continue
+            # Only trust a complete line, in case Vdbench is mid-write.
+            if line.endswith(b'\n'):
+                keys = text.split()
+            break
+        if keys is None:
+            raise ValueError('no results in %s' % path)
+        values = read_last_line(f, f.tell())
+    if values is None or len(values) != len(keys):
+        raise ValueError('no results in %s' % path)
+    return dict(zip(keys, values))
+
+#
+# Helper for read_summary_row. Find the last complete, non-blank,
+# non-comment line at or after offset start in an open binary file, reading
+# backwards from the end one block at a time.
+#
+# Return:
+#     The line's columns, or None if there is no such line.
+#
+def read_last_line(f, start):
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    data = b''
+    trailing = True
+    while position > start:
+        step = min(FLATFILE_BLOCK_SIZE, position - start)
+        position -= step
+        f.seek(position)
+        data = f.read(step) + data
+        lines = data.split(b'\n')
+        # A last line without a newline is still being written. It may span
+        # more than one block.
+        if trailing:
+            trailing = len(lines) == 1
+            lines[-1] = b''
+        # Unless we've reached the start, the first piece may be a fragment.
+        complete = lines if position == start else lines[1:]
+        for line in reversed(complete):
+            text = line.decode('UTF-8', 'replace').strip()
+            if text and not is_comment_line(text):
+                return text.split()
+        # Keep only the fragment; everything after it was blank or comments.
+        data = lines[0]
+    return None
+
+#
+# Check whether a line of a Vdbench HTML file (stripped) is a comment or an
+# HTML tag.
+#
+def is_comment_line(text):
+    return text.startswith('*') or text.startswith('<')
+
+#
+# Read the last "Reads and writes:" section of a Vdbench histogram.html as a
+# list of [min, max, count] buckets (ms), with max None for the open-ended
+# last bucket. Raises ValueError if there is no such section.
+#
+def read_histogram(path):
+    histogram = None
+    buckets = None
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            text = line.strip()
+            if text in HISTOGRAM_SECTIONS:
+                if buckets:
+                    histogram = buckets
+                buckets = [] if text == HISTOGRAM_SECTION else None
+                continue
+            if buckets is None:
+                continue
+            match = BUCKET_REGEX.match(line)
+            if match:
+                low, high, count = match.groups()
+                buckets.append([float(low), None if high == 'max' else float(high),
+                                int(count.replace(',', ''))])
+    if buckets:
+        histogram = buckets
+    if histogram is None:
+        raise ValueError('no histogram in %s' % path)
+    return histogram
+
+#
+# Copy everything from a binary stream to an OutputBuffer until it ends.
+#
+def drain(stream, buffer):
+    try:
+        for data in iter(lambda: stream.read1(BUFFER_SIZE), b''):
+            buffer.write(data)
+    except (OSError, ValueError):
+        # The stream was closed under us.
+        pass
+
+#
+# Send one message as a frame, holding lock (if given) while sending.
+#
+def send_message(sock, message, lock=None):
+    payload = message.encode('UTF-8')
+    data = FRAME_HEADER.pack(len(payload)) + payload
+    if lock is None:
+        sock.sendall(data)
+    else:
+        with lock:
+            sock.sendall(data)
+
+#
+# Receive one message, blocking until all of it has arrived. Only for use
+# when no other thread is reading the socket.
+#
+def recv_message(sock):
+    (length,) = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    return recv_exact(sock, length).decode('UTF-8')
+
+#
+# Receive exactly count bytes.
+#
+def recv_exact(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(min(count - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
 
 
 # ############################################################################ #
@@ -0,0 +1,72 @@
+import socket
+import threading
+
+import pytest
+
+from NetJobs import NetJobs
+from NetJobs import NetJobsAgent
+
+def frame(message):
+    payload = message.encode("UTF-8")
+    return NetJobsAgent.FRAME_HEADER.pack(len(payload)) + payload
+
+def test_agent_frame_buffer_split_frame():
+    data = frame("first") + frame("sécond")
+    frames = NetJobsAgent.FrameBuffer()
+    # Split inside the header, then inside a multi-byte character.
+    frames.feed(data[:3])
+    assert frames.pop() is None
+    frames.feed(data[3:len(frame("first")) + 10])
+    assert frames.pop() == "first"
+    assert frames.pop() is None
+    frames.feed(data[len(frame("first")) + 10:])
+    assert frames.pop() == "sécond"
+    assert frames.pop() is None
+
+def test_agent_frame_buffer_keeps_later_frames():
+    frames = NetJobsAgent.FrameBuffer()
+    frames.feed(frame("one") + frame("") + frame("three")[:-1])
+    assert frames.pop() == "one"
+    assert frames.pop() == ""
+    assert frames.pop() is None
+    frames.feed(b"e")
+    assert frames.pop() == "three"
+
+def test_controller_frame_buffer_split_frame():
+    data = frame("first") + frame("second")
+    frames = NetJobs.FrameBuffer()
+    assert frames.feed(data[:4]) == []
+    assert frames.feed(data[4:-2]) == ["first"]
+    assert frames.feed(data[-2:]) == ["second"]
+
+# Answer one protocol negotiation on sock with reply.
+def answer(sock, reply):
+    NetJobsAgent.recv_message(sock)
+    NetJobsAgent.send_message(sock, reply)
+
+@pytest.mark.parametrize("reply, version", [
+    (NetJobs.HELLO_STRING + NetJobs.SOCKET_DELIMITER + "5", 5),
+    (NetJobs.HELLO_STRING + NetJobs.SOCKET_DELIMITER + "1", 1),
+])
+def test_negotiate_version(reply, version):
+    controller, agent = socket.socketpair()
+    with controller, agent:
+        thread = threading.Thread(target=answer, args=(agent, reply))
+        thread.start()
+        assert NetJobs.negotiate_version(controller, "agent") == version
+        thread.join()
+
+@pytest.mark.parametrize("reply", [
+    NetJobs.ERROR_STRING + NetJobs.SOCKET_DELIMITER + "unsupported",
+    NetJobs.HELLO_STRING + NetJobs.SOCKET_DELIMITER + "99",
+    NetJobs.HELLO_STRING + NetJobs.SOCKET_DELIMITER + "five",
+    "hello",
+])
+def test_negotiate_version_rejects(reply):
+    controller, agent = socket.socketpair()
+    with controller, agent:
+        thread = threading.Thread(target=answer, args=(agent, reply))
+        thread.start()
+        with pytest.raises(NetJobs.AgentError):
+            NetJobs.negotiate_version(controller, "agent")
+        thread.join()
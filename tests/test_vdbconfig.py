@@ -0,0 +1,109 @@
+import pytest
+
+from vdbconfig import vdbconfig
+
+BASE = """* Base profile
+hd=default,vdbench=/opt/vdbench,user=root
+
+sd=sd1,lun=/dev/sdb,openflags=o_direct,threads=8
+wd=wd1,sd=sd*,xfersize=4k,rdpct=70,seekpct=100
+rd=rd1,wd=wd*,iorate=1000,elapsed=60,interval=1,format=yes
+"""
+
+TABLE = """name,iorate,sd.threads,sd1.lun,wd1.rhpct
+vdb1,,,/dev/sdc,
+vdb2,2000,16,,50
+"""
+
+def loadTemplate(tmp_path):
+    base = tmp_path / "base.txt"
+    base.write_text(BASE)
+    table = tmp_path / "table.csv"
+    table.write_text(TABLE)
+    return vdbconfig.Template.load(str(base), str(table))
+
+def test_config_round_trip():
+    config = vdbconfig.VdbConfig(BASE)
+    assert config.render() == BASE
+    assert config.getIORate() == 1000
+    assert config.isFormatting()
+    assert [d.name for d in config.definitions()] == ["default", "sd1", "wd1",
+        "rd1"]
+
+def test_config_copy_is_independent():
+    config = vdbconfig.VdbConfig(BASE)
+    other = config.copy()
+    other.setIORate([500, 1000])
+    other.setFormat(vdbconfig.FORMAT_OFF)
+    assert config.render() == BASE
+    assert other.getIORates() == [500, 1000]
+    assert other.getIORate() == 750
+    assert not other.isFormatting()
+    assert "iorate=(500,1000)" in other.render()
+
+def test_template_render(tmp_path):
+    template = loadTemplate(tmp_path)
+    assert template.names() == ["vdb1", "vdb2"]
+    assert template.get("vdb1", vdbconfig.IORATE) is None
+
+    vdb1 = template.render("vdb1")
+    assert vdb1.getIORate() == 1000
+    assert vdb1.find("sd", "sd1").get("lun") == "/dev/sdc"
+    assert vdb1.find("sd", "sd1").get("threads") == "8"
+
+    vdb2 = template.render("vdb2")
+    assert vdb2.getIORate() == 2000
+    assert vdb2.find("sd", "sd1").get("threads") == "16"
+    assert vdb2.find("wd", "wd1").get("rhpct") == "50"
+    # The base profile is left alone.
+    assert template.base.render() == BASE
+
+def test_template_render_all_round_trip(tmp_path):
+    template = loadTemplate(tmp_path)
+    configDir = tmp_path / "config"
+    configDir.mkdir()
+    written = template.renderAll(str(configDir))
+    assert sorted(written) == [str(configDir / "vdb1"), str(configDir / "vdb2")]
+    for name in template.names():
+        text = (configDir / name).read_text()
+        assert text == template.render(name).render()
+        assert vdbconfig.VdbConfig(text).render() == text
+
+    # Only changed targets are written again.
+    assert template.renderAll(str(configDir)) == []
+    template.set("vdb1", vdbconfig.IORATE, vdbconfig.formatIORate([100, 200]))
+    assert template.renderAll(str(configDir)) == [str(configDir / "vdb1")]
+    assert vdbconfig.loadConfig(str(configDir / "vdb1")).getIORates() == [100,
+        200]
+
+    # A fresh template leaves files that are already right alone.
+    assert loadTemplate(tmp_path).renderAll(str(configDir)) == [
+        str(configDir / "vdb1")]
+
+def test_template_save_table(tmp_path):
+    template = loadTemplate(tmp_path)
+    template.set("vdb1", vdbconfig.FORMAT, vdbconfig.FORMAT_OFF)
+    path = tmp_path / "saved.csv"
+    template.saveTable(str(path))
+    base = tmp_path / "base.txt"
+    saved = vdbconfig.Template.load(str(base), str(path))
+    assert saved.rows == template.rows
+
+def test_template_rejects_unknown_column(tmp_path):
+    base = tmp_path / "base.txt"
+    base.write_text(BASE)
+    table = tmp_path / "table.csv"
+    table.write_text("name,fwd.threads\nvdb1,4\n")
+    template = vdbconfig.Template.load(str(base), str(table))
+    with pytest.raises(Exception, match="matches nothing"):
+        template.renderAll(str(tmp_path))
+
+def test_split_tokens():
+    assert vdbconfig.splitTokens("sd=sd1,lun=/dev/sdb") == ["sd=sd1",
+        "lun=/dev/sdb"]
+    assert vdbconfig.splitTokens("rd=rd1,iorate=(1,2,3),forthreads=(1,(2,3))") == [
+        "rd=rd1", "iorate=(1,2,3)", "forthreads=(1,(2,3))"]
+    assert vdbconfig.tokenize("a=1,b") == [["a", "1"], ["b"]]
+    for line in ("iorate=(1,2", "iorate=1,2)"):
+        with pytest.raises(Exception, match="mismatched parentheses"):
+            vdbconfig.splitTokens(line)
@@ -0,0 +1,70 @@
+from vdbresults import vdbflatfile
+
+HEADER = """<pre>
+* Vdbench flatfile
+* Run definitions: rd1
+
+Run Interval reqrate rate resp
+"""
+
+def writeFlatfile(tmp_path, text):
+    path = tmp_path / vdbflatfile.FLATFILE_NAME
+    path.write_bytes(text.encode("UTF-8"))
+    return str(path)
+
+def test_read_last_row(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER
+        + "rd1 1 1000 998.0 1.1\n"
+        + "rd1 2 1000 1001.0 1.3\n"
+        + "rd1 avg_2-2 1000 1001.0 1.3\n")
+    row = vdbflatfile.readLastRow(path)
+    assert row["Interval"] == "avg_2-2"
+    assert vdbflatfile.isSummaryRow(row)
+
+def test_read_last_row_skips_partial_line(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER
+        + "rd1 1 1000 998.0 1.1\n"
+        + "rd1 2 1000 1001.0 1.3\n"
+        + "rd1 3 1000 99")
+    row = vdbflatfile.readLastRow(path)
+    assert row["Interval"] == "2"
+    assert row["resp"] == "1.3"
+
+def test_read_last_row_partial_line_spans_blocks(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER
+        + "rd1 1 1000 998.0 1.1\n"
+        + "rd1 2 1000 " + "9" * (vdbflatfile.BLOCK_SIZE * 2))
+    assert vdbflatfile.readLastRow(path)["Interval"] == "1"
+
+def test_read_last_row_skips_trailing_comments(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER
+        + "rd1 1 1000 998.0 1.1\n"
+        + "\n* end of run\n</pre>\n")
+    assert vdbflatfile.readLastRow(path)["Interval"] == "1"
+
+def test_read_last_row_without_results(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER + "rd1 1 1000 9")
+    try:
+        vdbflatfile.readLastRow(path)
+    except Exception as e:
+        assert "contains no results" in str(e)
+    else:
+        assert False, "expected an exception"
+
+def test_tail_returns_only_new_complete_rows(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER + "rd1 1 1000 998.0 1.1\nrd1 2 10")
+    tail = vdbflatfile.FlatFileTail(path)
+    assert [row["Interval"] for row in tail.readRows()] == ["1"]
+    with open(path, "ab") as f:
+        f.write(b"00 1001.0 1.3\nformat 1 0 0 0\nrd1 avg_1-2 1000 999.5 1.2\n")
+    assert [row["Interval"] for row in tail.readRows()] == ["2"]
+    assert tail.readRows() == []
+
+def test_read_summary_rows(tmp_path):
+    path = writeFlatfile(tmp_path, HEADER
+        + "rd1 1 500 500.0 0.8\n"
+        + "rd1 avg_1-1 500 500.0 0.8\n"
+        + "rd1 1 1000 998.0 1.1\n"
+        + "rd1 avg_1-1 1000 998.0 1.1\n")
+    rows = vdbflatfile.readSummaryRows(path)
+    assert [row["reqrate"] for row in rows] == ["500", "1000"]
@@ -0,0 +1,72 @@
+import math
+
+import pytest
+
+from vdbresults import vdbhistogram
+
+BOUNDS = [(0.0, 1.0), (1.0, 2.0), (2.0, 4.0), (4.0, math.inf)]
+
+def test_percentile_interpolates_within_bucket():
+    histogram = vdbhistogram.Histogram(BOUNDS, [50, 30, 20, 0])
+    assert histogram.total() == 100
+    assert histogram.percentile(25) == pytest.approx(0.5)
+    assert histogram.percentile(50) == pytest.approx(1.0)
+    assert histogram.percentile(65) == pytest.approx(1.5)
+    assert histogram.percentile(90) == pytest.approx(3.0)
+    assert histogram.percentile(100) == pytest.approx(4.0)
+
+def test_percentile_in_open_bucket():
+    histogram = vdbhistogram.Histogram(BOUNDS, [90, 0, 0, 10])
+    assert histogram.percentile(99) == 4.0
+
+def test_percentile_of_empty_histogram():
+    assert vdbhistogram.Histogram(BOUNDS, [0, 0, 0, 0]).percentile(99) is None
+
+def test_merge_adds_counts():
+    a = vdbhistogram.Histogram(BOUNDS, [100, 0, 0, 0])
+    b = vdbhistogram.Histogram(BOUNDS, [0, 0, 100, 0])
+    merged = a.merge(b)
+    assert merged.counts == [100, 0, 100, 0]
+    assert a.counts == [100, 0, 0, 0]
+    # Unlike the mean of the targets' percentiles (2.5 ms), the merged
+    # histogram gives the fleet-wide percentile.
+    assert merged.percentile(75) == pytest.approx(3.0)
+
+def test_merge_needs_same_buckets():
+    a = vdbhistogram.Histogram(BOUNDS, [1, 1, 1, 1])
+    b = vdbhistogram.Histogram(BOUNDS[:-1], [1, 1, 1])
+    with pytest.raises(ValueError):
+        a.merge(b)
+
+def test_merge_histograms():
+    histograms = [vdbhistogram.Histogram(BOUNDS, [i, i, i, i])
+        for i in range(1, 4)]
+    assert vdbhistogram.mergeHistograms(histograms).counts == [6, 6, 6, 6]
+    assert vdbhistogram.mergeHistograms([]) is None
+
+def test_from_buckets():
+    histogram = vdbhistogram.fromBuckets([[0, 1, 5], [1, 2, 3], [2, None, 2]])
+    assert histogram.bounds == [(0.0, 1.0), (1.0, 2.0), (2.0, math.inf)]
+    assert histogram.counts == [5, 3, 2]
+
+def test_read_histogram_takes_last_section(tmp_path):
+    path = tmp_path / vdbhistogram.HISTOGRAM_NAME
+    path.write_text("""
+Reads and writes:
+     min(ms) <     max(ms)        count       %%    cum%%
+       0.000 <       1.000            9  90.0000  90.0000  ++++
+       1.000 <         max            1  10.0000 100.0000  +
+Reads:
+       0.000 <       1.000            1  50.0000  50.0000  ++++
+       1.000 <         max            1  50.0000 100.0000  ++++
+Reads and writes:
+     min(ms) <     max(ms)        count       %%    cum%%
+       0.000 <       1.000        1,000  50.0000  50.0000  ++++
+       1.000 <         max        1,000  50.0000 100.0000  ++++
+""")
+    histogram = vdbhistogram.readHistogram(str(path))
+    assert histogram.bounds == [(0.0, 1.0), (1.0, math.inf)]
+    assert histogram.counts == [1000, 1000]
+    assert vdbhistogram.readHistogram(str(path), vdbhistogram.READS).counts == [1, 1]
+    with pytest.raises(ValueError):
+        vdbhistogram.readHistogram(str(path), vdbhistogram.WRITES)
@@ -0,0 +1,50 @@
+from vdbsearch import vdbmodel
+
+SERVICE_TIME = 0.5
+SATURATION = 10000.0
+
+# Latency of an M/M/1 queue, optionally off by a relative error.
+def queueLatency(rate, error=0.0):
+    return SERVICE_TIME / (1.0 - rate / SATURATION) * (1.0 + error)
+
+def test_fit_exact_curve():
+    points = [(rate, queueLatency(rate)) for rate in (1000, 4000, 7000, 9000)]
+    model = vdbmodel.fitLatencyCurve(points)
+    assert model.isValid()
+    assert abs(model.serviceTime() - SERVICE_TIME) < 1e-9
+    assert abs(model.saturationRate() - SATURATION) < 1e-6
+    assert abs(model.predictRate(2.0) - 7500.0) < 1e-6
+    assert abs(model.predictLatency(5000) - 1.0) < 1e-9
+    assert model.predictLatency(SATURATION) == float("inf")
+
+def test_fit_noisy_curve():
+    errors = (0.02, -0.03, 0.01, -0.02, 0.03, -0.01)
+    rates = (1000, 2500, 4000, 5500, 7000, 8500)
+    points = [(rate, queueLatency(rate, error))
+        for rate, error in zip(rates, errors)]
+    model = vdbmodel.fitLatencyCurve(points)
+    assert model.isValid()
+    assert abs(model.predictRate(2.0) - 7500.0) < 250.0
+    low, high = model.confidenceInterval(2.0)
+    assert low < model.predictRate(2.0) < high
+
+def test_confidence_interval_needs_three_points():
+    model = vdbmodel.fitLatencyCurve([(1000, queueLatency(1000)),
+        (5000, queueLatency(5000))])
+    assert model.confidenceInterval(2.0) is None
+
+def test_fit_skips_unusable_points():
+    assert vdbmodel.fitLatencyCurve([(1000, 1.0)]) is None
+    assert vdbmodel.fitLatencyCurve([(1000, 1.0), (1000, 2.0)]) is None
+    assert vdbmodel.fitLatencyCurve([(1000, 1.0), (2000, 0), (None, 1.5),
+        (3000, None)]) is None
+
+def test_falling_curve_is_invalid():
+    model = vdbmodel.fitLatencyCurve([(1000, 2.0), (5000, 1.0)])
+    assert not model.isValid()
+
+def test_t_critical():
+    assert vdbmodel.getTCritical(0) == float("inf")
+    assert vdbmodel.getTCritical(1) == 12.706
+    assert vdbmodel.getTCritical(11) == 2.228
+    assert vdbmodel.getTCritical(1000) == vdbmodel.Z_CRITICAL_95
@@ -0,0 +1,56 @@
+from vdbsearch import vdbsearch
+
+TARGET = 2.0
+FUZZ = 0.05
+
+# Latency (ms) of an M/M/1-style device with the given saturation IOPS, with
+# anything at or past saturation reported as a fixed, very high latency.
+def queueLatency(rate, saturation):
+    if rate >= saturation:
+        return 25.0
+    return 0.5 / (1.0 - rate / saturation)
+
+# Number of runs a strategy needs to land within the fuzziness band.
+def countRuns(name, saturation, start, maxRuns=50):
+    strategy = vdbsearch.getStrategy(name, 5.0, 0.3)
+    rates = [start]
+    latencies = []
+    for run in range(1, maxRuns + 1):
+        latencies.append(queueLatency(rates[-1], saturation))
+        if abs(latencies[-1] - TARGET) <= TARGET * FUZZ:
+            return run
+        rates.append(strategy.nextRate(rates, latencies, TARGET))
+    return maxRuns + 1
+
+CASES = [(saturation, start) for saturation in (3000, 5000, 10000, 20000, 50000)
+    for start in (100, 1000, 4000)]
+
+def test_secant_beats_bisection():
+    secant = sum(countRuns("secant", *case) for case in CASES)
+    bisection = sum(countRuns("bisection", *case) for case in CASES)
+    assert secant < bisection
+
+def test_model_beats_bisection():
+    model = sum(countRuns("model", *case) for case in CASES)
+    bisection = sum(countRuns("bisection", *case) for case in CASES)
+    assert model < bisection
+
+def test_strategies_converge():
+    for name in vdbsearch.SEARCH_STRATEGIES:
+        if name == "multiplier":
+            continue
+        for case in CASES:
+            assert countRuns(name, *case) <= 20, (name, case)
+
+def test_false_position_stays_inside_bracket():
+    points = [(1000, 0.8), (14000, 25.0), (5000, 1.1)]
+    lower, upper = vdbsearch.getBracket(points, TARGET)
+    assert lower == (5000, 1.1) and upper == (14000, 25.0)
+    rate = vdbsearch.falsePositionRate(points, lower, upper, TARGET)
+    assert lower[0] < rate < upper[0]
+
+def test_false_position_is_exact_for_a_queue():
+    points = [(2000, queueLatency(2000, 10000)), (9000, queueLatency(9000, 10000))]
+    lower, upper = vdbsearch.getBracket(points, TARGET)
+    rate = vdbsearch.falsePositionRate(points, lower, upper, TARGET)
+    assert abs(queueLatency(rate, 10000) - TARGET) < 1e-6
@@ -0,0 +1,78 @@
+import math
+
+from vdbresults import vdbseries
+
+COLUMNS = ("rate", "resp")
+
+def makeRow(run, interval, rate, resp):
+    return {"Run": run, "Interval": str(interval), "rate": str(rate),
+        "resp": str(resp)}
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "series.bin")
+    writer = vdbseries.SeriesWriter(path, COLUMNS)
+    data, intervals = writer.pack([makeRow("rd1", 1, 1000.0, 1.5),
+        makeRow("rd1", 2, 1010.0, "n/a")])
+    writer.writeBlock(1, "vdb1", data, intervals, rd="rd1")
+    data, intervals = writer.pack([makeRow("rd1", 1, 2000.0, 2.5)])
+    writer.writeBlock(2, "vdb2", data, intervals)
+    writer.close()
+
+    reader = vdbseries.SeriesReader(path)
+    assert reader.runs() == [1, 2]
+    assert reader.targets() == ["vdb1", "vdb2"]
+    assert reader.targets(1) == ["vdb1"]
+    assert reader.read(1, "vdb1") == [(1, {"rate": 1000.0, "resp": 1.5}),
+        (2, {"rate": 1010.0, "resp": None})]
+    assert reader.readInterval(1, "vdb1", 2) == {"rate": 1010.0, "resp": None}
+    assert reader.readInterval(1, "vdb1", 3) is None
+    assert reader.readColumn(2, "vdb2", "resp") == [(1, 2.5)]
+    assert reader.read(2, "vdb1") == []
+    assert reader.steps(1, "vdb1") == ["rd1"]
+
+def test_pack_steps_splits_at_summary_and_restart(tmp_path):
+    writer = vdbseries.SeriesWriter(str(tmp_path / "series.bin"), COLUMNS)
+    rows = [makeRow("rd1", 1, 500.0, 1.0), makeRow("rd1", 2, 500.0, 1.1),
+        makeRow("rd1", "avg_2-2", 500.0, 1.1),
+        makeRow("rd1", 1, 1000.0, 2.0), makeRow("rd1", 2, 1000.0, 2.1),
+        makeRow("rd2", 1, 1500.0, 3.0)]
+    steps = writer.packSteps(rows)
+    writer.close()
+    assert [(rd, intervals) for rd, _, intervals in steps] == [
+        ("rd1", [1, 2]), ("rd1", [1, 2]), ("rd2", [1])]
+
+def test_ingest_round(tmp_path):
+    folder = tmp_path / "vdb1"
+    folder.mkdir()
+    (folder / "flatfile.html").write_text("Run Interval rate resp\n"
+        "rd1 1 500.0 1.0\nrd1 avg_1-1 500.0 1.0\n"
+        "rd1 1 1000.0 2.0\nrd1 2 1000.0 2.2\nrd1 avg_1-2 1000.0 2.1\n")
+    missing = tmp_path / "vdb2"
+    missing.mkdir()
+    path = str(tmp_path / "series.bin")
+    writer = vdbseries.SeriesWriter(path, COLUMNS)
+    assert vdbseries.ingestRound(writer, 1, [str(folder), str(missing)]) == 3
+    writer.close()
+
+    reader = vdbseries.SeriesReader(path)
+    assert reader.targets(1) == ["vdb1"]
+    assert reader.steps(1, "vdb1") == ["rd1", "rd1"]
+    assert reader.readColumn(1, "vdb1", "rate", step=1) == [(1, 1000.0),
+        (2, 1000.0)]
+
+def test_reader_rejects_other_files(tmp_path):
+    path = tmp_path / "series.bin"
+    writer = vdbseries.SeriesWriter(str(path), COLUMNS)
+    writer.close()
+    path.write_bytes(b"NOTASERIES")
+    try:
+        vdbseries.SeriesReader(str(path))
+    except Exception as e:
+        assert "not a vdbtest time-series file" in str(e)
+    else:
+        assert False, "expected an exception"
+
+def test_to_float():
+    assert vdbseries.toFloat("1.5") == 1.5
+    assert math.isnan(vdbseries.toFloat("n/a"))
+    assert math.isnan(vdbseries.toFloat(None))
@@ -0,0 +1,43 @@
+import pytest
+
+from vdbresults import vdbstore
+
+def makeStore():
+    store = vdbstore.ResultStore(["vdb1", "vdb2", "vdb3"], ("resp",))
+    run = store.addRun()
+    store.set(run, "vdb1", "resp", 1.0)
+    store.set(run, "vdb2", "resp", 3.0)
+    return store
+
+def test_missing_values():
+    store = makeStore()
+    assert store.get(1, "vdb3", "resp") is None
+    assert not store.isPresent(1, "vdb3", "resp")
+    assert store.get(1, "vdb1", "rate") is None
+    with pytest.raises(IndexError):
+        store.get(2, "vdb1", "resp")
+
+def test_history_and_new_metrics():
+    store = makeStore()
+    run = store.addRun()
+    store.set(run, "vdb1", "rate", 500)
+    assert store.history("vdb1", "resp") == [1.0, None]
+    assert store.history("vdb1", "rate") == [None, 500.0]
+    assert store.history("vdb2", "queue_depth") == [None, None]
+
+def test_set_row_skips_text():
+    store = makeStore()
+    store.setRow(1, "vdb3", {"Run": "rd1", "Interval": "avg_2-10",
+        "resp": "2.0", "resp_max": "n/a"})
+    assert store.get(1, "vdb3", "resp") == 2.0
+    assert store.get(1, "vdb3", "resp_max") is None
+    assert "Run" not in store.metrics()
+
+def test_aggregates():
+    store = makeStore()
+    assert store.total(1, "resp") == 4.0
+    assert store.mean(1, "resp") == 2.0
+    assert store.mean(1, "resp", ["vdb2", "vdb3"]) == 3.0
+    assert store.mean(1, "resp", ["vdb3"]) is None
+    assert store.percentile(1, "resp", 50) == 2.0
+    assert store.percentile(1, "resp", 100) == 3.0
@@ -0,0 +1,52 @@
+import pytest
+
+from vdbconfig import vdbconfig
+from vdbsweep import vdbsweep
+
+def test_parse_grid_spec():
+    assert vdbsweep.parseGridSpec("threads=1,4,16") == ("threads",
+        ["1", "4", "16"])
+
+def test_parse_grid_spec_accepts_loop_names_and_parentheses():
+    assert vdbsweep.parseGridSpec(" ForXfersize = (4k, 64k) ") == ("xfersize",
+        ["4k", "64k"])
+
+def test_parse_grid_spec_drops_duplicates_and_blanks():
+    assert vdbsweep.parseGridSpec("rdpct=0,,70,0,100,") == ("rdpct",
+        ["0", "70", "100"])
+
+@pytest.mark.parametrize("spec", ["threads", "threads=", "threads=,",
+    "iorate=100,200", "=1,2"])
+def test_parse_grid_spec_rejects_bad_specs(spec):
+    with pytest.raises(Exception, match="bad sweep"):
+        vdbsweep.parseGridSpec(spec)
+
+def test_points_and_rounds():
+    grid = [("threads", ["1", "4"]), ("xfersize", ["4k", "64k"])]
+    points = [("1", "4k"), ("1", "64k"), ("4", "4k"), ("4", "64k")]
+    assert vdbsweep.Sweep(grid).points() == points
+    assert vdbsweep.Sweep(grid).rounds() == [points]
+    assert vdbsweep.Sweep(grid, vdbsweep.MODE_POINTS).rounds() == [[p]
+        for p in points]
+    with pytest.raises(Exception, match="unknown sweep mode"):
+        vdbsweep.Sweep(grid, "bogus")
+
+def test_apply_sets_loops():
+    config = vdbconfig.VdbConfig("wd=wd1,sd=sd1,xfersize=4k\n"
+        "rd=rd1,wd=wd1,iorate=max,threads=8\n")
+    sweep = vdbsweep.Sweep([("threads", ["1", "4"])])
+    swept = sweep.apply(config, sweep.points())
+    assert swept.rds()[0].get("forthreads") == "(1,4)"
+    assert not swept.rds()[0].has("threads")
+    assert config.rds()[0].get("threads") == "8"
+
+def test_split_rows_matches_points():
+    sweep = vdbsweep.Sweep([("xfersize", ["4k", "64k"])])
+    rows = [{"xfersize": "65536"}, {"xfersize": "4096"}]
+    assert sweep.splitRows(rows, sweep.points()) == [(("64k",), rows[0]),
+        (("4k",), rows[1])]
+
+def test_value_matches():
+    assert vdbsweep.valueMatches("xfersize", "64k", "65536")
+    assert not vdbsweep.valueMatches("threads", "4", "8")
+    assert vdbsweep.valueMatches("threads", "4", "n/a")
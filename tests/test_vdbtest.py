@@ -0,0 +1,99 @@
+import vdbtest
+
+def test_batch_rates_include_chosen_rate():
+    for steps in range(2, 7):
+        rates = vdbtest.batchRates(1000, steps)
+        assert len(rates) == steps
+        assert 1000 in rates
+        assert rates == sorted(rates)
+        assert len(set(rates)) == steps
+        assert min(rates) >= 500 and max(rates) <= 1500
+
+def test_batch_rates_stay_inside_bracket():
+    rates = vdbtest.batchRates(1000, 4, 900, 1100)
+    assert 1000 in rates
+    assert all(900 < rate < 1100 for rate in rates)
+
+def test_batch_rates_narrow_with_bracket():
+    wide = vdbtest.batchRates(1000, 5)
+    narrow = vdbtest.batchRates(1000, 5, 950, 1020)
+    assert max(narrow) - min(narrow) < max(wide) - min(wide)
+
+def test_batch_rates_minimum():
+    assert min(vdbtest.batchRates(1, 4)) >= 1
+
+class FakeTestInfo:
+    def __init__(self, rows):
+        self.rows = rows
+        self.names = list(rows)
+        self.runCount = 1
+        self.store = self
+
+    def getLatest(self, name, metric):
+        return self.rows[name][metric]
+
+    def total(self, run, metric, names):
+        return sum(self.rows[name][metric] for name in names)
+
+    def mean(self, run, metric, names):
+        return self.total(run, metric, names) / len(names)
+
+def makeTestInfo():
+    return FakeTestInfo({
+        "vdb1": {vdbtest.REQUESTED_IOPS: 100, vdbtest.ACHIEVED_IOPS: 100.0,
+            vdbtest.LATENCY: 1.5},
+        "vdb2": {vdbtest.REQUESTED_IOPS: 200, vdbtest.ACHIEVED_IOPS: 190.0,
+            vdbtest.LATENCY: 2.5},
+    })
+
+def readLog(path):
+    with open(path, newline="") as f:
+        return f.read().splitlines()
+
+def test_log_appends_rows_each_round(tmp_path):
+    path = str(tmp_path / "log.csv")
+    logWriter = vdbtest.LogWriter(path)
+    logWriter.writeHeader()
+    assert readLog(path) == ["run #,configuration,requested IOPS,achieved IOPS,latency (ms)"]
+    testInfo = makeTestInfo()
+    logWriter.updateLog(testInfo, 1)
+    assert readLog(path)[1:] == ["1,vdb1,100,100.0,1.5", ",vdb2,200,190.0,2.5",
+        ",total/average,300,290.0,2.0"]
+    logWriter.updateLog(testInfo, 2)
+    assert len(readLog(path)) == 7
+    assert logWriter.pending.getvalue() == ""
+    logWriter.logSignOff("done")
+    logWriter.close()
+    assert readLog(path)[-2:] == ["", "done"]
+    assert not (tmp_path / ("log.csv" + vdbtest.LOG_TEMP_SUFFIX)).exists()
+
+def test_log_sync_on_exit(tmp_path):
+    path = str(tmp_path / "log.csv")
+    logWriter = vdbtest.LogWriter(path, syncPolicy=vdbtest.LOG_SYNC_EXIT)
+    logWriter.writeHeader()
+    logWriter.updateLog(makeTestInfo(), 1)
+    assert len(readLog(path)) == 1
+    logWriter.close()
+    assert len(readLog(path)) == 4
+
+def test_log_replaces_old_log(tmp_path):
+    path = tmp_path / "log.csv"
+    path.write_text("old\nlog\n")
+    logWriter = vdbtest.LogWriter(str(path))
+    logWriter.writeHeader()
+    logWriter.close()
+    assert readLog(str(path)) == ["run #,configuration,requested IOPS,achieved IOPS,latency (ms)"]
+
+def test_batched_log_has_step_column(tmp_path):
+    path = str(tmp_path / "log.csv")
+    logWriter = vdbtest.LogWriter(path, batched=True)
+    logWriter.writeHeader()
+    testInfo = makeTestInfo()
+    logWriter.updateLog(testInfo, 3, step=0)
+    logWriter.updateLog(testInfo, 3, step=1)
+    logWriter.close()
+    rows = readLog(path)
+    assert rows[0].startswith("run #,step,configuration")
+    assert rows[1] == "3,1,vdb1,100,100.0,1.5"
+    assert rows[2] == ",,vdb2,200,190.0,2.5"
+    assert rows[4] == "3,2,vdb1,100,100.0,1.5"
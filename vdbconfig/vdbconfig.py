@@ -6,14 +6,458 @@
 # Author: Ramon A. Lovato (ramonalovato.com)
 # For: DeepStorage, LLC (deepstorage.net)
 #
+# A Vdbench parameter file is a list of lines, each either a comment (starting
+# with "/", "#" or "*"), blank, or a comma-separated list of key=value
+# parameters. Values may be parenthesized lists that contain commas of their
+# own, e.g. "range=(0,1.5)". The first parameter of a definition names its
+# kind and the thing defined ("sd=sd1", "wd=wd1", "rd=run1"); lines that don't
+# start with a definition keyword hold general parameters ("dedupratio=4").
+#
+# VdbConfig holds a parsed file as a list of lines, so it can be changed in
+# memory and written back out: lines that weren't changed are written exactly
+# as they were read. loadConfig parses each file only once, and again only if
+# it has changed on disk since.
+#
+# Template renders one base profile into a config per target, with the
+# parameters that differ between targets (lun, iorate, threads, ...) taken
+# from a table. Only the configs whose parameters have changed are written.
+#
 
 import argparse
+import csv
+import os
 import os.path
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Keywords that start a definition.
+DEFINITION_KINDS = ("hd", "sd", "wd", "rd", "fsd", "fwd", "rg", "dv", "include")
+GENERAL = "general"
+COMMENT_REGEX = re.compile(r"[\/\#\*]")
+# Characters that matter when splitting a line into parameters: commas
+# separate them, except inside (possibly nested) parentheses.
+SEPARATOR_REGEX = re.compile(r"[(),]")
+IORATE = "iorate"
+# Run parameter that has Vdbench format the storage before measuring, and
+# the value that turns it off.
+FORMAT = "format"
+FORMAT_OFF = "no"
+# Template table column holding the target name.
+NAME_COLUMN = "name"
+DEFAULT_WORKERS = 16
+
+# One line of parameters. params is a list of [key, value] pairs in file
+# order, with value None for a bare token that has no "=". Copies share their
+# params until one of them is changed.
+class Definition:
+    # Initializer. text is the line as read, without the line ending.
+    def __init__(self, text, suffix=""):
+        self.text = text
+        self.suffix = suffix
+        self.params = [splitParam(t) for t in splitTokens(text)]
+        self.shared = False
+
+    # Kind of definition ("sd", "wd", "rd", ...), or GENERAL.
+    @property
+    def kind(self):
+        key = self.params[0][0].strip().lower() if self.params else ""
+        return key if key in DEFINITION_KINDS else GENERAL
+
+    # Name of the thing defined (e.g. "wd1"), or None for general lines.
+    @property
+    def name(self):
+        return self.params[0][1] if self.kind != GENERAL else None
+
+    # Parameters as a dictionary. For a repeated key, the last value wins.
+    def asDict(self):
+        return dict((k.strip(), v) for k, v in self.params)
+
+    # Check whether the line has a parameter.
+    def has(self, key):
+        return any(k.strip() == key for k, _ in self.params)
+
+    # Get the value of a parameter, or default if it isn't there.
+    def get(self, key, default=None):
+        for k, v in self.params:
+            if k.strip() == key:
+                return v
+        return default
+
+    # Set every occurrence of a parameter, or append it if it isn't there.
+    def set(self, key, value):
+        value = str(value)
+        matches = [p for p in self.params if p[0].strip() == key]
+        if matches and all(p[1] == value for p in matches):
+            return
+        self.unshare()
+        if matches:
+            for param in self.params:
+                if param[0].strip() == key:
+                    param[1] = value
+        else:
+            self.params.append([key, value])
+        self.text = None
+
+    # Remove every occurrence of a parameter. Returns True if there was one.
+    def remove(self, key):
+        if not self.has(key):
+            return False
+        self.unshare()
+        self.params = [p for p in self.params if p[0].strip() != key]
+        self.text = None
+        return True
+
+    # An independent copy.
+    def copy(self):
+        other = Definition.__new__(Definition)
+        other.text = self.text
+        other.suffix = self.suffix
+        other.params = self.params
+        other.shared = self.shared = True
+        return other
+
+    # Give this line its own params before changing them.
+    def unshare(self):
+        if self.shared:
+            self.params = [list(p) for p in self.params]
+            self.shared = False
+
+    # The line as it should be written, without the line ending.
+    def render(self):
+        if self.text is not None:
+            return self.text
+        return ",".join(k if v is None else "{}={}".format(k, v)
+            for k, v in self.params)
+
+# A whole parameter file. lines holds, in order, a string for every comment
+# or blank line (including its line ending) and a Definition for every other
+# line.
+class VdbConfig:
+    # Initializer.
+    def __init__(self, text=""):
+        self.lines = []
+        for line in text.splitlines(True):
+            body = line.rstrip("\r\n")
+            if not body.strip() or COMMENT_REGEX.match(body):
+                self.lines.append(line)
+            else:
+                self.lines.append(Definition(body, line[len(body):]))
+
+    # All definitions, or only those of the given kind (GENERAL for general
+    # parameter lines).
+    def definitions(self, kind=None):
+        return [l for l in self.lines if isinstance(l, Definition)
+            and (kind is None or l.kind == kind)]
+
+    # The definition of the given kind and name, or None.
+    def find(self, kind, name):
+        for d in self.definitions(kind):
+            if d.name == name:
+                return d
+        return None
+
+    # General parameters as a dictionary.
+    def general(self):
+        params = {}
+        for d in self.definitions(GENERAL):
+            params.update(d.asDict())
+        return params
+
+    # Storage, workload and run definitions.
+    def sds(self):
+        return self.definitions("sd")
+
+    def wds(self):
+        return self.definitions("wd")
+
+    def rds(self):
+        return self.definitions("rd")
+
+    # Get the first value of a parameter anywhere in the file, or default.
+    def getParam(self, key, default=None):
+        for d in self.definitions():
+            if d.has(key):
+                return d.get(key)
+        return default
+
+    # Set a parameter on every line that has it. Returns the number of lines
+    # changed.
+    def setParam(self, key, value):
+        count = 0
+        for d in self.definitions():
+            if d.has(key):
+                d.set(key, value)
+                count += 1
+        return count
+
+    # The IO rates (of the first "iorate" in the file) as a list of
+    # integers: one for "iorate=1000", or one per step for a list such as
+    # "iorate=(1000,2000,4000)", which Vdbench runs one after the other.
+    # Raises ValueError if there isn't one or it isn't a number.
+    def getIORates(self):
+        value = self.getParam(IORATE)
+        if value is None:
+            raise ValueError("no \"{}\" specified".format(IORATE))
+        return [int(v) for v in value.strip().strip("()").split(",")]
+
+    # The IO rate as an integer. For a list of rates, this is their mean.
+    def getIORate(self):
+        rates = self.getIORates()
+        return int(round(sum(rates) / len(rates)))
+
+    # Set the IO rate everywhere it's specified. rate may be a list of rates,
+    # one per step.
+    def setIORate(self, rate):
+        return self.setParam(IORATE, formatIORate(rate))
+
+    # The value of "format" (the first in the file), or None.
+    def getFormat(self):
+        return self.getParam(FORMAT)
+
+    # Set "format" everywhere it's specified, e.g. to FORMAT_OFF to skip
+    # formatting storage that has already been formatted.
+    def setFormat(self, value):
+        return self.setParam(FORMAT, value)
+
+    # Check whether Vdbench will format the storage before the run.
+    def isFormatting(self):
+        value = self.getFormat()
+        return value is not None and value.strip().lower() != FORMAT_OFF
+
+    # An independent copy that can be changed without affecting this one.
+    def copy(self):
+        other = VdbConfig()
+        other.lines = [l if isinstance(l, str) else l.copy() for l in self.lines]
+        return other
+
+    # The file's text.
+    def render(self):
+        return "".join(l if isinstance(l, str) else l.render() + l.suffix
+            for l in self.lines)
+
+# Cache of parsed files, by path: ((modification time, size), VdbConfig).
+cache = {}
+cacheLock = threading.Lock()
+
+# Get the parsed config at path. Each file is only read and parsed again if
+# its modification time or size has changed. The result is shared, so don't
+# change it; use its copy method to get one that can be changed.
+def loadConfig(path):
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with cacheLock:
+        entry = cache.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    with open(path, "r") as f:
+        config = VdbConfig(f.read())
+    with cacheLock:
+        cache[path] = (key, config)
+    return config
+
+# Write config to path, and remember it as the parsed contents of that path,
+# so it mustn't be changed afterwards.
+def saveConfig(config, path):
+    with open(path, "w") as f:
+        f.write(config.render())
+    rememberConfig(config, path)
+
+# Remember config as the parsed contents of path as it is now on disk, so the
+# next loadConfig doesn't parse it again.
+def rememberConfig(config, path):
+    stat = os.stat(path)
+    with cacheLock:
+        cache[path] = ((stat.st_mtime_ns, stat.st_size), config)
+
+# Forget the cached contents of path, e.g. after it has been moved.
+def forgetConfig(path):
+    with cacheLock:
+        cache.pop(path, None)
+
+# A base profile plus a table of per-target parameters. The table is a CSV
+# file with a "name" column naming each target (and so its config file) and
+# one column per parameter:
+#
+#   name,lun,iorate,sd.threads
+#   vdb1,/dev/sdb,1000,8
+#   vdb2,/dev/sdc,2000,
+#
+# A plain column ("lun") sets the parameter on every line of the profile that
+# already has it. A column of the form "kind.key" ("sd.threads") or
+# "name.key" ("sd2.lun") sets it on every definition of that kind or on the
+# named definition, adding it if it isn't there. Empty cells keep the value
+# in the base profile.
+class Template:
+    # Initializer. base is a VdbConfig; rows maps each target name to a
+    # dictionary of column -> value.
+    def __init__(self, base, rows, columns):
+        self.base = base
+        self.rows = rows
+        self.columns = list(columns)
+        # The last config rendered for each target, and for each target
+        # whose parameters have changed since, the columns that changed (None
+        # if it has never been rendered).
+        self.configs = {}
+        self.dirty = dict((name, None) for name in rows)
+
+    # Load the base profile and table from disk.
+    @classmethod
+    def load(cls, basePath, tablePath):
+        base = loadConfig(basePath)
+        rows = {}
+        with open(tablePath, "r", newline="") as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is None or NAME_COLUMN not in reader.fieldnames:
+                raise Exception("Template table {}: no \"{}\" column.".format(
+                    tablePath, NAME_COLUMN))
+            columns = [c for c in reader.fieldnames if c != NAME_COLUMN]
+            for row in reader:
+                name = (row.pop(NAME_COLUMN) or "").strip()
+                if not name:
+                    continue
+                if name in rows:
+                    raise Exception("Template table {}: target {} listed twice.".format(
+                        tablePath, name))
+                rows[name] = dict((k, v.strip()) for k, v in row.items()
+                    if k is not None and v is not None and v.strip())
+        return cls(base, rows, columns)
+
+    # Target names, in table order.
+    def names(self):
+        return list(self.rows)
+
+    # Get a target's value for a column, or None if it uses the base profile.
+    def get(self, name, column):
+        return self.rows[name].get(column)
+
+    # Change a target's value for a column (e.g. IORATE). The target's config
+    # is rewritten by the next renderAll, if the value differs.
+    def set(self, name, column, value):
+        value = str(value)
+        if self.rows[name].get(column) == value:
+            return
+        self.rows[name][column] = value
+        if column not in self.columns:
+            self.columns.append(column)
+        if name in self.configs:
+            self.dirty.setdefault(name, set()).add(column)
+
+    # A new VdbConfig for the named target.
+    def render(self, name):
+        config = self.base.copy()
+        for column in self.rows[name]:
+            self.apply(config, name, column)
+        return config
+
+    # Set one of a target's columns on config.
+    def apply(self, config, name, column):
+        value = self.rows[name][column]
+        kind, dot, key = column.rpartition(".")
+        if not dot:
+            count = config.setParam(key, value)
+        else:
+            targets = [d for d in config.definitions()
+                if d.kind == kind or (d.name == kind and d.kind != GENERAL)]
+            for d in targets:
+                d.set(key, value)
+            count = len(targets)
+        if count == 0:
+            raise Exception("Template: column \"{}\" for {} matches nothing in the base profile.".format(
+                column, name))
+
+    # Write the config of every target whose parameters have changed to
+    # directory/name, using up to workers threads for the file IO. A target
+    # that has been rendered before only has its changed columns applied
+    # again. The first time, a file that already has the right contents is
+    # left alone. Every config is rendered before any is written, so a bad
+    # table fails without writing anything. Returns the paths written.
+    def renderAll(self, directory, workers=DEFAULT_WORKERS):
+        jobs = []
+        for name, columns in self.dirty.items():
+            previous = self.configs.get(name)
+            if previous is None or columns is None:
+                config = self.render(name)
+            else:
+                config = previous.copy()
+                for column in columns:
+                    self.apply(config, name, column)
+            self.configs[name] = config
+            jobs.append((config, os.path.join(directory, name),
+                previous is None))
+        self.dirty = {}
+        if not jobs:
+            return []
+
+        def writeOne(job):
+            config, path, first = job
+            if first:
+                try:
+                    with open(path, "r") as f:
+                        if f.read() == config.render():
+                            rememberConfig(config, path)
+                            return None
+                except (FileNotFoundError, IsADirectoryError):
+                    pass
+            saveConfig(config, path)
+            return path
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+            return [p for p in pool.map(writeOne, jobs) if p is not None]
+
+    # Write the table, with any changes made by set, to path.
+    def saveTable(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([NAME_COLUMN] + self.columns)
+            for name, row in self.rows.items():
+                writer.writerow([name] + [row.get(c, "") for c in self.columns])
+
+# Format an IO rate, or a list of rates, as the value of an "iorate".
+def formatIORate(rate):
+    if isinstance(rate, (list, tuple)):
+        return "({})".format(",".join(str(r) for r in rate))
+    return str(rate)
+
+# Split a line into its parameters at the commas that aren't inside
+# parentheses, in a single pass that keeps track of the nesting depth.
+# Returns the parameters as strings.
+def splitTokens(line):
+    if "(" not in line and ")" not in line:
+        return line.split(",")
+    tokens = []
+    depth = 0
+    start = 0
+    for match in SEPARATOR_REGEX.finditer(line):
+        c = match.group()
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            if depth == 0:
+                raise Exception("Line {}: mismatched parentheses.".format(line))
+            depth -= 1
+        elif depth == 0:
+            tokens.append(line[start:match.start()])
+            start = match.end()
+    if depth != 0:
+        raise Exception("Line {}: mismatched parentheses.".format(line))
+    tokens.append(line[start:])
+    return tokens
+
+# Split a line into its parameters, each as a list of the parts between its
+# "="s, e.g. [key, value].
+def tokenize(line):
+    return [t.split("=") for t in splitTokens(line)]
+
+# Split a token into [key, value] at its first "=", with value None if there
+# is no "=".
+def splitParam(token):
+    key, sep, value = token.partition("=")
+    return [key, value if sep else None]
 
 def getArgs():
     parser = argparse.ArgumentParser(description="Clone VDbench config files, changing their IO rates.")
-    
+
     parser.add_argument("sourcePath", type=str,
         help="path to VDbench config file to clone and modify")
     parser.add_argument("destPath", type=str,
@@ -25,54 +469,14 @@ def getArgs():
 
     return args
 
-def tokenize(line):
-    tokens = []
-    parens = []
-    current = ""
-    for c in line:
-        if c == "," and len(parens) == 0:
-            tokens.append(current)
-            current = ""
-        else:
-            if c == "(":
-                parens.append(c)
-            elif c == ")":
-                if len(parens) == 0:
-                    raise Exception("Line {}: mismatched parentheses.".format(line))
-                parens.pop()
-            current += c
-    tokens.append(current)
-
-    if len(parens) != 0:
-        raise Exception("Line {}: mismatched parentheses.".format(line))
-
-    return [t.split("=") for t in tokens]
-
 def makeNewConfig(sourcePath, destPath, newIORate):
-    with open(sourcePath, "r") as inFile, open(destPath, "w") as outFile:
-        for line in inFile:
-            if re.match(r"[\/\#\*].*", line):
-                outFile.write(line)
-            else:
-                tokens = tokenize(line)
-                for i in range(len(tokens)):
-                    token = tokens[i]
-                    if len(token) < 1:
-                        continue
-                    if len(token) < 2:
-                        outFile.write(token[0])
-                    else:
-                        key = token[0]
-                        value = token[1]
-
-                        if key == "iorate":
-                            value = newIORate
-
-                        outFile.write("{key}={value}{sep}".format(key=key, value=value,
-                            sep=("" if i == len(tokens)-1 else ",")))
+    config = loadConfig(sourcePath).copy()
+    config.setIORate(newIORate)
+    saveConfig(config, destPath)
+
 def main():
     args = getArgs()
     makeNewConfig(args.sourcePath, args.destPath, args.newIORate)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
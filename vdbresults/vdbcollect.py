@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+#
+# vdbcollect.py - Vdbench Result Collection
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# Gathers the results of one round from every target's output directory,
+# reading the flatfiles concurrently, since on a shared NFS mount the time is
+# almost entirely spent waiting on I/O.
+#
+
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+from vdbresults import vdbflatfile
+from vdbresults import vdbhistogram
+
+DEFAULT_WORKERS = 16
+
+# Results for a single target in a single round. rate and resp are the
+# achieved IOPS and mean response time (ms); row holds every column of the
+# summary row as strings, keyed by flatfile column name. histogram is the
+# target's response time histogram, if it was read. latency is the response
+# time the target is judged by: a percentile from the histogram when one was
+# requested and available (fromHistogram is then True), otherwise resp.
+class TargetResult:
+    # Initializer.
+    def __init__(self, name, row, histogram=None, percentile=None):
+        self.name = name
+        self.row = row
+        self.histogram = histogram
+        try:
+            self.rate = float(row["rate"])
+            self.resp = float(row["resp"])
+        except (KeyError, ValueError):
+            raise Exception("Error: results for {} have no usable rate and resp columns.".format(
+                name))
+        self.latency = self.resp
+        self.fromHistogram = False
+        if histogram is not None and percentile is not None:
+            value = histogram.percentile(percentile)
+            if value is not None:
+                self.latency = value
+                self.fromHistogram = True
+
+# Results for every target in a single round. results maps target names to
+# TargetResults; errors maps the names of targets whose results couldn't be
+# read to the exception that occurred.
+class RoundResults:
+    # Initializer.
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    # Names of targets with results, in sorted order.
+    def names(self):
+        return sorted(self.results.keys())
+
+    # Get the TargetResult for the named target, or None.
+    def get(self, name):
+        return self.results.get(name)
+
+    # Merge the histograms of the named targets (default all), so fleet-wide
+    # percentiles can be computed. Returns None if none of them has one.
+    def mergedHistogram(self, names=None):
+        names = self.names() if names is None else names
+        return vdbhistogram.mergeHistograms([self.results[n].histogram
+            for n in names if n in self.results
+            and self.results[n].histogram is not None])
+
+# Read the results for every output directory in folders, using up to workers
+# threads. Targets named in earlyResults (a dictionary of name to row
+# dictionary, from a round that was stopped early) use those rows instead of
+# their flatfiles. Target names are the directory base names.
+#
+# Targets named in records (a dictionary of name to the results record
+# extracted by the NetJobs agent, with "row" and "histogram" entries) use the
+# record instead of reading anything from the output directory, so only the
+# rest touch the file share.
+#
+# The targets are those in folders, earlyResults and records together, so a
+# target whose results came from the agent or the early stop is included even
+# if its output directory isn't visible on the share yet.
+#
+# If percentile (0-100) is given, each target's histogram.html is read as
+# well and its latency is that percentile. Targets without a usable
+# histogram, including those in earlyResults, fall back to the mean.
+def collectResults(folders, earlyResults=None, workers=DEFAULT_WORKERS,
+        percentile=None, records=None):
+    earlyResults = earlyResults or {}
+    records = records or {}
+    roundResults = RoundResults()
+
+    targets = dict((os.path.basename(folder), folder) for folder in folders)
+    for name in list(earlyResults.keys()) + list(records.keys()):
+        targets.setdefault(name, None)
+
+    def readTarget(item):
+        name, folder = item
+        try:
+            histogram = None
+            if name in earlyResults:
+                row = earlyResults[name]
+            elif name in records:
+                row = records[name]["row"]
+                if percentile is not None and records[name].get("histogram"):
+                    histogram = vdbhistogram.fromBuckets(records[name]["histogram"])
+            else:
+                row = vdbflatfile.readLastRow(findFlatFile(folder))
+                if percentile is not None:
+                    histogram = readHistogram(folder)
+            return name, TargetResult(name, row, histogram, percentile), None
+        except Exception as e:
+            return name, None, e
+
+    if len(targets) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as pool:
+            for name, result, error in pool.map(readTarget, targets.items()):
+                if error is None:
+                    roundResults.results[name] = result
+                else:
+                    roundResults.errors[name] = error
+
+    return roundResults
+
+# Read every summary row (see vdbflatfile.readSummaryRows) of every output
+# directory in folders, using up to workers threads. Returns two
+# dictionaries keyed by target name: the lists of rows, and the exceptions
+# for targets whose flatfile couldn't be read.
+def collectSummaryRows(folders, workers=DEFAULT_WORKERS):
+    rows = {}
+    errors = {}
+
+    def readTarget(folder):
+        name = os.path.basename(folder)
+        try:
+            return name, vdbflatfile.readSummaryRows(findFlatFile(folder)), None
+        except Exception as e:
+            return name, None, e
+
+    if len(folders) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(folders)))) as pool:
+            for name, result, error in pool.map(readTarget, folders):
+                if error is None:
+                    rows[name] = result
+                else:
+                    errors[name] = error
+
+    return rows, errors
+
+# Read the histogram.html in the specified directory, or None if it's missing
+# or unreadable.
+def readHistogram(parentDir):
+    try:
+        return vdbhistogram.readHistogram(
+            os.path.join(parentDir, vdbhistogram.HISTOGRAM_NAME))
+    except (IOError, ValueError):
+        return None
+
+# Find absolute path to flatfile.html file in specified directory.
+def findFlatFile(parentDir):
+    path = os.path.join(parentDir, vdbflatfile.FLATFILE_NAME)
+    if os.path.isfile(path):
+        return path
+    # Didn't find.
+    raise Exception(
+        "Error: directory {} does not contain the file flatfile.html.".format(
+            parentDir))
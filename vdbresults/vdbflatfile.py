@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+#
+# vdbflatfile.py - Vdbench flatfile.html Parser
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# A flatfile.html consists of a comment block (lines starting with "*" or an
+# HTML tag), a single line of whitespace-separated column names, and one row
+# per reporting interval. Each run definition ends with a summary row whose
+# Interval column starts with "avg_".
+#
+# Nothing here reads a whole file into memory: the header is found by reading
+# forward from the start, the final row by seeking backwards from the end, and
+# interval rows are streamed one line at a time.
+#
+
+import re
+
+FLATFILE_NAME = "flatfile.html"
+BLOCK_SIZE = 4096
+SUMMARY_PREFIX = "avg_"
+FORMAT_RUN_PREFIX = "format"
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+# Incremental reader for a flatfile.html that Vdbench is still writing.
+# Remembers how far it has read, so each call to readRows only returns the
+# interval rows added since the last call. The header is only read once.
+class FlatFileTail:
+    # Initializer.
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b""
+        self.keys = None
+
+    # Read any complete rows appended since the last call. Returns a list of
+    # dictionaries keyed by the column names. Summary rows and format runs
+    # are skipped.
+    def readRows(self):
+        try:
+            with open(self.path, "rb") as f:
+                if self.keys is None:
+                    try:
+                        self.keys, self.offset = readHeaderFrom(f)
+                    except ValueError:
+                        # Header not written yet.
+                        return []
+                f.seek(self.offset)
+                data = f.read()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return []
+
+        lines = (self.partial + data).split(b"\n")
+        # The last element is either empty or a line still being written.
+        self.partial = lines.pop()
+
+        rows = []
+        for line in lines:
+            row = parseRow(self.keys, line)
+            if isIntervalRow(row):
+                rows.append(row)
+        return rows
+
+# Read the column names from the specified flatfile. Raises ValueError if the
+# file has no header.
+def readHeader(path):
+    with open(path, "rb") as f:
+        keys, _ = readHeaderFrom(f)
+    return keys
+
+# Helper for readHeader. Reads forward from the start of an open binary file
+# and returns the column names and the offset of the first line after them.
+def readHeaderFrom(f):
+    f.seek(0)
+    offset = 0
+    for line in f:
+        offset += len(line)
+        text = line.decode("UTF-8", "replace").strip()
+        if not text or isCommentLine(text):
+            continue
+        # Only trust a complete line, in case Vdbench is mid-write.
+        if not line.endswith(b"\n"):
+            break
+        return WHITESPACE_REGEX.split(text), offset
+    raise ValueError("Unable to locate result keys.")
+
+# Read the last data row of the specified flatfile by seeking backwards from
+# the end, and return it as a dictionary keyed by column name. For a
+# completed run this is the summary ("avg_") row; for an interrupted run it
+# is the last complete interval.
+def readLastRow(path):
+    with open(path, "rb") as f:
+        try:
+            keys, headerEnd = readHeaderFrom(f)
+        except ValueError:
+            raise Exception("Unable to locate result keys. File {} is invalid.".format(
+                path))
+        line = readLastLineFrom(f, headerEnd)
+    row = parseRow(keys, line) if line is not None else None
+    if row is None:
+        raise Exception("File {} contains no results.".format(path))
+    return row
+
+# Helper for readLastRow. Returns the last complete, non-blank, non-comment
+# line at or after offset start in an open binary file, reading backwards one
+# block at a time, or None if there isn't one.
+def readLastLineFrom(f, start):
+    f.seek(0, 2)
+    position = f.tell()
+    data = b""
+    trailing = True
+    while position > start:
+        step = min(BLOCK_SIZE, position - start)
+        position -= step
+        f.seek(position)
+        data = f.read(step) + data
+        lines = data.split(b"\n")
+        # A last line without a newline is still being written. It may span
+        # more than one block.
+        if trailing:
+            trailing = len(lines) == 1
+            lines[-1] = b""
+        # Unless we've reached the start, the first piece may be a fragment.
+        complete = lines if position == start else lines[1:]
+        for line in reversed(complete):
+            text = line.decode("UTF-8", "replace").strip()
+            if text and not isCommentLine(text):
+                return line
+        # Keep only the fragment; everything after it was blank or comments.
+        data = lines[0]
+    return None
+
+# Stream the interval rows of the specified flatfile as dictionaries keyed by
+# column name, one line at a time. Summary rows are skipped unless
+# includeSummary is set; format runs are always skipped.
+def iterRows(path, includeSummary=False):
+    with open(path, "rb") as f:
+        try:
+            keys, headerEnd = readHeaderFrom(f)
+        except ValueError:
+            return
+        f.seek(headerEnd)
+        for line in f:
+            row = parseRow(keys, line)
+            if isIntervalRow(row) or (includeSummary and isSummaryRow(row)):
+                yield row
+
+# Read every summary row of the specified flatfile, in file order. A run
+# definition that steps through several settings (for-loops such as
+# "forthreads=", or a list of IO rates) has one summary row per step.
+def readSummaryRows(path):
+    return [row for row in iterRows(path, includeSummary=True)
+        if isSummaryRow(row)]
+
+# Split a raw line into a dictionary keyed by column name. Returns None for
+# blank lines, comments, and lines with the wrong number of columns.
+def parseRow(keys, line):
+    if isinstance(line, bytes):
+        line = line.decode("UTF-8", "replace")
+    text = line.strip()
+    if not text or isCommentLine(text):
+        return None
+    values = WHITESPACE_REGEX.split(text)
+    if len(values) != len(keys):
+        return None
+    return dict(zip(keys, values))
+
+# Check whether a parsed row is a regular interval row of a measured run.
+def isIntervalRow(row):
+    return (row is not None and row.get("Interval", "").isdigit()
+        and not row.get("Run", "").startswith(FORMAT_RUN_PREFIX))
+
+# Check whether a parsed row is a run's summary row.
+def isSummaryRow(row):
+    return (row is not None
+        and row.get("Interval", "").startswith(SUMMARY_PREFIX)
+        and not row.get("Run", "").startswith(FORMAT_RUN_PREFIX))
+
+# Comment lines start with "*"; HTML tags such as <pre> start with "<".
+def isCommentLine(text):
+    return text.startswith("*") or text.startswith("<")
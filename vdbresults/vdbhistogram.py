@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+#
+# vdbhistogram.py - Vdbench Histogram Parser
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# Vdbench writes response time histograms to histogram.html (all I/O) and
+# to one *.histogram.html per SD and WD. Each run definition gets three
+# sections, "Reads and writes:", "Reads:" and "Writes:", each a table of
+# buckets:
+#
+#     min(ms) <     max(ms)        count       %%    cum%%  ...
+#       0.200 <       0.400        7,543  12.5220  12.5220  ++++++
+#    2000.000 <         max            0   0.0000 100.0000  -------
+#
+# Since every target uses the same bucket boundaries, histograms from
+# different targets can be merged by adding their counts, which gives exact
+# fleet-wide percentiles (up to the bucket resolution), unlike averaging
+# per-target percentiles.
+#
+
+import math
+import re
+
+HISTOGRAM_NAME = "histogram.html"
+READS_AND_WRITES = "Reads and writes"
+READS = "Reads"
+WRITES = "Writes"
+SECTIONS = (READS_AND_WRITES, READS, WRITES)
+OPEN_BUCKET = "max"
+BUCKET_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*<\s*(\d+(?:\.\d+)?|max)\s+([\d,]+)\s")
+
+# A response time histogram. bounds is a list of (min, max) tuples in ms,
+# with max = infinity for the open-ended last bucket; counts holds the number
+# of I/Os in each bucket.
+class Histogram:
+    # Initializer.
+    def __init__(self, bounds, counts):
+        if len(bounds) != len(counts):
+            raise ValueError("Histogram has {} buckets but {} counts.".format(
+                len(bounds), len(counts)))
+        self.bounds = list(bounds)
+        self.counts = list(counts)
+
+    # Total number of I/Os.
+    def total(self):
+        return sum(self.counts)
+
+    # Return a new histogram with the counts of this one and other added
+    # together. Both must have the same buckets.
+    def merge(self, other):
+        if self.bounds != other.bounds:
+            raise ValueError("Unable to merge histograms with different buckets.")
+        return Histogram(self.bounds,
+            [a + b for a, b in zip(self.counts, other.counts)])
+
+    # Response time (ms) below which p percent (0-100) of I/Os completed,
+    # interpolating linearly within the bucket that contains it. Returns the
+    # lower bound for the open-ended last bucket, and None if the histogram
+    # is empty.
+    def percentile(self, p):
+        total = self.total()
+        if total == 0:
+            return None
+        rank = total * p / 100.0
+        cumulative = 0
+        for (low, high), count in zip(self.bounds, self.counts):
+            if count > 0 and cumulative + count >= rank:
+                if math.isinf(high):
+                    return low
+                return low + (high - low) * max(rank - cumulative, 0) / count
+            cumulative += count
+        # Only reachable for p > 100.
+        low, high = self.bounds[-1]
+        return low if math.isinf(high) else high
+
+# Read a histogram section from the specified file. A file covering several
+# run definitions has one section of each kind per run; the last one is
+# returned, to match the flatfile's final summary row. Raises ValueError if
+# the file has no such section.
+def readHistogram(path, section=READS_AND_WRITES):
+    if section not in SECTIONS:
+        raise ValueError("Unknown histogram section \"{}\".".format(section))
+    title = section + ":"
+    histogram = None
+    bounds = None
+    counts = None
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            text = line.strip()
+            if text in (s + ":" for s in SECTIONS):
+                # A new section ends the current one.
+                if bounds:
+                    histogram = Histogram(bounds, counts)
+                bounds, counts = ([], []) if text == title else (None, None)
+                continue
+            if bounds is None:
+                continue
+            match = BUCKET_REGEX.match(line)
+            if match:
+                low, high, count = match.groups()
+                bounds.append((float(low),
+                    float("inf") if high == OPEN_BUCKET else float(high)))
+                counts.append(int(count.replace(",", "")))
+    if bounds:
+        histogram = Histogram(bounds, counts)
+    if histogram is None:
+        raise ValueError("File {} has no \"{}\" histogram.".format(path, section))
+    return histogram
+
+# Build a histogram from a list of [min, max, count] buckets, with max None
+# for the open-ended last bucket, as extracted by NetJobsAgent.
+def fromBuckets(buckets):
+    return Histogram([(float(low), float("inf") if high is None else float(high))
+        for low, high, _ in buckets], [int(count) for _, _, count in buckets])
+
+# Merge a list of histograms into one. Returns None for an empty list.
+def mergeHistograms(histograms):
+    merged = None
+    for histogram in histograms:
+        merged = histogram if merged is None else merged.merge(histogram)
+    return merged
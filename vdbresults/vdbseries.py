@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+#
+# vdbseries.py - Interval Time-Series Storage
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# Keeps every interval row of every target and every run in a compact binary
+# file, so warm-up behavior and latency spikes can be examined after the
+# Vdbench output has been archived, without re-reading any HTML.
+#
+# A single Vdbench run can hold several steps: one per run definition, and
+# one per setting its for-loops or IO rate list go through. Each step numbers
+# its intervals from 1 again, so intervals are stored per step, numbered from
+# 0 in the order Vdbench ran them.
+#
+# Two files are written:
+#
+#   PATH        Data file. An 8-byte magic number, then one block per
+#               (run, target, step): fixed-size records packed as
+#               RECORD_PREFIX (interval number) followed by one little-endian
+#               double per column in the index's column list. Missing values
+#               are NaN.
+#   PATH.idx    Index (JSON). The column list, the target names, and for each
+#               block its run, target, step, Vdbench run definition name
+#               ("rd"), byte offset, and first and last interval. Rewritten
+#               atomically after each run.
+#
+
+import json
+import math
+import os
+import os.path
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from vdbresults import vdbflatfile
+
+MAGIC = b"VDBTS\x00\x01\x00"
+INDEX_SUFFIX = ".idx"
+RECORD_PREFIX = "<I"
+DEFAULT_WORKERS = 16
+SERIES_COLUMNS = ("reqrate", "rate", "MB/sec", "bytes/io", "read%", "resp",
+    "read_resp", "write_resp", "resp_max", "resp_std", "queue_depth",
+    "cpu_used", "cpu_user", "cpu_kernel", "cpu_wait", "cpu_idle")
+
+# Writes interval data to a new time-series file, replacing any existing one.
+class SeriesWriter:
+    # Initializer.
+    def __init__(self, path, columns=SERIES_COLUMNS):
+        self.path = path
+        self.indexPath = path + INDEX_SUFFIX
+        self.columns = list(columns)
+        self.names = []
+        self.blocks = []
+        self.file = open(self.path, "wb")
+        self.file.write(MAGIC)
+        self.record = struct.Struct(RECORD_PREFIX + "d" * len(self.columns))
+
+    # Split flatfile rows (interval rows, and optionally summary rows) into
+    # steps and pack each into a block of records. A step ends at a summary
+    # row, or where the run definition changes or the interval numbers start
+    # again. Returns a list of (run definition name, data, intervals), one
+    # per step.
+    def packSteps(self, rows):
+        steps = []
+        current = []
+        for row in rows:
+            if vdbflatfile.isSummaryRow(row):
+                if current:
+                    steps.append(current)
+                current = []
+                continue
+            if current and (row.get("Run") != current[-1].get("Run")
+                    or int(row["Interval"]) <= int(current[-1]["Interval"])):
+                steps.append(current)
+                current = []
+            current.append(row)
+        if current:
+            steps.append(current)
+        return [(step[0].get("Run"),) + self.pack(step) for step in steps]
+
+    # Pack flatfile interval rows into a block of records.
+    def pack(self, rows):
+        data = bytearray()
+        intervals = []
+        for row in rows:
+            interval = int(row["Interval"])
+            values = [toFloat(row.get(c)) for c in self.columns]
+            data += self.record.pack(interval, *values)
+            intervals.append(interval)
+        return bytes(data), intervals
+
+    # Append a packed block for the named target, run and step, with the
+    # name of the run definition it came from, if known.
+    def writeBlock(self, run, name, data, intervals, step=0, rd=None):
+        if len(intervals) == 0:
+            return
+        if name not in self.names:
+            self.names.append(name)
+        offset = self.file.seek(0, 2)
+        self.file.write(data)
+        self.blocks.append({
+            "run": run,
+            "target": self.names.index(name),
+            "step": step,
+            "rd": rd,
+            "offset": offset,
+            "count": len(intervals),
+            "first": intervals[0],
+            "last": intervals[-1],
+        })
+
+    # Make the data written so far durable and readable, then rewrite the
+    # index to cover it.
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        temp = self.indexPath + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"columns": self.columns, "names": self.names,
+                "blocks": self.blocks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.indexPath)
+
+    # Close the data file.
+    def close(self):
+        self.commit()
+        self.file.close()
+
+# Reads a time-series file written by SeriesWriter.
+class SeriesReader:
+    # Initializer.
+    def __init__(self, path):
+        self.path = path
+        index = readIndex(path + INDEX_SUFFIX)
+        self.columns = index["columns"]
+        self.names = index["names"]
+        self.blocks = dict(((b["run"], self.names[b["target"]],
+            b.get("step", 0)), b) for b in index["blocks"])
+        self.record = struct.Struct(RECORD_PREFIX + "d" * len(self.columns))
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("Error: {} is not a vdbtest time-series file.".format(
+                    path))
+
+    # Sorted list of runs with data.
+    def runs(self):
+        return sorted(set(key[0] for key in self.blocks.keys()))
+
+    # Target names with data for the given run, or for any run.
+    def targets(self, run=None):
+        keys = set(key[:2] for key in self.blocks.keys())
+        return [name for name in self.names
+            if run is None or (run, name) in keys]
+
+    # The steps of one target in one run, as a list of the run definition
+    # name of each (None if unknown), indexed by step.
+    def steps(self, run, name):
+        blocks = sorted((key[2], b) for key, b in self.blocks.items()
+            if key[:2] == (run, name))
+        return [b.get("rd") for _, b in blocks]
+
+    # Read every interval of one target in one run and step. Returns a list
+    # of (interval, values) tuples, where values is a dictionary keyed by
+    # column name with None for missing values.
+    def read(self, run, name, step=0):
+        block = self.blocks.get((run, name, step))
+        if block is None:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(block["offset"])
+            data = f.read(block["count"] * self.record.size)
+        return [self.unpack(r) for r in self.record.iter_unpack(data)]
+
+    # Read a single interval of one target in one run and step, or None.
+    def readInterval(self, run, name, interval, step=0):
+        block = self.blocks.get((run, name, step))
+        if block is None or not block["first"] <= interval <= block["last"]:
+            return None
+        # Intervals are normally consecutive, so try the direct position
+        # first and fall back to a scan.
+        position = interval - block["first"]
+        with open(self.path, "rb") as f:
+            if position < block["count"]:
+                f.seek(block["offset"] + position * self.record.size)
+                record = self.unpack(self.record.unpack(
+                    f.read(self.record.size)))
+                if record[0] == interval:
+                    return record[1]
+        for recordInterval, values in self.read(run, name, step):
+            if recordInterval == interval:
+                return values
+        return None
+
+    # Read one column of one target in one run and step as a list of
+    # (interval, value) tuples.
+    def readColumn(self, run, name, column, step=0):
+        return [(interval, values[column])
+            for interval, values in self.read(run, name, step)]
+
+    # Helper for read. Turns an unpacked record into (interval, values).
+    def unpack(self, record):
+        values = dict((c, None if math.isnan(v) else v)
+            for c, v in zip(self.columns, record[1:]))
+        return record[0], values
+
+# Read every output directory in folders and append all of their interval
+# rows to writer as the given run, one block per step, reading up to workers
+# flatfiles at once. Target names are the directory base names. Directories
+# without a readable flatfile are skipped. Returns the number of interval
+# rows written.
+def ingestRound(writer, run, folders, workers=DEFAULT_WORKERS):
+    def readTarget(folder):
+        path = os.path.join(folder, vdbflatfile.FLATFILE_NAME)
+        try:
+            return os.path.basename(folder), writer.packSteps(
+                vdbflatfile.iterRows(path, includeSummary=True))
+        except (IOError, ValueError):
+            return os.path.basename(folder), []
+
+    count = 0
+    if len(folders) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(folders)))) as pool:
+            for name, steps in pool.map(readTarget, folders):
+                for step, (rd, data, intervals) in enumerate(steps):
+                    writer.writeBlock(run, name, data, intervals, step, rd)
+                    count += len(intervals)
+    writer.commit()
+    return count
+
+# Load an index file.
+def readIndex(indexPath):
+    with open(indexPath, "r") as f:
+        return json.load(f)
+
+# Convert a flatfile value to a float, with NaN for anything non-numeric.
+def toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+#
+# vdbstore.py - Columnar Result Store
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# Holds every numeric result of a test, indexed by run x target x metric.
+# Each metric is its own column: a flat array of doubles laid out run-major
+# (all targets for run 1, then all targets for run 2, ...), plus a parallel
+# byte array marking which values are present. Appending a run extends every
+# column by one block, and per-run aggregates work on a single contiguous
+# slice.
+#
+# Run indexing goes from 1, to match vdbtest.
+#
+
+import math
+from array import array
+from itertools import compress
+
+# Flatfile columns that aren't numeric measurements.
+NON_NUMERIC_COLUMNS = ("tod", "Run", "Interval")
+
+class ResultStore:
+    # Initializer. names is the fixed list of targets; metrics is an optional
+    # list of metrics to create up front. More are added as they appear.
+    def __init__(self, names, metrics=()):
+        self.names = list(names)
+        self.nameIndex = dict((name, i) for i, name in enumerate(self.names))
+        self.values = {}
+        self.masks = {}
+        self.runCount = 0
+        for metric in metrics:
+            self.addMetric(metric)
+
+    # Number of targets, i.e. the block size of each run in a column.
+    def width(self):
+        return len(self.names)
+
+    # Names of all metrics stored so far.
+    def metrics(self):
+        return list(self.values.keys())
+
+    # Add a metric column, marked missing for all existing runs.
+    def addMetric(self, metric):
+        if metric not in self.values:
+            size = self.runCount * self.width()
+            self.values[metric] = array("d", [math.nan]) * size
+            self.masks[metric] = array("b", [0]) * size
+
+    # Start a new run and return its index. Every value starts out missing.
+    def addRun(self):
+        self.runCount += 1
+        blockValues = array("d", [math.nan]) * self.width()
+        blockMask = array("b", [0]) * self.width()
+        for metric in self.values:
+            self.values[metric].extend(blockValues)
+            self.masks[metric].extend(blockMask)
+        return self.runCount
+
+    # Offset of a (run, target) pair within a column.
+    def offset(self, run, name):
+        if not 1 <= run <= self.runCount:
+            raise IndexError("Run {} is out of range (1-{}).".format(
+                run, self.runCount))
+        return (run - 1) * self.width() + self.nameIndex[name]
+
+    # Store a single value.
+    def set(self, run, name, metric, value):
+        self.addMetric(metric)
+        i = self.offset(run, name)
+        self.values[metric][i] = float(value)
+        self.masks[metric][i] = 1
+
+    # Store every numeric column of a flatfile row. Values that don't parse
+    # as numbers (such as "n/a") are left missing.
+    def setRow(self, run, name, row):
+        for metric, value in row.items():
+            if metric in NON_NUMERIC_COLUMNS:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            self.set(run, name, metric, value)
+
+    # Get a single value, or None if it's missing.
+    def get(self, run, name, metric):
+        if metric not in self.values:
+            return None
+        i = self.offset(run, name)
+        return self.values[metric][i] if self.masks[metric][i] else None
+
+    # Check whether a value is present.
+    def isPresent(self, run, name, metric):
+        return metric in self.masks and bool(
+            self.masks[metric][self.offset(run, name)])
+
+    # Get the values of a metric for one target over every run, in run order,
+    # with None for missing values.
+    def history(self, name, metric):
+        if metric not in self.values:
+            return [None] * self.runCount
+        values = self.values[metric]
+        mask = self.masks[metric]
+        return [values[i] if mask[i] else None
+            for i in range(self.nameIndex[name], len(values), self.width())]
+
+    # Get the present values of a metric for one run, optionally limited to
+    # the given target names.
+    def runValues(self, run, metric, names=None):
+        if metric not in self.values or self.width() == 0:
+            return []
+        start = self.offset(run, self.names[0])
+        end = start + self.width()
+        mask = self.masks[metric][start:end]
+        if names is not None:
+            wanted = array("b", [0]) * self.width()
+            for name in names:
+                wanted[self.nameIndex[name]] = 1
+            mask = array("b", (m & w for m, w in zip(mask, wanted)))
+        return list(compress(self.values[metric][start:end], mask))
+
+    # Sum of a metric over the targets of one run.
+    def total(self, run, metric, names=None):
+        return math.fsum(self.runValues(run, metric, names))
+
+    # Mean of a metric over the targets of one run, or None if no values.
+    def mean(self, run, metric, names=None):
+        values = self.runValues(run, metric, names)
+        return math.fsum(values) / len(values) if values else None
+
+    # Percentile (0-100, linear interpolation) of a metric over the targets
+    # of one run, or None if no values.
+    def percentile(self, run, metric, p, names=None):
+        values = sorted(self.runValues(run, metric, names))
+        if not values:
+            return None
+        position = (len(values) - 1) * p / 100.0
+        low = int(math.floor(position))
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
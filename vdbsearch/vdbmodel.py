@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+#
+# vdbmodel.py - Latency Curve Model
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# Fits a queueing-style latency curve to measured (IOPS, latency) points and
+# predicts the IOPS at which latency reaches a target.
+#
+# The model is the M/M/1 hyperbola
+#
+#     latency = s / (1 - x / c)
+#
+# where x is the achieved IOPS, s the unloaded service time and c the
+# saturation IOPS. Its reciprocal is linear in x,
+#
+#     1 / latency = a + b * x,    a = 1 / s,    b = -1 / (s * c)
+#
+# so the fit is an ordinary least-squares line through (x, 1 / latency).
+#
+
+import math
+
+# Two-sided 95% Student's t critical values by degrees of freedom. Degrees of
+# freedom between entries use the next lower entry, which is conservative.
+T_CRITICAL_95 = [
+    (1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571), (6, 2.447),
+    (7, 2.365), (8, 2.306), (9, 2.262), (10, 2.228), (12, 2.179),
+    (15, 2.131), (20, 2.086), (30, 2.042), (60, 2.000), (120, 1.980),
+]
+Z_CRITICAL_95 = 1.960
+
+# A fitted latency curve.
+class LatencyModel:
+    # Initializer. a and b are the line coefficients for 1 / latency,
+    # covariance is their 2x2 covariance matrix (None if the fit is exact),
+    # and count is the number of points used.
+    def __init__(self, a, b, covariance, count):
+        self.a = a
+        self.b = b
+        self.covariance = covariance
+        self.count = count
+
+    # The model only describes a latency curve if latency rises with IOPS
+    # from a positive unloaded service time.
+    def isValid(self):
+        return self.a > 0 and self.b < 0
+
+    # Unloaded service time (ms).
+    def serviceTime(self):
+        return 1.0 / self.a
+
+    # IOPS at which latency grows without bound.
+    def saturationRate(self):
+        return -self.a / self.b
+
+    # Predicted latency at the given IOPS. Returns infinity at or past
+    # saturation.
+    def predictLatency(self, rate):
+        reciprocal = self.a + self.b * rate
+        return 1.0 / reciprocal if reciprocal > 0 else float("inf")
+
+    # Predicted IOPS at which latency reaches the target.
+    def predictRate(self, targetLatency):
+        return (1.0 / targetLatency - self.a) / self.b
+
+    # 95% confidence interval (low, high) for predictRate, by the delta
+    # method. Returns None if there are too few points to estimate the
+    # residual error.
+    def confidenceInterval(self, targetLatency):
+        if self.covariance is None:
+            return None
+        rate = self.predictRate(targetLatency)
+        (varA, covAB), (_, varB) = self.covariance
+        # Gradient of rate with respect to (a, b).
+        dA = -1.0 / self.b
+        dB = -rate / self.b
+        variance = dA * dA * varA + dB * dB * varB + 2.0 * dA * dB * covAB
+        margin = getTCritical(self.count - 2) * math.sqrt(max(variance, 0.0))
+        return rate - margin, rate + margin
+
+# Fit the latency curve to a list of (rate, latency) points. Points with
+# non-positive latency are ignored. Returns None if fewer than two distinct
+# rates remain.
+def fitLatencyCurve(points):
+    xs = []
+    ys = []
+    for rate, latency in points:
+        if rate is None or latency is None or latency <= 0:
+            continue
+        xs.append(float(rate))
+        ys.append(1.0 / float(latency))
+
+    n = len(xs)
+    if n < 2:
+        return None
+    meanX = sum(xs) / n
+    meanY = sum(ys) / n
+    sxx = sum((x - meanX) ** 2 for x in xs)
+    if sxx == 0:
+        return None
+    sxy = sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys))
+    b = sxy / sxx
+    a = meanY - b * meanX
+
+    covariance = None
+    if n > 2:
+        residual = sum((y - a - b * x) ** 2 for x, y in zip(xs, ys)) / (n - 2)
+        varB = residual / sxx
+        varA = residual * (1.0 / n + meanX * meanX / sxx)
+        covAB = -meanX * varB
+        covariance = ((varA, covAB), (covAB, varB))
+
+    return LatencyModel(a, b, covariance, n)
+
+# Look up the 95% t critical value for the given degrees of freedom.
+def getTCritical(degrees):
+    if degrees < 1:
+        return float("inf")
+    if degrees > T_CRITICAL_95[-1][0]:
+        return Z_CRITICAL_95
+    for df, t in reversed(T_CRITICAL_95):
+        if degrees >= df:
+            return t
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+#
+# vdbsearch.py - IO Rate Search Strategies
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+
+from vdbsearch import vdbmodel
+
+MIN_IORATE = 1
+# Factor the Anderson-Bjorck method falls back to when its own scaling
+# factor for a retained bracket end isn't positive (as in Illinois).
+ILLINOIS_FACTOR = 0.5
+# Smallest latency (ms) taken at face value, to keep reciprocals finite.
+MIN_LATENCY = 1e-6
+
+# A search strategy proposes the next IO rate for a target from the history
+# of rates requested so far and the latencies they produced. Histories are
+# plain lists in run order (run 1 first). A None latency means no data for
+# that run. Strategies that model the latency curve may also use the
+# achieved IOPS history, which is optional.
+#
+# Base class. Subclasses override proposeRate; by default, the last rate
+# with data is multiplied by the success or failure multiplier.
+class SearchStrategy:
+    name = None
+
+    # Initializer.
+    def __init__(self, successMultiplier, failureMultiplier):
+        self.successMultiplier = successMultiplier
+        self.failureMultiplier = failureMultiplier
+
+    # Get the next IO rate, rounded and clamped to a sane minimum.
+    def nextRate(self, rates, latencies, targetLatency, achieved=None):
+        if len(rates) == 0:
+            raise Exception("Error: search strategy {} needs at least one requested rate.".format(
+                self.name))
+        rate = self.proposeRate(rates, latencies, targetLatency, achieved)
+        return max(MIN_IORATE, int(round(rate)))
+
+    # Get the next IO rate, before rounding.
+    def proposeRate(self, rates, latencies, targetLatency, achieved=None):
+        points = getPoints(rates, latencies)
+        if len(points) == 0:
+            return rates[-1]
+        rate, latency = points[-1]
+        return self.expandRate(rate, latency <= targetLatency)
+
+    # Get a short human-readable note on how the next rate was chosen, or
+    # None if there is nothing to add.
+    def describe(self, rates, latencies, targetLatency, achieved=None):
+        return None
+
+    # Step away from the last tested rate using the configured multipliers.
+    # Used by every strategy before it has found both sides of the target.
+    def expandRate(self, rate, passed):
+        return rate * (self.successMultiplier if passed else self.failureMultiplier)
+
+# Legacy behavior: multiply the last rate by the success or failure
+# multiplier, ignoring everything but the most recent result.
+class MultiplierStrategy(SearchStrategy):
+    name = "multiplier"
+
+# Bracketing bisection. Expands with the multipliers until one passing and
+# one failing rate are known, then halves the bracket every run.
+class BisectionStrategy(SearchStrategy):
+    name = "bisection"
+
+    def proposeRate(self, rates, latencies, targetLatency, achieved=None):
+        points = getPoints(rates, latencies)
+        if len(points) == 0:
+            return rates[-1]
+        lower, upper = getBracket(points, targetLatency)
+        if upper is None:
+            return self.expandRate(lower[0], True)
+        if lower is None:
+            return self.expandRate(upper[0], False)
+        return (lower[0] + upper[0]) / 2.0
+
+# Secant search on the latency-vs-IOPS curve. Inside a bracket this is the
+# Anderson-Bjorck variant of regula falsi (see falsePositionRate), which
+# keeps the speed of the secant method without creeping along one side of
+# the bracket when the latency curve is strongly convex. Outside a bracket it
+# extrapolates through the two most recent points, limited to the range the
+# multipliers would have reached.
+class SecantStrategy(SearchStrategy):
+    name = "secant"
+
+    def proposeRate(self, rates, latencies, targetLatency, achieved=None):
+        points = getPoints(rates, latencies)
+        if len(points) == 0:
+            return rates[-1]
+        lower, upper = getBracket(points, targetLatency)
+
+        if lower is not None and upper is not None:
+            return falsePositionRate(points, lower, upper, targetLatency)
+
+        lastRate, lastLatency = points[-1]
+        passed = lastLatency <= targetLatency
+        expanded = self.expandRate(lastRate, passed)
+        if len(points) < 2:
+            return expanded
+
+        rate = interpolateRate(points[-2], points[-1], targetLatency)
+        if rate is None:
+            return expanded
+        # Only trust the extrapolation if it moves in the right direction, and
+        # never step further than the multiplier would have.
+        if passed:
+            return rate if lastRate < rate < expanded else expanded
+        return rate if expanded < rate < lastRate else expanded
+
+# Model-based search. Fits an M/M/1-style latency curve (see vdbmodel) to
+# every run so far and proposes the rate at which it predicts latency will
+# reach the target, if that is inside the known bracket, or else clamped to
+# the range the multipliers would have reached. The fit uses achieved IOPS
+# where available, since past saturation the requested rate is not what the
+# storage served. Falls back to the secant strategy until the fit describes
+# a rising curve, and inside a bracket whenever the prediction falls outside
+# it or once a run inside it has failed to cross the target.
+class ModelStrategy(SecantStrategy):
+    name = "model"
+
+    def proposeRate(self, rates, latencies, targetLatency, achieved=None):
+        model = fitModel(rates, latencies, achieved)
+        if model is None or not model.isValid():
+            return SecantStrategy.proposeRate(self, rates, latencies,
+                targetLatency, achieved)
+
+        rate = model.predictRate(targetLatency)
+        points = getPoints(rates, latencies)
+        lower, upper = getBracket(points, targetLatency)
+        if lower is not None and upper is not None:
+            if lower[0] < rate < upper[0] and not missedBracket(points, targetLatency):
+                return rate
+            return falsePositionRate(points, lower, upper, targetLatency)
+
+        lastRate, lastLatency = points[-1]
+        expanded = self.expandRate(lastRate, lastLatency <= targetLatency)
+        return min(max(rate, min(lastRate, expanded)), max(lastRate, expanded))
+
+    def describe(self, rates, latencies, targetLatency, achieved=None):
+        model = fitModel(rates, latencies, achieved)
+        if model is None or not model.isValid():
+            return None
+        description = "predicted {:.0f} IOPS at {}ms (saturation {:.0f} IOPS".format(
+            model.predictRate(targetLatency), targetLatency,
+            model.saturationRate())
+        interval = model.confidenceInterval(targetLatency)
+        if interval is not None:
+            description += ", 95% CI {:.0f}-{:.0f}".format(*interval)
+        return description + ")"
+
+SEARCH_STRATEGIES = {
+    MultiplierStrategy.name: MultiplierStrategy,
+    BisectionStrategy.name: BisectionStrategy,
+    SecantStrategy.name: SecantStrategy,
+    ModelStrategy.name: ModelStrategy,
+}
+
+# Create a search strategy by name.
+def getStrategy(name, successMultiplier, failureMultiplier):
+    try:
+        strategyClass = SEARCH_STRATEGIES[name]
+    except KeyError:
+        raise Exception("Error: unknown search strategy \"{}\". Choose from: {}.".format(
+            name, ", ".join(sorted(SEARCH_STRATEGIES.keys()))))
+    return strategyClass(successMultiplier, failureMultiplier)
+
+# Pair up rates and latencies, dropping runs without data.
+def getPoints(rates, latencies):
+    return [(float(r), float(l)) for r, l in zip(rates, latencies)
+        if r is not None and l is not None]
+
+# Fit the latency curve to a target's history, preferring achieved IOPS over
+# requested IOPS for each run where it is known.
+def fitModel(rates, latencies, achieved=None):
+    if achieved is None:
+        achieved = [None] * len(rates)
+    xs = [a if a is not None else r for r, a in zip(rates, achieved)]
+    return vdbmodel.fitLatencyCurve(getPoints(xs, latencies))
+
+# Find the tightest bracket around the target latency. Returns a tuple
+# (lower, upper) of (rate, latency) points, where lower is the highest rate
+# that met the target and upper the lowest rate that didn't. Either may be
+# None. Noisy measurements can produce a passing rate above a failing one;
+# in that case the passing point is discarded, since the failure is the
+# more conservative reading.
+def getBracket(points, targetLatency):
+    failing = [p for p in points if p[1] > targetLatency]
+    upper = min(failing) if failing else None
+    passing = [p for p in points if p[1] <= targetLatency
+        and (upper is None or p[0] < upper[0])]
+    lower = max(passing) if passing else None
+    return lower, upper
+
+# The next rate inside a bracket by the Anderson-Bjorck method: regula falsi
+# between the bracket ends, except that while the runs keep landing on the
+# same side of the target, the error of the other (retained) end is scaled
+# down once per repeat, which pulls the next rate towards it. For a repeat
+# from error f1 to f2, the factor is 1 - f2 / f1, or ILLINOIS_FACTOR if that
+# isn't positive. The repeats are the runs in a row at the end of the
+# history that were on the same side of the target. See latencyError for
+# the error of a point.
+def falsePositionRate(points, lower, upper, targetLatency):
+    lowerError = latencyError(lower[1], targetLatency)
+    upperError = latencyError(upper[1], targetLatency)
+    passed = points[-1][1] <= targetLatency
+    scale = 1.0
+    for previous, current in zip(reversed(points[:-1]), reversed(points)):
+        if (previous[1] <= targetLatency) != passed:
+            break
+        previousError = latencyError(previous[1], targetLatency)
+        factor = 0.0
+        if previousError != 0:
+            factor = 1.0 - latencyError(current[1], targetLatency) / previousError
+        scale *= factor if factor > 0 else ILLINOIS_FACTOR
+    if passed:
+        upperError *= scale
+    else:
+        lowerError *= scale
+    if upperError == lowerError:
+        return (lower[0] + upper[0]) / 2.0
+    return (lower[0] * upperError - upper[0] * lowerError) / (upperError - lowerError)
+
+# Whether any run since the target was first bracketed landed on the same
+# side of it as the run before, i.e. a step inside the bracket that didn't
+# cross the target.
+def missedBracket(points, targetLatency):
+    sides = [latency <= targetLatency for rate, latency in points]
+    crossed = False
+    for previous, current in zip(sides, sides[1:]):
+        if previous != current:
+            crossed = True
+        elif crossed:
+            return True
+    return False
+
+# How far a latency is from the target, for regula falsi: the difference of
+# their reciprocals, which is negative for a passing latency and positive for
+# a failing one. Latency rises ever more steeply with the IO rate as the
+# storage nears saturation, but its reciprocal falls close to linearly (for
+# an M/M/1 queue, exactly), so interpolating it stays accurate even with a
+# bracket end far into saturation.
+def latencyError(latency, targetLatency):
+    return 1.0 / targetLatency - 1.0 / max(latency, MIN_LATENCY)
+
+# Linear interpolation (or extrapolation) of the rate at which the line
+# through two (rate, latency) points reaches the target latency. Returns None
+# if the line is flat or the points share a rate.
+def interpolateRate(a, b, targetLatency):
+    if a[0] == b[0] or a[1] == b[1]:
+        return None
+    return a[0] + (targetLatency - a[1]) * (b[0] - a[0]) / (b[1] - a[1])
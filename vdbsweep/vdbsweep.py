@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+#
+# vdbsweep.py - Vdbench Parameter Sweeps
+#
+# Author: Ramon A. Lovato (ramonalovato.com)
+# For: DeepStorage, LLC (deepstorage.net)
+#
+# A sweep measures every combination ("point") of a grid of workload
+# parameters, such as threads x xfersize x rdpct, on every target. Each point
+# is set through the run definitions' Vdbench for-loops ("forthreads=(4)"),
+# which override the storage and workload definitions. In loop mode, the
+# whole grid goes into the for-loops of a single run, so Vdbench steps
+# through every point itself and each point is one summary row of
+# flatfile.html; in points mode, every point is a run of its own.
+#
+
+import csv
+import itertools
+import os
+
+# Parameters that can be swept. Each has a run definition for-loop
+# ("for" + name) and a flatfile column of the same name.
+SWEEP_PARAMETERS = ("threads", "xfersize", "rdpct", "seekpct", "rhpct",
+    "whpct", "compratio")
+LOOP_PREFIX = "for"
+MODE_LOOP = "loop"
+MODE_POINTS = "points"
+SWEEP_MODES = (MODE_LOOP, MODE_POINTS)
+DEFAULT_MODE = MODE_LOOP
+# Multipliers for transfer size suffixes, e.g. "64k".
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+TABLE_TEMP_SUFFIX = ".tmp"
+
+# A grid of parameter values and how to run it. grid is a list of
+# (parameter, [values]) pairs; points are taken in the order of the grid,
+# with the last parameter changing fastest.
+class Sweep:
+    # Initializer.
+    def __init__(self, grid, mode=DEFAULT_MODE):
+        if mode not in SWEEP_MODES:
+            raise Exception("Error: unknown sweep mode \"{}\". Choose from: {}.".format(
+                mode, ", ".join(SWEEP_MODES)))
+        self.grid = grid
+        self.mode = mode
+        self.parameters = [p for p, _ in grid]
+
+    # Every point, as a tuple of values in the order of the grid.
+    def points(self):
+        return list(itertools.product(*[values for _, values in self.grid]))
+
+    # The points measured by each run: all of them in one run in loop mode,
+    # or one per run in points mode.
+    def rounds(self):
+        points = self.points()
+        if self.mode == MODE_LOOP:
+            return [points]
+        return [[p] for p in points]
+
+    # A copy of config (a vdbconfig.VdbConfig) set up to measure points.
+    # Any value a run definition already had for a swept parameter is
+    # replaced.
+    def apply(self, config, points):
+        config = config.copy()
+        for i, parameter in enumerate(self.parameters):
+            values = []
+            for point in points:
+                if point[i] not in values:
+                    values.append(point[i])
+            for rd in config.rds():
+                rd.remove(parameter)
+                rd.set(LOOP_PREFIX + parameter, "({})".format(",".join(values)))
+        return config
+
+    # Pair one target's summary rows from a run with the points it measured.
+    # Each row is matched to the first remaining point whose values agree
+    # with its flatfile columns; columns Vdbench reports as "n/a" agree with
+    # anything, so rows are otherwise taken in order. Returns a list of
+    # (point, row) pairs.
+    def splitRows(self, rows, points):
+        remaining = list(points)
+        pairs = []
+        for row in rows:
+            for point in remaining:
+                if all(valueMatches(parameter, value, row.get(parameter))
+                        for parameter, value in zip(self.parameters, point)):
+                    remaining.remove(point)
+                    pairs.append((point, row))
+                    break
+        return pairs
+
+# The results of a sweep, as a CSV table with one row per target per point,
+# followed by the totals for that point:
+#
+# point #    configuration    threads    ...    requested IOPS    ...
+# 1          vdb1             1
+#            vdb2             1
+#            total/average    1
+# 2          vdb1             2
+# ...
+#
+# The table is rewritten (through a temporary file) whenever rows are added,
+# so it is complete up to the last finished run.
+class SweepTable:
+    # Initializer. judge maps a latency to a verdict for the last column.
+    def __init__(self, path, parameters, judge):
+        self.path = path
+        self.parameters = parameters
+        self.judge = judge
+        self.rows = [["point #", "configuration"] + list(parameters)
+            + ["requested IOPS", "achieved IOPS", "MB/sec", "latency (ms)",
+            "queue depth", "latency verdict"]]
+        self.write()
+
+    # Add the results of one point. results maps target names to flatfile
+    # summary rows.
+    def addPoint(self, number, point, results):
+        first = True
+        totals = [0.0, 0.0, 0.0]
+        latencies = []
+        for name in sorted(results):
+            row = results[name]
+            values = [toFloat(row.get(k))
+                for k in ("reqrate", "rate", "MB/sec", "resp", "queue_depth")]
+            self.rows.append([str(number) if first else "", name]
+                + list(point) + [formatValue(v) for v in values]
+                + [self.judge(values[3]) if values[3] is not None else ""])
+            first = False
+            for i, v in enumerate(values[:3]):
+                totals[i] += v or 0.0
+            if values[3] is not None:
+                latencies.append(values[3])
+        if results:
+            latency = sum(latencies) / len(latencies) if latencies else None
+            self.rows.append(["", "total/average"] + list(point)
+                + [formatValue(v) for v in totals]
+                + [formatValue(latency), "",
+                self.judge(latency) if latency is not None else ""])
+        self.write()
+
+    # Add a closing message on its own line, after a single empty line.
+    def signOff(self, message):
+        self.rows.append([])
+        self.rows.append([message])
+        self.write()
+
+    # Atomically replace the table on disk with everything added so far.
+    def write(self):
+        tempPath = self.path + TABLE_TEMP_SUFFIX
+        with open(tempPath, "w", newline="") as f:
+            csv.writer(f).writerows(self.rows)
+        os.replace(tempPath, self.path)
+
+# Parse a command line grid specification, "parameter=value,value,...",
+# into a (parameter, [values]) pair.
+def parseGridSpec(spec):
+    parameter, sep, values = spec.partition("=")
+    parameter = parameter.strip().lower()
+    if parameter.startswith(LOOP_PREFIX):
+        parameter = parameter[len(LOOP_PREFIX):]
+    values = [v.strip() for v in values.strip().strip("()").split(",")
+        if v.strip()]
+    values = [v for i, v in enumerate(values) if v not in values[:i]]
+    if not sep or parameter not in SWEEP_PARAMETERS or not values:
+        raise Exception("Error: bad sweep \"{}\". Expected parameter=value,value,... with parameter one of: {}.".format(
+            spec, ", ".join(SWEEP_PARAMETERS)))
+    return parameter, values
+
+# Check whether a swept value agrees with the value in a flatfile column.
+# Transfer sizes may have a k, m or g suffix; the flatfile gives bytes.
+def valueMatches(parameter, value, column):
+    actual = toFloat(column)
+    if actual is None:
+        return True
+    expected = parseSize(value) if parameter == "xfersize" else toFloat(value)
+    if expected is None:
+        return True
+    return abs(expected - actual) <= 1e-6 * max(1.0, abs(expected))
+
+# Convert a transfer size such as "4k" to bytes, or None.
+def parseSize(value):
+    value = value.strip().lower()
+    multiplier = SIZE_SUFFIXES.get(value[-1:], 1)
+    if value[-1:] in SIZE_SUFFIXES:
+        value = value[:-1]
+    number = toFloat(value)
+    return number * multiplier if number is not None else None
+
+# Convert a flatfile value to a float, or None for "n/a" and anything else
+# that isn't a number.
+def toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Format a number for the table, or "" for None.
+def formatValue(value):
+    return "" if value is None else str(value)
@@ -12,7 +12,18 @@ import os.path
 import os
 import re
 import csv
+import math
+import threading
+import io
+import time
 from vdbconfig import vdbconfig
+from vdbsearch import vdbsearch
+from vdbresults import vdbflatfile
+from vdbresults import vdbcollect
+from vdbresults import vdbstore
+from vdbresults import vdbseries
+from vdbresults import vdbhistogram
+from vdbsweep import vdbsweep
 from NetJobs import NetJobs
 
 DEFAULT_RUNS = 5
@@ -25,39 +36,73 @@ DEFAULT_FAILURE_MULTIPLIER = 0.3
 DEFAULT_CONSECUTIVE_FAILURES = 2
 DEFAULT_FUZZINESS = 0.0
 DEFAULT_IOPS_TOLERANCE = 1.5
+DEFAULT_SEARCH = vdbsearch.ModelStrategy.name
+REQUESTED_IOPS = "iorate"
+ACHIEVED_IOPS = "rate"
+LATENCY = "resp"
+# The latency each target is judged by: LATENCY, or a percentile from its
+# histogram when --target-percentile is given.
+TARGET_LATENCY = "target latency"
+LATENCY_BELOW = "below"
+LATENCY_WITHIN = "within"
+LATENCY_ABOVE = "above"
+DEFAULT_EARLY_STOP = 0
+EARLY_STOP_POLL_INTERVAL = 5
+# Number of standard errors the mean latency must clear a band edge by before
+# a verdict is reached. Generous, since consecutive intervals are correlated.
+EARLY_STOP_Z = 3.0
+# Vdbench leaves the first interval out of its own averages as warm-up.
+WARMUP_INTERVALS = 1
+# When the log is written to disk: after every round, only when the test
+# ends, or (given a number) at most once every that many seconds.
+LOG_SYNC_ROUND = "round"
+LOG_SYNC_EXIT = "exit"
+DEFAULT_LOG_SYNC = LOG_SYNC_ROUND
+# Number of IO rates each Vdbench run steps through (see batchRates), and how
+# far either side of the chosen rate they reach, as a fraction of it.
+DEFAULT_BATCH = 1
+BATCH_SPREAD = 0.5
+# Runs between formats of a target's storage; 0 formats it only once.
+DEFAULT_REFORMAT_EVERY = 0
+LOG_TEMP_SUFFIX = ".tmp"
 
 # Simple data structure for storing test information. Note that run indexing
-# goes from 1 to args.max_runs (for readability). Thus, run 0 data are
-# initialized to None.
+# goes from 1 to args.max_runs (for readability).
+#
+# All measurements live in a columnar vdbstore.ResultStore: the IO rate
+# requested from each target (REQUESTED_IOPS) plus every numeric column of
+# its flatfile summary row, such as "rate" (achieved IOPS) and "resp"
+# (mean latency), and the latency the search is driven by (TARGET_LATENCY).
+# Use getHistory and getLatest rather than reading it directly. With
+# --batch, every step of a batched Vdbench run is a run of its own here.
 #
 # Early builds had some problems with invisible files (such as Linux
 # temp files: file.txt~) being added to TestInfo on initialization but
 # not having any data associated with them since they weren't real
 # run configurations. This solution isn't foolproof, but as a safeguard
 # to prevent errors if there are problems, we now deliberately ignore
-# lists whose length is shorter than the others.
+# targets that are missing data for the current run.
 class TestInfo:
     # Initializer.
     def __init__(self, configDir):
         self.names = [getNameOnly(f) for f in getContents(configDir)]
-        self.requestedIOPS = {}
-        self.achievedIOPS = {}
-        self.latencies = {}
-
-        for name in self.names:
-            self.requestedIOPS[name] = [None]
-            self.achievedIOPS[name] = [None]
-            self.latencies[name] = [None]
-        
+        self.store = vdbstore.ResultStore(self.names,
+            (REQUESTED_IOPS, ACHIEVED_IOPS, LATENCY, TARGET_LATENCY))
+
         # self.state = 0: pre-test.
         # self.state = 1: post-test.
         self.state = 0
         self.runCount = 0
         self.ignoredNames = []
-
-    # Add requested IOPS to TestInfo.
-    def updatePreTest(self, configDir):
-        self.runCount += 1
+        # Targets whose latency has landed inside the fuzziness band, and
+        # the IO rate at which it did. Their IO rate is no longer changed.
+        self.frozenNames = []
+        self.frozenRates = {}
+
+    # Add requested IOPS to TestInfo. For a batched run, step picks which of
+    # each config's IO rates to use.
+    def updatePreTest(self, configDir, step=None):
+        self.runCount = self.store.addRun()
         self.state = 0
         for config in getContents(configDir):
             name = getNameOnly(config)
@@ -68,47 +113,46 @@ class TestInfo:
                         config))
                 continue
 
-            self.requestedIOPS[name].append(getOldIORate(config))
+            self.store.set(self.runCount, name, REQUESTED_IOPS,
+                getOldIORate(config, step))
 
-    # Add latency and achieved IOPS to TestInfo.
-    def updatePostTest(self, outputParent):
+    # Add latency, achieved IOPS, and the rest of the summary row to
+    # TestInfo from a round's RoundResults.
+    def updatePostTest(self, roundResults):
         self.state = 1
-        for folder in getContents(outputParent):
-            name = os.path.basename(folder)
+        for name in sorted(list(roundResults.results.keys())
+                + list(roundResults.errors.keys())):
             if name not in self.names:
                 if name not in self.ignoredNames:
                     self.ignoredNames.append(name)
-                    print("Warning: output file {} found for unregistered (new or blacklisted) configuration. This warning will only appear once per file".format(
-                        folder))
+                    print("Warning: output for {} found for unregistered (new or blacklisted) configuration. This warning will only appear once per file".format(
+                        name))
                 continue
 
-            try:
-                results = getTestResults(folder)
-            except Exception as e:
+            if name in roundResults.errors:
                 self.blacklistTarget(name)
                 print("Warning: unable to get test results for {}. Adding to blacklist. Original exception follows:\n{}".format(
-                    name, str(e)))
+                    name, str(roundResults.errors[name])))
+                continue
+
+            result = roundResults.get(name)
+            self.store.setRow(self.runCount, name, result.row)
+            self.store.set(self.runCount, name, ACHIEVED_IOPS, result.rate)
+            self.store.set(self.runCount, name, LATENCY, result.resp)
+            self.store.set(self.runCount, name, TARGET_LATENCY, result.latency)
 
-            if name in self.names and not name in self.ignoredNames:
-                self.achievedIOPS[name].append(float(results["rate"]))
-                self.latencies[name].append(float(results["resp"]))
-        
         # Check for targets without updated data and blacklist them.
         self.blacklistTest()
 
-    # Scan the data structure and blacklist any list whose length is shorter
-    # than self.runCount + 1 (since the first element of each list is always
-    # None), as this would mean its entries weren't updated properly.
+    # Scan the data structure and blacklist any target missing requested
+    # IOPS, achieved IOPS, or latency for the current run, as this would mean
+    # its entries weren't updated properly.
     def blacklistTest(self):
         if not self.state == 1:
             raise Exception("TestInfo.blacklistTest is only valid in post-test (1) state.")
 
-        # List index 0 is always None, since test indexing goes from 1 through
-        # n, so the length is always 1 more than the run index.
-        maxLength = self.runCount + 1
-        testLam = lambda t: (len(self.requestedIOPS[t]) == maxLength
-            and len(self.achievedIOPS[t]) == maxLength
-            and len(self.latencies[t]) == maxLength)
+        testLam = lambda t: all(self.store.isPresent(self.runCount, t, metric)
+            for metric in (REQUESTED_IOPS, ACHIEVED_IOPS, LATENCY))
 
         blacklist = [t for t in self.names if not testLam(t)]
 
@@ -130,17 +174,92 @@ class TestInfo:
         if len(self.names) == 0:
             raise Exception("Error: no targets remain after blacklisting. Unable to continue.")
 
+    # Get the values of a metric for the named target over every run so far,
+    # in run order, with None where data is missing.
+    def getHistory(self, name, metric):
+        return self.store.history(name, metric)
+
+    # Get the value of a metric for the named target in the current run.
+    def getLatest(self, name, metric):
+        return self.store.get(self.runCount, name, metric)
+
     # Blacklist a specific target.
     def blacklistTarget(self, name):
         if name in self.names:
+            # Its history stays in the store, but it gets no new data.
             self.names.remove(name)
-            del(self.requestedIOPS[name])
-            del(self.achievedIOPS[name])
-            del(self.latencies[name])
             self.ignoredNames.append(name)
+            if name in self.frozenNames:
+                self.frozenNames.remove(name)
+                self.frozenRates.pop(name, None)
+
+    # Stop changing the IO rate for a specific target, keeping it at rate.
+    def freezeTarget(self, name, rate=None):
+        if name in self.names and name not in self.frozenNames:
+            self.frozenNames.append(name)
+            self.frozenRates[name] = rate
+
+    # Check whether every remaining target has been frozen.
+    def allFrozen(self):
+        return all(name in self.frozenNames for name in self.names)
+
+# Keeps track of which targets' storage has been prepared by Vdbench's
+# "format=" run parameter, so it isn't formatted again on every run. The
+# format setting each config starts with is remembered, and once a run that
+# formatted a target has produced results, the target's later configs get
+# "format=no" until the reformat policy (every reformatEvery runs, or never
+# if 0) calls for another format.
+class PreparationState:
+    # Initializer.
+    def __init__(self, reformatEvery=DEFAULT_REFORMAT_EVERY):
+        self.reformatEvery = reformatEvery
+        # Original format setting of each target's config (None if it has
+        # none), the targets being formatted by the current run, and the run
+        # each target was last formatted in.
+        self.formats = {}
+        self.formatting = []
+        self.lastFormatted = {}
+
+    # Read the format settings of the configs for the run about to start.
+    def updatePreTest(self, configDir):
+        self.formatting = []
+        for path in getContents(configDir):
+            name = getNameOnly(path)
+            config = vdbconfig.loadConfig(path)
+            if name not in self.formats:
+                self.formats[name] = config.getFormat()
+            if config.isFormatting():
+                self.formatting.append(name)
+
+    # Record that the named targets completed the run, so any of them that
+    # were being formatted are now prepared. Only pass targets whose run went
+    # to completion (see isCompleteResult); one that was stopped early,
+    # killed or timed out may not have finished formatting.
+    def updatePostTest(self, run, names):
+        for name in names:
+            if name in self.formatting:
+                self.lastFormatted[name] = run
+
+    # The format setting the named target's config should have for the given
+    # run, or None to leave it as it is.
+    def getFormat(self, name, run):
+        original = self.formats.get(name)
+        if original is None or original.strip().lower() == vdbconfig.FORMAT_OFF:
+            return None
+        last = self.lastFormatted.get(name)
+        if last is None or (self.reformatEvery > 0
+                and run - last >= self.reformatEvery):
+            return original
+        return vdbconfig.FORMAT_OFF
 
 # LogWriter object for better encapsulating Python's file IO and CSV-handling.
-# Tracks the CSV writer associated with the log file and auto-flushes rows.
+# Rows are kept in memory until the sync policy says to write them (see
+# LOG_SYNC_ROUND), since the log often lives on the same share that is under
+# test. The header is written to a temporary file that is fsynced and then
+# renamed over the log, so an old log at the path is only ever replaced by a
+# complete new one. After that, each sync appends just the pending rows to
+# the open log file and fsyncs it. Call close when done to write any rows
+# still pending and close the file.
 #
 # --- CSV table format ---
 #
@@ -154,49 +273,86 @@ class TestInfo:
 #          ...
 #          total/average
 # ...      ...
+#
+# With a target percentile, a "pNN latency (ms)" column follows the mean
+# latency. Its total/average entry is the percentile of the merged histogram
+# of all targets, not an average of percentiles.
+#
+# With --batch, a "step" column follows the run number, and each step of a
+# Vdbench run gets its own block of rows, numbered from 1. The run number is
+# still that of the Vdbench run.
 class LogWriter:
-    # Initializaer.
-    def __init__(self, log):
-        self.log = log
-        self.logWriter = csv.writer(log, delimiter=',', quotechar='"',
-            quoting=csv.QUOTE_MINIMAL)
+    # Initializaer. syncPolicy is LOG_SYNC_ROUND, LOG_SYNC_EXIT, or a number
+    # of seconds. batched adds the step column.
+    def __init__(self, path, percentile=None, syncPolicy=DEFAULT_LOG_SYNC,
+            batched=False):
+        self.path = path
+        self.percentile = percentile
+        self.syncPolicy = syncPolicy
+        self.batched = batched
+        # Rows not yet written to the log file.
+        self.pending = io.StringIO(newline="")
+        self.logWriter = csv.writer(self.pending, delimiter=',',
+            quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.file = None
+        self.dirty = False
+        self.lastSync = None
 
     # Write the log header.
     def writeHeader(self):
-        self.logWriter.writerow(["run #", "configuration", "requested IOPS",
-            "achieved IOPS", "latency (ms)"])
+        header = ["run #", "configuration", "requested IOPS",
+            "achieved IOPS", "latency (ms)"]
+        if self.batched:
+            header.insert(1, "step")
+        if self.percentile is not None:
+            header.append("{} latency (ms)".format(
+                formatPercentile(self.percentile)))
+        self.logWriter.writerow(header)
+        # Always create the file up front, so a bad path fails immediately.
         self.flushNow()
 
-    # Update the log file.
-    def updateLog(self, testInfo, run):
+    # Update the log file. fleetLatency is the fleet-wide target percentile,
+    # if there is one. step is the step of a batched run, from 0.
+    def updateLog(self, testInfo, run, fleetLatency=None, step=None):
         row = LogWriter.updateLogHelper(testInfo.names[0], testInfo, run=run)
-        self.logWriter.writerow(row)
+        if self.percentile is not None:
+            row.append(str(testInfo.getLatest(testInfo.names[0],
+                TARGET_LATENCY)))
+        self.writeRow(row, step)
         if len(testInfo.names) > 1:
             for name in testInfo.names[1:]:
                 row = LogWriter.updateLogHelper(name, testInfo)
-                self.logWriter.writerow(row)
+                if self.percentile is not None:
+                    row.append(str(testInfo.getLatest(name, TARGET_LATENCY)))
+                self.writeRow(row)
         row = LogWriter.updateLogTotalsHelper(testInfo)
+        if self.percentile is not None:
+            row.append(str(fleetLatency))
+        self.writeRow(row)
+        self.sync()
+
+    # Write a row, with the step column filled in from step (numbered from 1
+    # in the log) if the log has one.
+    def writeRow(self, row, step=None):
+        if self.batched:
+            row.insert(1, str(step + 1) if step is not None else "")
         self.logWriter.writerow(row)
-        self.flushNow()
 
     # Helper for updateLog.
     def updateLogHelper(name, testInfo, run=None):
         row = ["{}".format(str(run) if run else ""),
                name,
-               str(testInfo.requestedIOPS[name][-1]),
-               str(testInfo.achievedIOPS[name][-1]),
-               str(testInfo.latencies[name][-1])]
+               str(int(testInfo.getLatest(name, REQUESTED_IOPS))),
+               str(testInfo.getLatest(name, ACHIEVED_IOPS)),
+               str(testInfo.getLatest(name, LATENCY))]
         return row
 
     def updateLogTotalsHelper(testInfo):
-        totalRequestedIOPS = 0.0
-        totalAchievedIOPS = 0.0
-        totalLatency = 0.0
-        for name in testInfo.names:
-            totalRequestedIOPS += testInfo.requestedIOPS[name][-1]
-            totalAchievedIOPS += testInfo.achievedIOPS[name][-1]
-            totalLatency += testInfo.latencies[name][-1]
-        averageLatency = totalLatency  / len(testInfo.latencies.keys())
+        store = testInfo.store
+        run = testInfo.runCount
+        totalRequestedIOPS = store.total(run, REQUESTED_IOPS, testInfo.names)
+        totalAchievedIOPS = store.total(run, ACHIEVED_IOPS, testInfo.names)
+        averageLatency = store.mean(run, LATENCY, testInfo.names)
         row = ["",
                "total/average",
                str(totalRequestedIOPS),
@@ -208,12 +364,183 @@ class LogWriter:
     def logSignOff(self, message):
         self.logWriter.writerow([])
         self.logWriter.writerow([message])
+        self.sync()
+
+    # Write pending rows if the sync policy calls for it.
+    def sync(self):
+        self.dirty = True
+        if self.syncPolicy == LOG_SYNC_EXIT:
+            return
+        if (self.syncPolicy != LOG_SYNC_ROUND and self.lastSync is not None
+                and time.monotonic() - self.lastSync < float(self.syncPolicy)):
+            return
         self.flushNow()
 
-    # Force Python and the OS to immediately write the changes to disk.
+    # Write any pending rows and close the log file.
+    def close(self):
+        if self.dirty:
+            self.flushNow()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Immediately write the pending rows to disk. The first write creates
+    # the log atomically; later ones append to it.
     def flushNow(self):
-        self.log.flush()
-        os.fsync(self.log.fileno())
+        rows = self.pending.getvalue()
+        if self.file is None:
+            self.createLog(rows)
+        else:
+            self.file.write(rows)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending.seek(0)
+        self.pending.truncate()
+        self.dirty = False
+        self.lastSync = time.monotonic()
+
+    # Write rows to a temporary file, rename it over the log, and keep the
+    # log open for appending.
+    def createLog(self, rows):
+        tempPath = self.path + LOG_TEMP_SUFFIX
+        with open(tempPath, "w", newline="") as f:
+            f.write(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, self.path)
+        # Make the rename itself durable. Not every platform can open a
+        # directory.
+        try:
+            dirFd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+        except OSError:
+            pass
+        self.file = open(self.path, "a", newline="")
+
+# Watches each target's flatfile.html while a round is running and decides
+# whether the round can be stopped early. A target has a verdict once at
+# least minIntervals post-warm-up intervals are in and the mean latency is
+# more than EARLY_STOP_Z standard errors above, below, or inside the
+# fuzziness band. The round can stop once every target in decideNames has a
+# verdict; the other targets are only tracked so their partial results are
+# available.
+#
+# NetJobs agents also stream each interval as Vdbench prints it. Once a
+# streamed interval arrives for a target (matched by agent host name, see
+# addMetrics), the monitor uses the stream for that target instead of its
+# flatfile, since the stream doesn't wait for the file share to catch up.
+# addMetrics is called from the NetJobs thread, so sample access is locked.
+class EarlyStopMonitor:
+    # Initializer.
+    def __init__(self, outputParent, names, decideNames, minIntervals,
+            targetLatency, fuzziness):
+        self.tails = {}
+        self.samples = {}
+        # Run and interval of the last row from each target.
+        self.steps = {}
+        self.streamed = set()
+        self.lock = threading.Lock()
+        for name in names:
+            self.tails[name] = vdbflatfile.FlatFileTail(os.path.join(
+                outputParent, name, vdbflatfile.FLATFILE_NAME))
+            self.samples[name] = []
+        self.decideNames = decideNames
+        self.minIntervals = minIntervals
+        self.minLat = targetLatency * (1.0 - fuzziness)
+        self.maxLat = targetLatency * (1.0 + fuzziness)
+
+    # Read new interval rows from every target that isn't being streamed.
+    def poll(self):
+        for name, tail in list(self.tails.items()):
+            rows = tail.readRows()
+            with self.lock:
+                if name in self.streamed:
+                    continue
+                for row in rows:
+                    self.addRow(name, row)
+
+    # Add a streamed interval from the NetJobs agent on host. The host is
+    # matched to the target with the same name, or failing that, the same
+    # first DNS label (so "vdb1.lab.local" matches "vdb1"); intervals from
+    # hosts that don't match any target are ignored, and those targets keep
+    # using their flatfiles.
+    def addMetrics(self, host, command, metrics):
+        name = host if host in self.samples else host.split(".")[0]
+        if name not in self.samples:
+            return
+        with self.lock:
+            if name not in self.streamed:
+                # Switch over. The stream starts with the run, so it has
+                # every interval the flatfile had and possibly more.
+                self.streamed.add(name)
+                self.tails.pop(name, None)
+                self.samples[name] = []
+                self.steps.pop(name, None)
+            self.addRow(name, metrics)
+
+    # Helper for poll and addMetrics. Adds an interval row with Interval,
+    # rate and resp columns (and Run, if known) to the named target's
+    # samples. Format runs are skipped, and a new run or for-loop step, whose
+    # intervals are numbered from 1 again, replaces the samples of the one
+    # before.
+    def addRow(self, name, row):
+        run = row.get("Run")
+        if run is not None and run.startswith(vdbflatfile.FORMAT_RUN_PREFIX):
+            return
+        try:
+            interval = int(row["Interval"])
+            sample = (float(row["rate"]), float(row["resp"]))
+        except (KeyError, ValueError):
+            return
+        last = self.steps.get(name)
+        if last is not None and (last[0] != run or last[1] >= interval):
+            self.samples[name] = []
+        self.steps[name] = (run, interval)
+        if interval > WARMUP_INTERVALS:
+            self.samples[name].append(sample)
+
+    # Get the verdict for the named target, or None if it isn't clear yet.
+    def getVerdict(self, name):
+        with self.lock:
+            samples = list(self.samples[name])
+        n = len(samples)
+        if n < max(self.minIntervals, 2):
+            return None
+        latencies = [s[1] for s in samples]
+        mean = sum(latencies) / n
+        variance = sum((l - mean) ** 2 for l in latencies) / (n - 1)
+        margin = EARLY_STOP_Z * math.sqrt(variance / n)
+        if mean - margin > self.maxLat:
+            return LATENCY_ABOVE
+        if mean + margin < self.minLat:
+            return LATENCY_BELOW
+        if self.minLat <= mean - margin and mean + margin <= self.maxLat:
+            return LATENCY_WITHIN
+        return None
+
+    # Check whether every target that matters has a verdict.
+    def isDecided(self):
+        return all(self.getVerdict(name) is not None
+            for name in self.decideNames)
+
+    # Get results for every target with data, as rows with rate and resp
+    # columns averaged over the intervals seen so far.
+    def getResults(self):
+        results = {}
+        with self.lock:
+            allSamples = dict((n, list(s)) for n, s in self.samples.items())
+        for name, samples in allSamples.items():
+            if len(samples) == 0:
+                continue
+            results[name] = {
+                "rate": str(sum(s[0] for s in samples) / len(samples)),
+                "resp": str(sum(s[1] for s in samples) / len(samples)),
+            }
+        return results
 
 # Get CLI arguments.
 def getArgs():
@@ -251,6 +578,9 @@ def getArgs():
         default=DEFAULT_CONSECUTIVE_FAILURES,
         help="terminate after n consecutive failures (default {})"
         .format(DEFAULT_CONSECUTIVE_FAILURES))
+    parser.add_argument("-F", "--forgive-bracketed-failures",
+        action="store_true",
+        help="don't count a failed run towards --consecutive-failures if every target that failed has already met the target latency at a lower IO rate")
     parser.add_argument("-z", "--fuzziness", type=float,
         default=DEFAULT_FUZZINESS,
         help="acceptable fractional skew from target latency, such that targetLatency * (1.0 - fuzziness) <= x <= targetLatency * (1.0 + fuzziness)  (default {})".format(
@@ -259,6 +589,45 @@ def getArgs():
         default=DEFAULT_IOPS_TOLERANCE,
         help="if IOPS achieved * IOPS tolerance < IOPS requested, terminate early (default {})".format(
             DEFAULT_IOPS_TOLERANCE))
+    parser.add_argument("-a", "--search", type=str, default=DEFAULT_SEARCH,
+        choices=sorted(vdbsearch.SEARCH_STRATEGIES.keys()),
+        help="strategy used to choose the next IO rate (default {})".format(
+            DEFAULT_SEARCH))
+    parser.add_argument("-e", "--early-stop", type=int,
+        default=DEFAULT_EARLY_STOP,
+        help="stop a run early once every target's latency is clearly above, below, or within the target band after at least n intervals; 0 disables (default {})".format(
+            DEFAULT_EARLY_STOP))
+    parser.add_argument("-j", "--collect-threads", type=int,
+        default=vdbcollect.DEFAULT_WORKERS,
+        help="number of threads used to read results after each run (default {})".format(
+            vdbcollect.DEFAULT_WORKERS))
+    parser.add_argument("-p", "--target-percentile", type=float,
+        default=None,
+        help="judge each target by this percentile (e.g. 99 or 99.9) of its response time histogram instead of its mean latency (default mean)")
+    parser.add_argument("-l", "--log-sync", type=str, default=DEFAULT_LOG_SYNC,
+        help="when to write the log to disk: \"{}\" (after every run), \"{}\" (only when the test ends), or a number of seconds between writes (default {})".format(
+            LOG_SYNC_ROUND, LOG_SYNC_EXIT, DEFAULT_LOG_SYNC))
+    parser.add_argument("-T", "--timeseries", type=str, default=None,
+        help="save every interval of every target and run to a binary time-series file at this path (plus an index at path{})".format(
+            vdbseries.INDEX_SUFFIX))
+    parser.add_argument("-b", "--batch", type=int, default=DEFAULT_BATCH,
+        help="step each Vdbench run through this many IO rates, including the chosen rate and within +/-{:g}%% of it and its search bracket, and use every step as a result (default {})".format(
+            BATCH_SPREAD * 100, DEFAULT_BATCH))
+    parser.add_argument("-r", "--reformat-every", type=int,
+        default=DEFAULT_REFORMAT_EVERY,
+        help="let Vdbench format a target's storage (\"format=\" in its config) again every n runs; 0 formats it only on the first run that succeeds (default {})".format(
+            DEFAULT_REFORMAT_EVERY))
+    parser.add_argument("-g", "--template", type=str, nargs=2, default=None,
+        metavar=("BASE", "TABLE"),
+        help="generate the Vdbench configs in configDir from the base profile BASE and the per-target parameter table TABLE (a CSV file) instead of editing hand-made ones")
+    parser.add_argument("-w", "--sweep", type=str, action="append",
+        default=None, metavar="PARAMETER=VALUES",
+        help="instead of searching for the target latency, measure every combination of the given parameter values (e.g. threads=1,4,16); repeat for each parameter, one of: {}".format(
+            ", ".join(vdbsweep.SWEEP_PARAMETERS)))
+    parser.add_argument("-W", "--sweep-mode", type=str,
+        default=vdbsweep.DEFAULT_MODE, choices=vdbsweep.SWEEP_MODES,
+        help="run the whole sweep as Vdbench for-loops in a single run (\"{}\") or each combination as a run of its own (\"{}\") (default {})".format(
+            vdbsweep.MODE_LOOP, vdbsweep.MODE_POINTS, vdbsweep.DEFAULT_MODE))
     parser.add_argument("-v", "--verbose", action="store_true",
         help="enable verbose mode")
 
@@ -268,6 +637,13 @@ def getArgs():
     args.configDir = os.path.realpath(args.configDir)
     args.outputParent = os.path.realpath(args.outputParent)
     args.workFolder = os.path.realpath(args.workFolder)
+    if args.timeseries is not None:
+        args.timeseries = os.path.realpath(args.timeseries)
+    if args.template is not None:
+        args.template = [os.path.realpath(p) for p in args.template]
+    if args.sweep is not None:
+        args.sweep = vdbsweep.Sweep([vdbsweep.parseGridSpec(s)
+            for s in args.sweep], args.sweep_mode)
 
     # Verify directories exist.
     os.makedirs(args.configDir, exist_ok=True)
@@ -281,6 +657,43 @@ def getArgs():
         print("Warning: 1.0 - fuzziness < 0. Using default ({}).".format(
             DEFAULT_FUZZINESS))
         args.fuzziness = DEFAULT_FUZZINESS
+    if args.early_stop < 0:
+        print("Warning: early_stop < 0. Using default ({}).".format(
+            DEFAULT_EARLY_STOP))
+        args.early_stop = DEFAULT_EARLY_STOP
+    if args.target_percentile is not None:
+        if not 0.0 < args.target_percentile < 100.0:
+            print("Warning: target_percentile not between 0 and 100. Using default (mean).")
+            args.target_percentile = None
+        elif args.early_stop > 0:
+            print("Warning: early stop only works with mean latency. Disabling early stop.")
+            args.early_stop = 0
+    if args.log_sync not in (LOG_SYNC_ROUND, LOG_SYNC_EXIT):
+        try:
+            if float(args.log_sync) < 0:
+                raise ValueError()
+        except ValueError:
+            print("Warning: log_sync is not \"{}\", \"{}\", or a number of seconds >= 0. Using default ({}).".format(
+                LOG_SYNC_ROUND, LOG_SYNC_EXIT, DEFAULT_LOG_SYNC))
+            args.log_sync = DEFAULT_LOG_SYNC
+    if args.collect_threads < 1:
+        print("Warning: collect_threads < 1. Using default ({}).".format(
+            vdbcollect.DEFAULT_WORKERS))
+        args.collect_threads = vdbcollect.DEFAULT_WORKERS
+    if args.reformat_every < 0:
+        print("Warning: reformat_every < 0. Using default ({}).".format(
+            DEFAULT_REFORMAT_EVERY))
+        args.reformat_every = DEFAULT_REFORMAT_EVERY
+    if args.batch < 1:
+        print("Warning: batch < 1. Using default ({}).".format(DEFAULT_BATCH))
+        args.batch = DEFAULT_BATCH
+    if args.batch > 1:
+        if args.early_stop > 0:
+            print("Warning: early stop doesn't work with batched runs. Disabling early stop.")
+            args.early_stop = 0
+        if args.target_percentile is not None:
+            print("Warning: batched runs only have one histogram for all their steps. Using mean latency.")
+            args.target_percentile = None
     if args.iops_tolerance < 1.0:
         print("Warning: iops_tolerance < 1.0. Using default ({}).".format(
             DEFAULT_IOPS_TOLERANCE))
@@ -348,6 +761,90 @@ def readConfig(configFile):
 
     return config
 
+# Run a parameter sweep (see vdbsweep) instead of the latency search. Every
+# target's config is set up for each run's points from the config it had
+# when the sweep started, and the originals are put back at the end. As in
+# the latency search, storage is only formatted as often as the
+# PreparationState allows. The results go to a vdbsweep.SweepTable at the
+# log path, with each target's latency judged against the target latency
+# band.
+def runSweep(args, jobs, sweep):
+    print("Starting sweep...")
+
+    table = vdbsweep.SweepTable(args.logPath, sweep.parameters,
+        lambda latency: judgeLatency(latency, args.targetLatency,
+            args.fuzziness))
+    print("Sweep results saved as: {}\n".format(args.logPath))
+    configs = dict((path, vdbconfig.loadConfig(path))
+        for path in getContents(args.configDir))
+    rounds = sweep.rounds()
+    preparation = PreparationState(args.reformat_every)
+    number = 0
+
+    try:
+        for run, points in enumerate(rounds, 1):
+            print("\n--- Sweep run {}/{} ({} point{}) ----".format(run,
+                len(rounds), len(points), "" if len(points) == 1 else "s"))
+            for path, config in configs.items():
+                newConfig = sweep.apply(config, points)
+                newFormat = preparation.getFormat(getNameOnly(path), run)
+                if newFormat is not None:
+                    newConfig.setFormat(newFormat)
+                vdbconfig.saveConfig(newConfig, path)
+            preparation.updatePreTest(args.configDir)
+
+            if args.verbose:
+                print("\n### Begin NetJobs Output ###")
+            startNetJobs(jobs, verbose=args.verbose)
+            if args.verbose:
+                print("\n### End NetJobs Output ###")
+
+            # A single point only needs each target's last row, which the
+            # agents may already have sent; several need every summary row.
+            folders = getContents(args.outputParent)
+            if len(points) == 1:
+                allResults = getAllTestResults(args.outputParent, None,
+                    args.collect_threads, None, getAgentRecords(jobs))
+                rows = dict((name, [r.row])
+                    for name, r in allResults.results.items())
+                errors = allResults.errors
+            else:
+                rows, errors = vdbcollect.collectSummaryRows(folders,
+                    args.collect_threads)
+            for name in sorted(errors):
+                print("Warning: unable to get sweep results for {}. Original exception follows:\n{}".format(
+                    name, str(errors[name])))
+            if not jobsInterrupted(jobs):
+                preparation.updatePostTest(run, [name
+                    for name, targetRows in rows.items()
+                    if len(targetRows) >= len(points)
+                    and vdbflatfile.isSummaryRow(targetRows[-1])])
+
+            byPoint = dict((point, {}) for point in points)
+            for name, targetRows in rows.items():
+                pairs = sweep.splitRows(targetRows, points)
+                if len(pairs) < len(points):
+                    print("Warning: {} has results for only {} of {} points.".format(
+                        name, len(pairs), len(points)))
+                for point, row in pairs:
+                    byPoint[point][name] = row
+            for point in points:
+                number += 1
+                table.addPoint(number, point, byPoint[point])
+                if args.verbose:
+                    print("Point {}: {}.".format(number, ", ".join(
+                        "{}={}".format(p, v)
+                        for p, v in zip(sweep.parameters, point))))
+
+            archiveContents(args.outputParent, run)
+    finally:
+        for path, config in configs.items():
+            vdbconfig.saveConfig(config, path)
+
+    message = "Sweep of {} points complete.".format(number)
+    print("\n--- Notice: {}\n".format(message))
+    table.signOff(message)
+
 # Archive everything in the specified directory that isn't itself an archive
 # directory.
 def archiveContents(parentDir, testID):
@@ -378,73 +875,73 @@ def getContents(parentDir):
         os.listdir(parentDir))
     return [os.path.join(parentDir, p) for p in names]
 
-# Reads test results from totals.html in the specified directory.
-def getTestResults(parentDir):
-    try:
-        flatFile = findFlatFile(parentDir)
-    except Exception as e:
-        raise e
-        
-    try:
-        with open(flatFile, "r") as f:
-            # Line for results is the last in the file, but first we need to locate the keys.
-            lines = f.readlines()
-            
-            # Keys are the first non-comment ("*") and non-HTML tag ("<") line in file.
-            keyIt = 0
-            while lines[keyIt].startswith("*") or lines[keyIt].startswith("<") or not lines[keyIt].strip():
-                keyIt += 1
-                if keyIt >= len(lines):
-                    raise Exception("Unable to locate result keys. File {} is invalid.".format(
-                        flatFile))
-                continue
-            keys = re.split("\s+", lines[keyIt].strip())
-            values = re.split("\s+", lines[-1].strip())
-            results = dict(zip(keys, values))
-            return results
-    except Exception as e:
-        raise e
-
-# Find absolute path to flatfile.html file in specified directory.
-def findFlatFile(parentDir):
-    for f in os.listdir(parentDir):
-        if os.path.basename(f) == "flatfile.html":
-            return os.path.join(parentDir, f)
-    # Didn't find.
-    raise Exception(
-        "Error: directory {} does not contain the file flatfile.html.".format(
-            parentDir))
-
-# Get all test results from the directories within the output directory.
-def getAllTestResults(outputDir):
-    allResults = {}
-    for f in getContents(outputDir):
-        allResults[os.path.basename(f)] = getTestResults(f)
-    return allResults
-
-# Given a results dictionary from getAllTestResults and the target latency,
-# returns true if ALL test results were below the target latency, else false.
+# Collect the results of the round that just finished from every output
+# directory, and for every target the agents or the early stop already have
+# results for, whether or not its directory shows up on the share yet. See
+# vdbcollect.RoundResults.
+def getAllTestResults(outputDir, earlyResults=None,
+        workers=vdbcollect.DEFAULT_WORKERS, percentile=None, records=None):
+    return vdbcollect.collectResults(getContents(outputDir), earlyResults,
+        workers, percentile, records)
+
+# Get the Vdbench results the NetJobs agents extracted in the last run, keyed
+# by target name (the base name of each record's output directory).
+def getAgentRecords(jobs):
+    records = {}
+    for test in jobs.tests:
+        for commands in test.records.values():
+            for record in commands.values():
+                name = os.path.basename(os.path.normpath(record["output"]))
+                records[name] = record
+    return records
+
+# Check whether NetJobs killed or timed out any command in the last run.
+def jobsInterrupted(jobs):
+    for test in jobs.tests:
+        for commands in test.results.values():
+            for result in commands.values():
+                if result is not None and result[0] in (NetJobs.KILLED_STATUS,
+                        NetJobs.TIMEOUT_STATUS):
+                    return True
+    return False
+
+# Check whether a TargetResult (or None) is from the summary row Vdbench
+# writes when a run ends, rather than an interval row left by a run that
+# didn't finish.
+def isCompleteResult(result):
+    return result is not None and vdbflatfile.isSummaryRow(result.row)
+
+# Given the RoundResults from getAllTestResults and the target latency,
+# returns a dictionary mapping each target name to LATENCY_BELOW,
+# LATENCY_WITHIN, or LATENCY_ABOVE, depending on where its latency (the mean,
+# or the target percentile) falls relative to the band
+# targetLatency * (1.0 -/+ fuzziness).
 def compareResultLatencies(allResults, targetLatency, fuzziness):
-    maybeDone = True
-    minLat = targetLatency * (1.0 - fuzziness)
-    maxLat = targetLatency * (1.0 + fuzziness)
-    for r in allResults.values():
-        try:
-            responseTime = float(r["resp"])
-        except ValueError as e:
-            raise e
-
-        if fuzziness == 0.0 and responseTime > targetLatency:
-            return False, False
-        elif responseTime < minLat or responseTime > maxLat:
-            maybeDone = False
-
-    return True, maybeDone
-
-# Make a new Vdbench configuration file.
-def makeNewVDBConfig(oldConfig, newConfig, newIORate):
+    verdicts = {}
+    for name, r in allResults.results.items():
+        verdicts[name] = judgeLatency(r.latency, targetLatency, fuzziness)
+
+    return verdicts
+
+# Helper for compareResultLatencies. Judge a single latency against the band
+# targetLatency * (1.0 -/+ fuzziness).
+def judgeLatency(responseTime, targetLatency, fuzziness):
+    if responseTime > targetLatency * (1.0 + fuzziness):
+        return LATENCY_ABOVE
+    elif responseTime < targetLatency * (1.0 - fuzziness):
+        return LATENCY_BELOW
+    return LATENCY_WITHIN
+
+# Make a new Vdbench configuration file from a parsed one (a
+# vdbconfig.VdbConfig), with the IO rate changed, and the format setting too
+# if one is given.
+def makeNewVDBConfig(oldConfig, newConfig, newIORate, newFormat=None):
+    config = oldConfig.copy()
+    config.setIORate(newIORate)
+    if newFormat is not None:
+        config.setFormat(newFormat)
     try:
-        vdbconfig.makeNewConfig(oldConfig, newConfig, newIORate)
+        vdbconfig.saveConfig(config, newConfig)
     except IOError as e:
         raise e
 
@@ -491,62 +988,266 @@ def makeNetJobsConfig(workFolder, timeout, targets, command, configFile):
 
     return nj_path
 
-# Run NetJobs once.
-def startNetJobs(njconfig, verbose=False):
+# Create the NetJobs scheduler for the whole test. It runs in session mode,
+# so the connections to the agents are made once and reused by every run;
+# call its close method when the test is over. Agents are asked to extract
+# each run's results themselves (see getAgentRecords).
+def makeNetJobs(njconfig, verbose=False):
     if verbose:
         njargs = ("-l", "-v", njconfig)
     else:
         njargs = ("-l", njconfig)
 
-    try:
-        NetJobs.main(njargs)
-    except Exception as e:
-        raise e
+    return NetJobs.NetJobs(njargs, session=True, extractResults=True)
 
-# Calculate the new IO rate based on the given config file and allPassed.
-def calculateNewIORate(configFile, args, allPassed):
-    rate = getOldIORate(configFile)
-    rate *= args.success_multiplier if allPassed else args.failure_multiplier
-    return int(round(rate))
+# Run NetJobs once. If an EarlyStopMonitor is given, NetJobs runs in a
+# separate thread while the monitor polls the output files and receives the
+# intervals streamed by the agents, and all agents are sent the kill command
+# as soon as the monitor reaches a verdict. Returns True if the run was
+# stopped early.
+def startNetJobs(jobs, verbose=False, monitor=None):
+    if monitor is None:
+        jobs.metricsCallback = None
+        try:
+            jobs.start()
+        except Exception as e:
+            raise e
+        return False
+
+    jobs.metricsCallback = monitor.addMetrics
+    errors = []
 
-# Get the old IO rate based on the given config file.
-def getOldIORate(configFile):
+    # NetJobs reports fatal errors with sys.exit, so catch SystemExit too and
+    # re-raise it in the main thread.
+    def runJobs():
+        try:
+            jobs.start()
+        except BaseException as e:
+            errors.append(e)
+
+    jobsThread = threading.Thread(target=runJobs)
+    jobsThread.start()
+
+    stopped = False
+    while jobsThread.is_alive():
+        jobsThread.join(EARLY_STOP_POLL_INTERVAL)
+        if stopped or not jobsThread.is_alive():
+            continue
+        monitor.poll()
+        if monitor.isDecided():
+            stopped = True
+            print("\nLatency verdict reached for all targets. Stopping run early.")
+            jobs.stop_and_kill_listeners()
+
+    if errors:
+        raise errors[0]
+    return stopped
+
+# Calculate the new IO rate for the named target from its own requested IOPS
+# and latency history. Frozen targets keep the rate they were frozen at, and
+# targets without history (new or blacklisted) keep the rate in their config
+# file.
+def calculateNewIORate(configFile, name, strategy, testInfo, targetLatency,
+        verbose=False):
+    if testInfo.frozenRates.get(name) is not None:
+        return testInfo.frozenRates[name]
+    if name not in testInfo.names or name in testInfo.frozenNames:
+        return getOldIORate(configFile)
+    history = (testInfo.getHistory(name, REQUESTED_IOPS),
+        testInfo.getHistory(name, TARGET_LATENCY), targetLatency,
+        testInfo.getHistory(name, ACHIEVED_IOPS))
+    newIORate = strategy.nextRate(*history)
+    if verbose:
+        description = strategy.describe(*history)
+        print("{}: next IO rate {}{}.".format(name, newIORate,
+            "; " + description if description else ""))
+    return newIORate
+
+# Get the named target's search bracket: its highest (rate, latency) point
+# that met the target latency and its lowest that failed, either of which
+# may be None.
+def getTargetBracket(testInfo, name, targetLatency):
+    return vdbsearch.getBracket(vdbsearch.getPoints(
+        testInfo.getHistory(name, REQUESTED_IOPS),
+        testInfo.getHistory(name, TARGET_LATENCY)), targetLatency)
+
+# Check whether the named target has met the target latency at some rate
+# below the lowest rate at which it failed, i.e. its search is bracketed from
+# below.
+def hasLowerBound(testInfo, name, targetLatency):
+    lowerBound, _ = getTargetBracket(testInfo, name, targetLatency)
+    return lowerBound is not None
+
+# Format a percentile for display, e.g. 99 -> "p99", 99.9 -> "p99.9".
+def formatPercentile(p):
+    return "p{:g}".format(p)
+
+# Get the old IO rate based on the given config file. The file is only
+# parsed again if it has changed since it was last read or written. For a
+# batched config, step picks one of its rates; without it, their mean is
+# returned.
+def getOldIORate(configFile, step=None):
     try:
-        with open(configFile, "r") as inFile:
-            for line in inFile:
-                if not re.match(r"[\/\#\*].*", line):
-                    tokens = [t.split("=") for t in line.split(",")]
-                    for i in range(len(tokens)):
-                        token = tokens[i]
-                        if len(token) > 1:
-                            key = token[0]
-                            value = token[1]
-
-                            if key == "iorate":
-                                return int(value)
-    except (IOError, ValueError) as e:
-        raise e
+        config = vdbconfig.loadConfig(configFile)
+        if config.getParam(vdbconfig.IORATE) is not None:
+            if step is None:
+                return config.getIORate()
+            rates = config.getIORates()
+            return rates[min(step, len(rates) - 1)]
     except (IsADirectoryError) as e:
         print("Warning: {} is a directory, not a file.".format(configFile))
+    except (IOError, ValueError) as e:
+        raise e
     # If we got here, the config file doesn't contain an iorate, so there's
     # something wrong.
     raise Exception("Error: config file {} malformed --- no \"iorate\" specified.".format(
         configFile))
 
-# Update all config files and archive the old ones.
-def updateAndArchiveConfigs(args, allPassed, testID):
-    for f in getContents(args.configDir):
-        name = os.path.join(args.configDir, f)
-        oldName = name
-        oldFile = archiveFile(name, testID)
-        newIORate = calculateNewIORate(oldFile, args, allPassed)
-        makeNewVDBConfig(oldFile, oldName, newIORate)
+# Update all config files and archive the old ones. Each file is parsed at
+# most once (usually not at all, since updatePreTest has already loaded it),
+# then moved to the archive and written out again with its new IO rate and
+# format setting (see PreparationState).
+def updateAndArchiveConfigs(args, strategy, testInfo, preparation, testID):
+    for name in getContents(args.configDir):
+        config = vdbconfig.loadConfig(name)
+        newIORate = makeRates(args, testInfo, getNameOnly(name),
+            calculateNewIORate(name, getNameOnly(name), strategy, testInfo,
+                args.targetLatency, verbose=args.verbose))
+        archiveFile(name, testID)
+        makeNewVDBConfig(config, name, newIORate,
+            preparation.getFormat(getNameOnly(name), testID + 1))
+
+# The IO rate(s) to give the named target's config for its next run: rate
+# itself, or with --batch, the steps of a batch around it. A frozen target
+# repeats its rate for every step, so that all targets step together.
+def makeRates(args, testInfo, name, rate):
+    if args.batch < 2:
+        return rate
+    if name in testInfo.frozenNames:
+        return [rate] * args.batch
+    lower, upper = getTargetBracket(testInfo, name, args.targetLatency)
+    return batchRates(rate, args.batch,
+        lower[0] if lower is not None else None,
+        upper[0] if upper is not None else None)
+
+# The steps IO rates of a batch, in ascending order: the rate the search
+# strategy chose, plus steps - 1 rates spread evenly below and above it
+# within rate * (1.0 -/+ BATCH_SPREAD), so a single Vdbench run measures both
+# sides of it. Once the search has a passing rate (lower) or a failing one
+# (upper), the range is narrowed to lie strictly between them, so the batch
+# tightens with the bracket instead of re-measuring rates already known to
+# pass or fail. The other steps are split between the two sides in
+# proportion to their widths.
+def batchRates(rate, steps, lower=None, upper=None):
+    low = max(vdbsearch.MIN_IORATE, rate * (1.0 - BATCH_SPREAD))
+    high = rate * (1.0 + BATCH_SPREAD)
+    if lower is not None and lower < rate:
+        low = max(low, lower)
+    if upper is not None and upper > rate:
+        high = min(high, upper)
+    below = 0
+    if high > low:
+        below = int(round((steps - 1) * (rate - low) / (high - low)))
+    above = steps - 1 - below
+    rates = ([rate - (rate - low) * step / (below + 1)
+            for step in range(below, 0, -1)] + [rate]
+        + [rate + (high - rate) * step / (above + 1)
+            for step in range(1, above + 1)])
+    return [max(vdbsearch.MIN_IORATE, int(round(r))) for r in rates]
+
+# Give every config a batch of IO rates around its current rate, before the
+# first run.
+def makeBatchConfigs(args, template, testInfo):
+    paths = getContents(args.configDir)
+    for path in paths:
+        rates = makeRates(args, testInfo, getNameOnly(path),
+            getOldIORate(path))
+        if template is not None and os.path.basename(path) in template.names():
+            template.set(os.path.basename(path), vdbconfig.IORATE,
+                vdbconfig.formatIORate(rates))
+        elif vdbconfig.loadConfig(path).getIORates() != rates:
+            makeNewVDBConfig(vdbconfig.loadConfig(path), path, rates)
+    if template is not None:
+        template.renderAll(args.configDir)
+
+# Split the results of a batched run into one RoundResults per step, from
+# the summary rows of each target's flatfile.html (one per IO rate, in the
+# order they were run). A target without a row for a step gets an error for
+# that step.
+def getBatchResults(outputDir, steps, workers=vdbcollect.DEFAULT_WORKERS):
+    rows, errors = vdbcollect.collectSummaryRows(getContents(outputDir),
+        workers)
+    stepResults = [vdbcollect.RoundResults() for _ in range(steps)]
+    for name, error in errors.items():
+        for roundResults in stepResults:
+            roundResults.errors[name] = error
+    for name, targetRows in rows.items():
+        # Any runs before the batched one come first.
+        targetRows = targetRows[-steps:]
+        for step, roundResults in enumerate(stepResults):
+            if step >= len(targetRows):
+                roundResults.errors[name] = Exception(
+                    "Error: results for {} have only {} of {} steps.".format(
+                        name, len(targetRows), steps))
+                continue
+            try:
+                roundResults.results[name] = vdbcollect.TargetResult(name,
+                    targetRows[step])
+            except Exception as e:
+                roundResults.errors[name] = e
+    return stepResults
+
+# Write the configs of every target in a vdbconfig.Template to the config
+# directory, and move any other configs there out of the way, since their
+# targets aren't part of the test.
+def makeTemplateConfigs(args, template):
+    names = template.names()
+    for path in getContents(args.configDir):
+        if os.path.basename(path) not in names:
+            print("Warning: configuration file {} is not in the template table. Archiving it.".format(
+                path))
+            archiveFile(path, 0)
+    written = template.renderAll(args.configDir)
+    print("Vdbench configurations generated from template: {} of {} written.".format(
+        len(written), len(names)))
+
+# Template counterpart of updateAndArchiveConfigs. Instead of archiving every
+# config, the round's table is archived, and only the configs whose IO rate
+# changes are written again.
+def updateTemplateConfigs(args, template, strategy, testInfo, preparation,
+        testID):
+    archiveTemplateTable(args, template, testID)
+    for name in template.names():
+        # Targets are known by their config file name without its
+        # extension, as for configs that aren't generated.
+        path = os.path.join(args.configDir, name)
+        targetName = getNameOnly(path)
+        template.set(name, vdbconfig.IORATE, vdbconfig.formatIORate(
+            makeRates(args, testInfo, targetName, calculateNewIORate(path,
+                targetName, strategy, testInfo, args.targetLatency,
+                verbose=args.verbose))))
+        newFormat = preparation.getFormat(targetName, testID + 1)
+        if newFormat is not None:
+            template.set(name, vdbconfig.FORMAT, newFormat)
+    written = template.renderAll(args.configDir)
+    if args.verbose:
+        print("Rewrote {} of {} Vdbench configurations.".format(
+            len(written), len(template.names())))
+
+# Save the template table used by a run to the config archive directory for
+# that run.
+def archiveTemplateTable(args, template, testID):
+    archDir = os.path.join(args.configDir, ARCHIVE_DIR_FORMAT.format(
+        content=os.path.basename(args.configDir), testID=testID))
+    os.makedirs(archDir, exist_ok=True)
+    template.saveTable(os.path.join(archDir,
+        os.path.basename(args.template[1])))
 
 # Test if the achieved IOPS is acceptable (achieved * tolerance >= requested).
 def testAchievedIOPS(testInfo, tolerance):
     for name in testInfo.names:
-        requestedIOPS = float(testInfo.requestedIOPS[name][-1])
-        achievedIOPS = float(testInfo.achievedIOPS[name][-1])
+        requestedIOPS = testInfo.getLatest(name, REQUESTED_IOPS)
+        achievedIOPS = testInfo.getLatest(name, ACHIEVED_IOPS)
 
         if achievedIOPS * tolerance < requestedIOPS:
             return False
@@ -558,49 +1259,150 @@ def getNameOnly(path):
     return os.path.splitext(os.path.basename(path))[0]
 
 # Start the main run.
-def run(args, config, njconfig, testInfo, logWriter):
+def run(args, config, jobs, testInfo, logWriter, seriesWriter=None,
+        template=None):
     print("Starting main run...")
 
     consecutiveFailures = 0
+    strategy = vdbsearch.getStrategy(args.search, args.success_multiplier,
+        args.failure_multiplier)
+    preparation = PreparationState(args.reformat_every)
+    if args.batch > 1:
+        makeBatchConfigs(args, template, testInfo)
 
     # Main loop. Note the run indexing goes from 1 to args.max_runs
     # (for readability).
     for run in range(1, args.max_runs+1):
         print("\n--- Run {}/{} ----".format(run, args.max_runs))
 
-        testInfo.updatePreTest(args.configDir)
+        testInfo.updatePreTest(args.configDir, 0 if args.batch > 1 else None)
+        preparation.updatePreTest(args.configDir)
 
         if args.verbose:
             print("\n### Begin NetJobs Output ###")
 
-        startNetJobs(njconfig, verbose=args.verbose)
+        monitor = None
+        if args.early_stop > 0:
+            monitor = EarlyStopMonitor(args.outputParent, list(testInfo.names),
+                [n for n in testInfo.names if n not in testInfo.frozenNames],
+                args.early_stop, args.targetLatency, args.fuzziness)
+
+        stoppedEarly = startNetJobs(jobs, verbose=args.verbose,
+            monitor=monitor)
+        # A stopped run has no summary row, so use the monitor's averages.
+        earlyResults = monitor.getResults() if stoppedEarly else {}
 
         if args.verbose:
             print("\n### End NetJobs Output ###")
 
-        testInfo.updatePostTest(args.outputParent)
-
-        logWriter.updateLog(testInfo, run)
+        # Read every target's results once; the log and the latency
+        # comparison both work from this table. Results extracted by the
+        # agents are used where available, and the rest are read from the
+        # output directory. A batched run has a table per step, read from
+        # the output directory.
+        if args.batch > 1:
+            stepResults = getBatchResults(args.outputParent, args.batch,
+                args.collect_threads)
+        else:
+            records = getAgentRecords(jobs)
+            stepResults = [getAllTestResults(args.outputParent, earlyResults,
+                args.collect_threads, args.target_percentile, records)]
+            if args.verbose:
+                print("Results from agents for {} of {} targets.".format(
+                    len([n for n in testInfo.names if n in records]),
+                    len(testInfo.names)))
+
+        # Each step of a batched run is logged and judged as a run of its
+        # own. A target is frozen at the rate of the first step that lands
+        # inside the latency band, and the requested IOPS only need to be
+        # achieved at one step.
+        sufficientIOPS = False
+        aboveNames = set()
+        for step, allResults in enumerate(stepResults):
+            if step > 0:
+                testInfo.updatePreTest(args.configDir, step)
+            testInfo.updatePostTest(allResults)
+
+            fleetLatency = None
+            if args.target_percentile is not None:
+                fallbackNames = [name for name in testInfo.names
+                    if not allResults.get(name).fromHistogram]
+                if len(fallbackNames) > 0:
+                    print("Warning: no usable {} for: {}. Using mean latency for these targets.".format(
+                        vdbhistogram.HISTOGRAM_NAME, ", ".join(fallbackNames)))
+                merged = allResults.mergedHistogram(testInfo.names)
+                if merged is not None:
+                    fleetLatency = merged.percentile(args.target_percentile)
+
+            logWriter.updateLog(testInfo, run, fleetLatency,
+                step if args.batch > 1 else None)
+
+            verdicts = compareResultLatencies(allResults, args.targetLatency,
+                args.fuzziness)
+            for name in testInfo.names:
+                if verdicts.get(name) == LATENCY_WITHIN:
+                    testInfo.freezeTarget(name,
+                        int(testInfo.getLatest(name, REQUESTED_IOPS)))
+                elif verdicts.get(name) == LATENCY_ABOVE:
+                    aboveNames.add(name)
+            sufficientIOPS = sufficientIOPS or testAchievedIOPS(testInfo,
+                args.iops_tolerance)
+        if not stoppedEarly and not jobsInterrupted(jobs):
+            preparation.updatePostTest(run, [name for name in testInfo.names
+                if isCompleteResult(stepResults[-1].get(name))])
 
-        allResults = getAllTestResults(args.outputParent)
-        allPassed, isDone = compareResultLatencies(allResults,
-            args.targetLatency, args.fuzziness)
-        sufficientIOPS = testAchievedIOPS(testInfo, args.iops_tolerance)
+        # A target failed if any step was above the band, unless another
+        # step froze it.
+        failedNames = [name for name in testInfo.names
+            if name in aboveNames and name not in testInfo.frozenNames]
+        allPassed = len(failedNames) == 0
+        isDone = testInfo.allFrozen()
 
         if args.verbose:
             print("\nDid all targets achieve the target latency? {}.".format(
                 "Yes" if allPassed else "No"))
             print("Did all targets achieve sufficient IOPS? {}.\n".format(
                 "Yes" if sufficientIOPS else "No"))
+            print("Targets within the latency band (frozen): {}/{}.".format(
+                len(testInfo.frozenNames), len(testInfo.names)))
+            print("Latency across targets: mean {:.3f}ms, median {:.3f}ms, 95th percentile {:.3f}ms.\n".format(
+                testInfo.store.mean(testInfo.runCount, LATENCY,
+                    testInfo.names),
+                testInfo.store.percentile(testInfo.runCount, LATENCY, 50,
+                    testInfo.names),
+                testInfo.store.percentile(testInfo.runCount, LATENCY, 95,
+                    testInfo.names)))
+            if fleetLatency is not None:
+                print("Fleet-wide {} latency (merged histograms): {:.3f}ms.\n".format(
+                    formatPercentile(args.target_percentile), fleetLatency))
             print("Archiving output and Vdbench configurations.\n")
 
+        # Save the full interval history before the output is archived.
+        if seriesWriter is not None:
+            count = vdbseries.ingestRound(seriesWriter, run,
+                getContents(args.outputParent), args.collect_threads)
+            if args.verbose:
+                print("Saved {} intervals to time-series file.\n".format(count))
+
         archiveContents(args.outputParent, run)
-        if run == args.max_runs:
+        if template is not None:
+            if run == args.max_runs:
+                archiveTemplateTable(args, template, run)
+            else:
+                updateTemplateConfigs(args, template, strategy, testInfo,
+                    preparation, run)
+        elif run == args.max_runs:
             archiveContents(args.configDir, run)
         else:
-            updateAndArchiveConfigs(args, allPassed, run)
-
-        if allPassed:
+            updateAndArchiveConfigs(args, strategy, testInfo, preparation,
+                run)
+
+        # With --forgive-bracketed-failures, a failure of a target that is
+        # known to meet the target latency at some rate only narrows its
+        # search bracket, so it doesn't count towards aborting.
+        if allPassed or (args.forgive_bracketed_failures
+                and all(hasLowerBound(testInfo, name, args.targetLatency)
+                    for name in failedNames)):
             consecutiveFailures = 0
         else:
             consecutiveFailures += 1
@@ -623,7 +1425,7 @@ def run(args, config, njconfig, testInfo, logWriter):
 
         # Finish if sweet spot found.
         if isDone:
-            message = "Desired latency (targetLatency * (1.0 - fuzziness) <= x <= targetLatency * (1.0 + fuzziness) --> {min} <= x <= {max}) found. Run complete.".format(
+            message = "Desired latency for all targets (targetLatency * (1.0 - fuzziness) <= x <= targetLatency * (1.0 + fuzziness) --> {min} <= x <= {max}) found. Run complete.".format(
             min=args.targetLatency * (1.0 - args.fuzziness),
             max=args.targetLatency * (1.0 + args.fuzziness))
             print("\n--- Notice: {}\n".format(message))
@@ -648,14 +1450,34 @@ def main():
         print("> Output directory: {}".format(args.outputParent))
         print("> NetJobs work folder: {}".format(args.workFolder))
         print("> Log file: {}".format(args.logPath))
+        print("> Log sync: {}".format(args.log_sync
+            if args.log_sync in (LOG_SYNC_ROUND, LOG_SYNC_EXIT)
+            else "every {}s".format(args.log_sync)))
+        if args.timeseries is not None:
+            print("> Time-series file: {}".format(args.timeseries))
+        if args.batch > 1:
+            print("> Batch: {} IO rates per run".format(args.batch))
+        if args.template is not None:
+            print("> Template: {} (table {})".format(*args.template))
+        if args.sweep is not None:
+            print("> Sweep ({} mode): {}".format(args.sweep.mode, " x ".join(
+                "{}=({})".format(p, ",".join(v)) for p, v in args.sweep.grid)))
         print("> Target latency: {}ms".format(args.targetLatency))
         print("> Fuzziness: {}".format(args.fuzziness))
         print("> Maximum runs: {}".format(args.max_runs))
         print("> Success multiplier: {}".format(args.success_multiplier))
         print("> Failure multiplier: {}".format(args.failure_multiplier))
+        print("> Search strategy: {}".format(args.search))
+        print("> Latency measure: {}".format(
+            formatPercentile(args.target_percentile)
+            if args.target_percentile is not None else "mean"))
+        print("> Early stop: {}".format("after at least {} intervals".format(
+            args.early_stop) if args.early_stop > 0 else "disabled"))
         print("> NetJobs timeout: {}s".format(args.timeout))
-        print("> Aborting after {} consecutive failures".format(
-            args.consecutive_failures))
+        print("> Aborting after {} consecutive failures{}".format(
+            args.consecutive_failures,
+            " (not counting bracketed targets)"
+            if args.forgive_bracketed_failures else ""))
 
     config = readConfig(args.configFile)
 
@@ -668,16 +1490,41 @@ def main():
 
     njconfig = makeNetJobsConfig(args.workFolder, args.timeout,
         config["targets"], config["command"], args.configFile)
+    jobs = makeNetJobs(njconfig, args.verbose)
+
+    template = None
+    if args.template is not None:
+        template = vdbconfig.Template.load(*args.template)
+        makeTemplateConfigs(args, template)
+
+    if args.sweep is not None:
+        try:
+            runSweep(args, jobs, args.sweep)
+        finally:
+            jobs.close()
+        return
 
     testInfo = TestInfo(args.configDir)
 
     try:
-        with open(args.logPath, "w", newline="") as log:
-            logWriter = LogWriter(log)
-            logWriter.writeHeader()
-            print("Log file saved as: {}\n".format(args.logPath))
-            # Done with setup.
-            run(args, config, njconfig, testInfo, logWriter)
+        logWriter = LogWriter(args.logPath, args.target_percentile,
+            args.log_sync, args.batch > 1)
+        logWriter.writeHeader()
+        print("Log file saved as: {}\n".format(args.logPath))
+        seriesWriter = None
+        if args.timeseries is not None:
+            seriesWriter = vdbseries.SeriesWriter(args.timeseries)
+        # Done with setup.
+        try:
+            run(args, config, jobs, testInfo, logWriter, seriesWriter,
+                template)
+        finally:
+            # Release the agents and write whatever has been logged, even if
+            # the test failed.
+            jobs.close()
+            logWriter.close()
+            if seriesWriter is not None:
+                seriesWriter.close()
     except IOError as e:
         raise e
 